@@ -0,0 +1,234 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how compile time and peak memory grow with the size of the
+main function, for several shapes of synthetic program.
+
+    python benchmarks/compile_scaling.py --sizes 500,1000,2000,4000
+
+Parsing (by Python's own 'ast' module) is timed separately from
+translation and emission of the JSON definition.  For each shape, the
+'exponent' is the slope of log(translation time) against log(size)
+between the smallest and largest sizes; about 1 means linear scaling.
+"""
+
+import ast
+import click
+import gc
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from pysfn.tools.compile import TranslationContext
+from pysfn.tools.emit import StateMachineEmitter
+
+
+########################################################################
+# Synthetic programs.  Each generator returns the source of a module
+# whose main function has roughly 'n' statements.
+
+def main_source(body_lines):
+    return '\n'.join(['@PSF.main', 'def main(x0):']
+                     + ['    ' + ln for ln in body_lines]) + '\n'
+
+
+def flat_source(n):
+    """A straight run of 'n' calls, each using the previous result."""
+    lines = ['x{} = f(x{})'.format(i + 1, i) for i in range(n)]
+    return main_source(lines + ['return x{}'.format(n)])
+
+
+def nested_if_source(n, depth=40):
+    """
+    Blocks of 'if' statements nested 'depth' deep, each with an 'else';
+    Python allows only 100 levels of indentation.
+    """
+    lines = []
+    for b in range(max(n // depth, 1)):
+        for d in range(depth):
+            lines.append('    ' * d
+                         + "if PSF.StringEquals(x0, 'v{}'):".format(d))
+            lines.append('    ' * (d + 1) + 'y = f(x0)')
+        for d in reversed(range(depth)):
+            lines.append('    ' * d + 'else:')
+            lines.append('    ' * (d + 1) + 'y = g(x0)')
+        lines.append('x0 = h(y)')
+    return main_source(lines + ['return x0'])
+
+
+def elif_chain_source(n, max_arms=500):
+    """
+    Chains of up to 'max_arms' if/elif arms, which Python represents
+    as deeply nested 'If' nodes.
+    """
+    lines = []
+    n_left = n
+    while n_left > 0:
+        n_arms = min(n_left, max_arms)
+        for i in range(n_arms):
+            lines.append("{} PSF.StringEquals(x0, 'v{}'):"
+                         .format('if' if i == 0 else 'elif', i))
+            lines.append('    y = f(x0)')
+        lines += ['else:', '    y = g(x0)', 'x0 = h(y)']
+        n_left -= n_arms
+    return main_source(lines + ['return x0'])
+
+
+def try_source(n):
+    """A run of 'n' try/except blocks."""
+    lines = []
+    for i in range(n):
+        lines += ['try:',
+                  '    x{} = f(x{})'.format(i + 1, i),
+                  'except ValueError:',
+                  "    raise PSF.Fail('Bad', 'bad value')"]
+    return main_source(lines + ['return x{}'.format(n)])
+
+
+def parallel_source(n):
+    """One PSF.parallel() call with 'n' two-statement branches."""
+    lines = []
+    for i in range(n):
+        lines += ['def branch_{}():'.format(i),
+                  '    y = f(x0)',
+                  '    return y']
+    lines.append('ys = PSF.parallel({})'.format(
+        ', '.join('branch_{}'.format(i) for i in range(n))))
+    return main_source(lines + ['return ys'])
+
+
+shapes = {'flat': flat_source,
+          'nested-if': nested_if_source,
+          'elif-chain': elif_chain_source,
+          'try': try_source,
+          'parallel': parallel_source}
+
+
+########################################################################
+
+def translate(syntax_tree, xln_ctx):
+    """
+    Translate and emit the definition as the compiler command does,
+    returning the number of states.
+    """
+    state_items, start_at = xln_ctx.state_machine_definition(syntax_tree)
+    with open(os.devnull, 'wt') as f_out:
+        emitter = StateMachineEmitter(f_out, max_bytes=None)
+        emitter.emit(state_items, start_at)
+    return len(emitter.state_sizes)
+
+
+def measure(source, xln_ctx, repeat):
+    """
+    Return (n_states, parse_seconds, translate_seconds, peak_bytes)
+    for compiling the given source, taking the best times of 'repeat'
+    runs.  Peak memory of translation alone is measured on a separate
+    run, since tracemalloc slows everything down.
+    """
+    best_parse = best_translate = math.inf
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        syntax_tree = ast.parse(source)
+        t1 = time.perf_counter()
+        n_states = translate(syntax_tree, xln_ctx)
+        t2 = time.perf_counter()
+        best_parse = min(best_parse, t1 - t0)
+        best_translate = min(best_translate, t2 - t1)
+
+    # Measure the translation's own memory, not that of the AST.
+    syntax_tree = ast.parse(source)
+    gc.collect()
+    tracemalloc.start()
+    translate(syntax_tree, xln_ctx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return n_states, best_parse, best_translate, peak
+
+
+def exponent(results):
+    (n0, _, _, t0, _), (n1, _, _, t1, _) = results[0], results[-1]
+    if n0 == n1 or t0 <= 0:
+        return math.nan
+    return math.log(t1 / t0) / math.log(n1 / n0)
+
+
+@click.command()
+@click.option('--sizes', default='250,500,1000,2000,4000', show_default=True,
+              help='Comma-separated statement counts.')
+@click.option('--shape', 'shape_names', multiple=True,
+              type=click.Choice(sorted(shapes)),
+              help='Shape of program to measure; may be repeated.'
+                   '  Default is all.')
+@click.option('--repeat', type=click.IntRange(min=1), default=3,
+              show_default=True, help='Timing runs per size; best is kept.')
+@click.option('--optimise', is_flag=True,
+              help='Also run the auto-parallel, fusing and pruning passes.')
+@click.option('--json-out', type=click.Path(dir_okay=False),
+              help='Write the results to this file as JSON.')
+@click.option('--max-exponent', type=float,
+              help='Exit with status 1 if any shape scales worse than this.')
+def main(sizes, shape_names, repeat, optimise, json_out, max_exponent):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    sizes = [int(s) for s in sizes.split(',')]
+    xln_ctx = TranslationContext('arn:aws:lambda:::function:dispatch',
+                                 auto_parallel='all' if optimise else None,
+                                 fuse_calls=optimise,
+                                 prune_locals=optimise)
+
+    report = {}
+    worst = 0.0
+    click.echo('{:<12} {:>6} {:>8} {:>10} {:>10} {:>10}'
+               .format('shape', 'size', 'states', 'parse s', 'translate s',
+                       'peak MB'))
+    for name in (shape_names or sorted(shapes)):
+        results = []
+        for n in sizes:
+            result = measure(shapes[name](n), xln_ctx, repeat)
+            n_states, parse_s, translate_s, peak = result
+            results.append((n,) + result)
+            click.echo('{:<12} {:>6} {:>8} {:>10.4f} {:>10.4f} {:>10.2f}'
+                       .format(name, n, n_states, parse_s, translate_s,
+                               peak / 2**20))
+        slope = exponent(results)
+        worst = max(worst, slope)
+        click.echo('{:<12} exponent {:.2f}'.format(name, slope))
+        report[name] = {'exponent': slope,
+                        'results': [dict(zip(['size', 'n_states',
+                                              'parse_seconds',
+                                              'translate_seconds',
+                                              'peak_bytes'], r))
+                                    for r in results]}
+
+    if json_out:
+        with open(json_out, 'wt') as f_out:
+            json.dump(report, f_out, indent=2)
+
+    if max_exponent is not None and worst > max_exponent:
+        click.echo('worst exponent {:.2f} exceeds {:.2f}'
+                   .format(worst, max_exponent), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
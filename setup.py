@@ -42,5 +42,6 @@ setuptools.setup(
     package_dir={"": "src"},
     python_requires="~=3.6",
     install_requires=["click", "attrs"],
-    extras_require={"dev": ["pytest"]},
+    extras_require={"dev": ["pytest"], "s3": ["boto3"],
+                    "zstd": ["zstandard"]},
     project_urls={"Bugs": "https://github.com/bennorth/pyawssfn/issues"})
@@ -0,0 +1,186 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stores for values too large to keep in a state machine's state.
+
+A value whose JSON exceeds a threshold is written to a store, under a
+key made from its content, and replaced in the state by a small
+reference, {"pysfn_blob": URI, "n_bytes": N}.  The Lambda handler
+resolves references when a function reads the variable holding them.
+
+This file is bundled into the Lambda zip-file as 'pysfn_blobstore.py',
+so must not import anything from the rest of 'pysfn'.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+ref_key = 'pysfn_blob'
+
+
+def is_ref(value):
+    return (type(value) is dict
+            and len(value) == 2
+            and ref_key in value
+            and 'n_bytes' in value)
+
+
+class BlobStore:
+    """
+    Base class of stores, each holding blobs under keys within its
+    'uri_prefix'.  Subclasses provide put(key, data) and get(key).
+    """
+    uri_prefix = None
+
+    def offloaded(self, value, threshold):
+        """
+        Return the given JSON-friendly value, or, if its JSON is larger
+        than 'threshold' bytes, a reference to it, having stored it.
+        """
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(data) <= threshold:
+            return value
+        key = hashlib.sha256(data).hexdigest() + '.json'
+        self.put(key, data)
+        return {ref_key: self.uri_prefix + key, 'n_bytes': len(data)}
+
+    def loaded(self, ref):
+        uri = ref[ref_key]
+        if not uri.startswith(self.uri_prefix):
+            raise ValueError('blob {} is not in the store at {}'
+                             .format(uri, self.uri_prefix))
+        return json.loads(self.get(uri[len(self.uri_prefix):]))
+
+    def resolved(self, value, memo=None):
+        """
+        Return the given value with every reference within it replaced
+        by the value it refers to.  Blobs are loaded at most once per
+        'memo' dict.
+        """
+        if memo is None:
+            memo = {}
+        if is_ref(value):
+            uri = value[ref_key]
+            if uri not in memo:
+                memo[uri] = self.loaded(value)
+            return memo[uri]
+        if type(value) is list:
+            return [self.resolved(v, memo) for v in value]
+        if type(value) is dict:
+            return {k: self.resolved(v, memo) for k, v in value.items()}
+        return value
+
+    def resolving(self, local_vars):
+        """
+        Return a read-only view of the given 'locals' in which looking
+        up a variable resolves any references in its value, so that
+        only blobs of variables actually read are loaded.
+        """
+        return ResolvingLocals(self, local_vars)
+
+
+class ResolvingLocals:
+    def __init__(self, store, local_vars):
+        self.store = store
+        self.local_vars = local_vars
+        self.memo = {}
+
+    def __getitem__(self, name):
+        return self.store.resolved(self.local_vars[name], self.memo)
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs as files in a local directory, standing in for S3 when
+    running locally or in tests.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.uri_prefix = 'file://{}/'.format(self.directory)
+
+    def put(self, key, data):
+        fname = os.path.join(self.directory, key)
+        if os.path.exists(fname):
+            return  # Keys are content hashes.
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename, so no reader sees a partial blob.
+        fd, tmp_fname = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f_out:
+            f_out.write(data)
+        os.replace(tmp_fname, fname)
+
+    def get(self, key):
+        with open(os.path.join(self.directory, key), 'rb') as f_in:
+            return f_in.read()
+
+
+class S3BlobStore(BlobStore):
+    """
+    Blobs as objects in an S3 bucket (or any store with S3's API, via
+    the 'endpoint_url'), under a key prefix.  Needs 'boto3', which the
+    Lambda runtime provides.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.uri_prefix = 's3://{}/{}'.format(bucket, prefix)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key,
+                               Body=data)
+
+    def get(self, key):
+        obj = self.client.get_object(Bucket=self.bucket,
+                                     Key=self.prefix + key)
+        return obj['Body'].read()
+
+
+def open_store(uri):
+    """
+    Return the store at the given URI: 's3://bucket/prefix/' (with the
+    S3 endpoint from the environment variable PYSFN_S3_ENDPOINT_URL,
+    if set), 'file:///directory', or a plain directory name.
+    """
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        if not bucket:
+            raise ValueError('expected s3://bucket/prefix, not {!r}'
+                             .format(uri))
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3BlobStore(bucket, prefix,
+                           os.environ.get('PYSFN_S3_ENDPOINT_URL'))
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    elif '://' in uri:
+        raise ValueError('unknown blob store {!r}'.format(uri))
+    return LocalBlobStore(uri)
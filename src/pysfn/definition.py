@@ -32,13 +32,357 @@ class Fail(Exception):
         return f'{self.label}: {self.message}'
 
 
+_parallel_executor = None
+
+
+def set_parallel_executor(executor):
+    """
+    Choose how parallel() runs branches which are plain functions:
+    'threads' for a new thread per branch, 'serial' for one after
+    another, or a concurrent.futures.Executor, such as a
+    ProcessPoolExecutor (whose branches must then be picklable, so
+    module-level functions).  None restores the default, which is
+    'threads' unless the environment variable PYSFN_PARALLEL names
+    another.  Return the previous setting.
+    """
+    global _parallel_executor
+    previous = _parallel_executor
+    _parallel_executor = executor
+    return previous
+
+
 def parallel(*funs):
-    return [f() for f in funs]
+    """
+    Call each of the given functions, concurrently, and return the list
+    of their results in order.  If any raises an exception, raise the
+    exception of the first to fail, as a Parallel state would.  If any
+    branch is a coroutine function, all are run on an asyncio event
+    loop, plain functions in its default executor.
+
+    Under a VirtualClock, each branch which is a plain function, run in
+    this process, sleeps on a clock of its own, and the branches
+    together take as long as the slowest.  Coroutine branches, and
+    branches on another executor, sleep on the enclosing clock.
+    """
+    import inspect
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    if any(inspect.iscoroutinefunction(f) for f in funs):
+        return _on_branch_clocks(_gathered_results, funs)
+    executor = (_parallel_executor
+                or os.environ.get('PYSFN_PARALLEL', 'threads'))
+    if executor == 'serial' or len(funs) <= 1:
+        return _on_branch_clocks(lambda funs: [f() for f in funs], funs)
+    if executor == 'threads':
+        def threaded(funs):
+            with ThreadPoolExecutor(len(funs)) as pool:
+                return _results_in_order(pool, funs)
+        return _on_branch_clocks(threaded, funs)
+    if isinstance(executor, str):
+        raise ValueError('unknown parallel executor {!r}'.format(executor))
+    return _results_in_order(executor, funs)
+
+
+def _results_in_order(pool, funs):
+    from concurrent.futures import wait, FIRST_EXCEPTION
+
+    futures = [pool.submit(f) for f in funs]
+    wait(futures, return_when=FIRST_EXCEPTION)
+    failed = [f for f in futures if f.done() and f.exception() is not None]
+    if failed:
+        for f in futures:
+            f.cancel()
+        raise failed[0].exception()
+    return [f.result() for f in futures]
+
+
+def _on_branch_clocks(run, funs):
+    """
+    Return run(funs), with each plain function in 'funs' sleeping on a
+    VirtualClock of its own if the current clock is one.  The current
+    clock then advances to the latest of the branches' clocks.
+    """
+    import inspect
+
+    clock = _current_clock()
+    if not isinstance(clock, VirtualClock):
+        return run(funs)
+    clocks = [VirtualClock(clock.now) for _ in funs]
+    try:
+        return run([f if inspect.iscoroutinefunction(f)
+                    else _on_clock(f, c)
+                    for f, c in zip(funs, clocks)])
+    finally:
+        clock.join(clocks)
+
+
+def _on_clock(fun, clock):
+    import threading
+
+    def call():
+        thread_id = threading.get_ident()
+        nested = thread_id in _branch_clocks
+        previous = _branch_clocks.get(thread_id)
+        _branch_clocks[thread_id] = clock
+        try:
+            return fun()
+        finally:
+            if nested:
+                _branch_clocks[thread_id] = previous
+            else:
+                del _branch_clocks[thread_id]
+    return call
+
+
+def _gathered_results(funs):
+    import asyncio
+    import inspect
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def gathered():
+        # Within a coroutine, this is the running loop.
+        loop = asyncio.get_event_loop()
+        return await asyncio.gather(*[
+            f() if inspect.iscoroutinefunction(f)
+            else loop.run_in_executor(None, f)
+            for f in funs])
+
+    if _running_loop() is None:
+        return _run_until_complete(gathered())
+    # This thread is already running an event loop, which cannot be
+    # re-entered, so run the branches on a loop of their own.
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(_run_until_complete, gathered()).result()
+
+
+def _running_loop():
+    import asyncio
+
+    # asyncio.get_running_loop() and asyncio.run() are new in Python
+    # 3.7; in 3.6 there is only the underlying _get_running_loop().
+    if not hasattr(asyncio, 'get_running_loop'):
+        return asyncio._get_running_loop()
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _run_until_complete(coroutine):
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def map(fun, items, max_concurrency=0):
+    """
+    Return the list of fun(item) for each of the given items.  This is
+    the PSF namespace's counterpart to a Map state, so deliberately
+    shares the builtin's name there; within this module, nothing uses
+    the builtin.  The items are processed one at a time, in order, so
+    that a large iterable (e.g., from items_from()) is consumed lazily;
+    'max_concurrency' applies only to the compiled Map state.
+    """
+    return [fun(item) for item in items]
+
+
+item_input_types = {'.jsonl': 'JSONL', '.csv': 'CSV', '.json': 'JSON'}
+
+
+def s3_location(uri):
+    """
+    Return the (bucket, key) pair of the given 's3://bucket/key' URI.
+    """
+    prefix = 's3://'
+    bucket, _, key = uri[len(prefix):].partition('/')
+    if not uri.startswith(prefix) or not bucket or not key:
+        raise ValueError('expected s3://bucket/key but got {!r}'.format(uri))
+    return bucket, key
+
+
+def item_input_type(key, input_type=None):
+    """
+    Return the input type ('JSONL', 'CSV' or 'JSON') of the object with
+    the given key, as given or else from its suffix.
+    """
+    if input_type is None:
+        suffix = key[key.rfind('.'):].lower() if '.' in key else ''
+        input_type = item_input_types.get(suffix)
+        if input_type is None:
+            raise ValueError('cannot tell input type of {!r}; give'
+                             ' input_type explicitly'.format(key))
+    if input_type not in item_input_types.values():
+        raise ValueError('unknown input type {!r}'.format(input_type))
+    return input_type
+
+
+def items_from(uri, input_type=None):
+    """
+    Yield the items of the JSONL, CSV (with a header row, giving one
+    dict per row) or JSON-array object at the given 's3://bucket/key'
+    URI, reading it as the items are asked for.  If the environment
+    variable PYSFN_ITEMS_DIR is set, the object is read instead from the
+    file '<bucket>/<key>' under that directory.
+    """
+    import codecs
+    import csv
+    import json
+    import os
+
+    bucket, key = s3_location(uri)
+    input_type = item_input_type(key, input_type)
+
+    items_dir = os.environ.get('PYSFN_ITEMS_DIR')
+    if items_dir:
+        f_in = open(os.path.join(items_dir, bucket, key), 'rt',
+                    encoding='utf-8', newline='')
+    else:
+        import boto3
+        body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+        f_in = codecs.getreader('utf-8')(body)
+
+    with f_in:
+        if input_type == 'JSONL':
+            for line in f_in:
+                if line.strip():
+                    yield json.loads(line)
+        elif input_type == 'CSV':
+            yield from csv.DictReader(f_in)
+        else:
+            # A JSON array cannot be parsed piecemeal with the standard
+            # library, so is read whole.
+            yield from json.load(f_in)
+
+
+def error_matches(error_equals, error):
+    """
+    Say whether the error with the given name is matched by the given
+    'ErrorEquals' list of a retrier or catcher.  As in Step Functions,
+    'States.Runtime' is only matched by name; otherwise 'States.ALL'
+    matches any error, and 'States.TaskFailed' any but 'States.Timeout'.
+    """
+    if error in error_equals:
+        return True
+    if error == 'States.Runtime':
+        return False
+    if 'States.ALL' in error_equals:
+        return True
+    return 'States.TaskFailed' in error_equals and error != 'States.Timeout'
+
+
+class VirtualClock:
+    """
+    A clock whose time passes only when it is slept on, for running
+    retries without waiting while still recording how long they would
+    have taken.  Used as a context manager, it is the clock for
+    with_retry_spec() within the 'with' block.
+    """
+    def __init__(self, now=0.0):
+        import threading
+        self.now = now
+        self.sleeps = []
+        self._lock = threading.Lock()
+        self._previous = []
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    def join(self, clocks):
+        """
+        Take on the sleeps of the given clocks, which ran concurrently
+        from this one's time, and advance to the latest of them.
+        """
+        with self._lock:
+            for clock in clocks:
+                self.sleeps.extend(clock.sleeps)
+                self.now = max(self.now, clock.now)
+
+    def __enter__(self):
+        self._previous.append(set_clock(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        set_clock(self._previous.pop())
+
+
+_clock = None
+
+# The clocks of parallel() branches running under a VirtualClock, by
+# the identity of the thread running the branch.
+_branch_clocks = {}
+
+
+def set_clock(clock):
+    """
+    Set the clock (an object with a sleep(seconds) method) on which
+    with_retry_spec() waits between attempts, or restore the real one
+    with None.  Return the previous clock.  Within a parallel() branch
+    with a clock of its own, this sets the branch's clock.
+    """
+    global _clock
+    import threading
+
+    thread_id = threading.get_ident()
+    previous = _current_clock()
+    if thread_id in _branch_clocks:
+        _branch_clocks[thread_id] = clock
+    else:
+        _clock = clock
+    return previous
+
+
+def _current_clock():
+    import threading
+    return _branch_clocks.get(threading.get_ident(), _clock)
+
+
+def _sleep(seconds):
+    clock = _current_clock()
+    if clock is None:
+        import time
+        time.sleep(seconds)
+    else:
+        clock.sleep(seconds)
 
 
 def with_retry_spec(fun, args, *retry_specs):
-    return fun(*args)
+    """
+    Return fun(*args), retrying as a Task state with the given retry
+    specs would.  Each spec is (error_equals, interval_seconds,
+    max_attempts, backoff_rate); an exception's error name is the name
+    of its class.  The first spec matching the error decides: if it
+    has retried fewer than 'max_attempts' times, wait
+    interval_seconds * backoff_rate ** (retries so far) and call again;
+    otherwise, or if no spec matches, let the exception propagate.
+    """
+    n_retries = [0] * len(retry_specs)
+    while True:
+        try:
+            return fun(*args)
+        except Exception as exc:
+            error = type(exc).__name__
+            i = next((i for i, spec in enumerate(retry_specs)
+                      if error_matches(spec[0], error)),
+                     None)
+            if i is None:
+                raise
+            _, interval_seconds, max_attempts, backoff_rate = retry_specs[i]
+            if n_retries[i] >= max_attempts:
+                raise
+            _sleep(interval_seconds * backoff_rate ** n_retries[i])
+            n_retries[i] += 1
 
 
 def main(fun):
     return fun
+
+
+def pure(fun):
+    return fun
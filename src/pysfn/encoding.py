@@ -0,0 +1,222 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact encodings of values crossing the Lambda boundary.
+
+The return annotation of a called function chooses how the Lambda
+handler encodes its result into the state:
+
+    bytes, bytearray --- the bytes, zlib-compressed if that helps;
+
+    array.array --- the array's machine values, little-endian;
+
+    list[int], list[float] --- likewise, packed into the narrowest
+        array type holding them, and decoded back to a list;
+
+    dict --- if its JSON is large, that JSON compressed with zstd (if
+        the 'zstandard' package is available) or gzip.
+
+Lists and dicts are valid JSON as they are, so are encoded only if the
+state machine does not itself look at them (see 'offload' in the call
+descriptors).
+
+An encoded value is a JSON object {"pysfn_codec": KIND, "data": BASE64,
+...}, which the handler decodes when a later call reads it.
+
+This file is bundled into the Lambda zip-file as 'pysfn_encoding.py',
+so must not import anything from the rest of 'pysfn'.
+"""
+
+import array
+import base64
+import json
+import re
+import sys
+import zlib
+
+
+codec_key = 'pysfn_codec'
+
+annotation_kinds = [
+    (re.compile(r'(bytes|bytearray)$'), 'bytes'),
+    (re.compile(r'(array\.)?array$'), 'array'),
+    (re.compile(r'(list|List|Sequence)\[int\]$'), 'int_list'),
+    (re.compile(r'(list|List|Sequence)\[float\]$'), 'float_list'),
+    (re.compile(r'(dict|Dict|Mapping)(\[.*\])?$'), 'dict')]
+
+# Narrowest first.
+int_typecodes = [(tc, 2 ** (8 * array.array(tc).itemsize - 1))
+                 for tc in 'bhilq']
+
+
+def annotation_text(annotation):
+    """
+    Return the given annotation (which may be a string, as with 'from
+    __future__ import annotations') as text, without spaces or any
+    'typing.' prefix.
+    """
+    if isinstance(annotation, str):
+        text = annotation
+    elif hasattr(annotation, '__origin__'):
+        text = repr(annotation)
+    elif annotation.__module__ == 'builtins':
+        text = annotation.__qualname__
+    else:
+        text = '{}.{}'.format(annotation.__module__, annotation.__qualname__)
+    return text.replace(' ', '').replace('typing.', '')
+
+
+def annotation_kind(annotation):
+    text = annotation_text(annotation)
+    for pattern, kind in annotation_kinds:
+        if pattern.match(text):
+            return kind
+    return None
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def packed(kind, data, **fields):
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+        return dict(fields, data=b64(compressed), compression='zlib',
+                    **{codec_key: kind})
+    return dict(fields, data=b64(data), **{codec_key: kind})
+
+
+def little_endian_bytes(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encoded_bytes(value, opaque, threshold):
+    if not isinstance(value, (bytes, bytearray)):
+        return value
+    return packed('bytes', bytes(value))
+
+
+def encoded_array(value, opaque, threshold):
+    if not isinstance(value, array.array):
+        return value
+    return packed('array', little_endian_bytes(value),
+                  typecode=value.typecode)
+
+
+def encoded_int_list(value, opaque, threshold):
+    if not (opaque and type(value) is list and value
+            and all(type(x) is int for x in value)):
+        return value
+    lo, hi = min(value), max(value)
+    for typecode, limit in int_typecodes:
+        if -limit <= lo and hi < limit:
+            return packed('array',
+                          little_endian_bytes(array.array(typecode, value)),
+                          typecode=typecode, type='list')
+    return value  # Too large for any array type.
+
+
+def encoded_float_list(value, opaque, threshold):
+    if not (opaque and type(value) is list and value
+            and all(type(x) is float for x in value)):
+        return value
+    return packed('array', little_endian_bytes(array.array('d', value)),
+                  typecode='d', type='list')
+
+
+def json_compression():
+    try:
+        import zstandard
+        return 'zstd', zstandard.ZstdCompressor().compress
+    except ImportError:
+        import gzip
+        # Without a timestamp, so equal values encode equally (and a blob
+        # store keeps one copy).
+        return 'gzip', lambda data: gzip.compress(data, mtime=0)
+
+
+def encoded_dict(value, opaque, threshold):
+    if not opaque or type(value) is not dict:
+        return value
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(data) <= threshold:
+        return value
+    compression, compress = json_compression()
+    return {codec_key: 'json', 'compression': compression,
+            'data': b64(compress(data))}
+
+
+encoders = {'bytes': encoded_bytes,
+            'array': encoded_array,
+            'int_list': encoded_int_list,
+            'float_list': encoded_float_list,
+            'dict': encoded_dict}
+
+
+def encoder(annotation):
+    """
+    Return the encoder for results of a function with the given return
+    annotation, or None if they are left as they are.  The encoder takes
+    the result, whether the state machine never looks inside it (so it
+    may be made opaque), and the size of JSON above which to compress a
+    dict, and returns what to put in the state.  A result not of the
+    annotated type is returned unchanged.
+    """
+    kind = annotation_kind(annotation)
+    return None if kind is None else encoders[kind]
+
+
+def decompressed(compression, data):
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'gzip':
+        import gzip
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('unknown compression {!r}'.format(compression))
+
+
+def is_encoded(value):
+    return type(value) is dict and codec_key in value
+
+
+def decoded(value):
+    """
+    Return the value which the given encoded value encodes.
+    """
+    data = base64.b64decode(value['data'])
+    if 'compression' in value:
+        data = decompressed(value['compression'], data)
+    kind = value[codec_key]
+    if kind == 'bytes':
+        return data
+    if kind == 'array':
+        values = array.array(value['typecode'])
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tolist() if value.get('type') == 'list' else values
+    if kind == 'json':
+        return json.loads(data)
+    raise ValueError('unknown codec {!r}'.format(kind))
@@ -0,0 +1,201 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import ast
+import attr
+import click
+import glob
+import os
+import os.path
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .compile import (TranslationContext, translation_options, lambda_arns,
+                      output_options, emitter_kwargs, too_large_message,
+                      cache_from_options, finish_cache)
+from .emit import DefinitionTooLargeError, emit_to_file
+
+
+########################################################################
+
+def source_fnames(patterns):
+    """
+    Return the list of files named by the given paths or glob patterns,
+    without duplicates, in the order first mentioned.  A pattern which
+    matches nothing is kept as-is, so that its failure is reported.
+    """
+    fnames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        for fname in (matches or [pattern]):
+            if fname not in fnames:
+                fnames.append(fname)
+    return fnames
+
+
+def output_fname(out_dir, source_fname, fun_name):
+    stem = os.path.splitext(os.path.basename(source_fname))[0]
+    return os.path.join(out_dir, '{}.{}.json'.format(stem, fun_name))
+
+
+@attr.s
+class FileResult:
+    source_fname = attr.ib()
+    output_fnames = attr.ib()
+    elapsed = attr.ib()
+    error = attr.ib(default=None)
+    cache_stats = attr.ib(default=None)
+    n_bytes = attr.ib(default=0)
+
+    def summary_line(self):
+        if self.error is not None:
+            return '{}: FAILED ({:.3f}s): {}'.format(
+                self.source_fname, self.elapsed, self.error)
+        return '{}: {} machine(s), {} bytes ({:.3f}s)'.format(
+            self.source_fname, len(self.output_fnames), self.n_bytes,
+            self.elapsed)
+
+
+def compile_file(xln_ctx, source_fname, out_dir, emit_kwargs=None):
+    """
+    Compile every PSF.main function in the given file, writing each
+    state machine to its own JSON file in 'out_dir', via an emitter
+    made with 'emit_kwargs'.  Errors are caught and recorded in the
+    returned FileResult rather than raised, so that one bad file does
+    not stop the batch.
+    """
+    t0 = time.perf_counter()
+    output_fnames = []
+    n_bytes = 0
+    error = None
+    try:
+        with open(source_fname, 'rt') as f_in:
+            syntax_tree = ast.parse(source=f_in.read(),
+                                    filename=source_fname)
+        main_fundefs = xln_ctx.main_fundefs(syntax_tree)
+        if not main_fundefs:
+            raise ValueError('no PSF.main function')
+        for fun in main_fundefs:
+            state_items, start_at = xln_ctx.state_machine_definition(
+                syntax_tree, fun)
+            out_fname = output_fname(out_dir, source_fname, fun.name)
+            emitter = emit_to_file(out_fname, state_items, start_at,
+                                   **(emit_kwargs or {}))
+            output_fnames.append(out_fname)
+            n_bytes += emitter.n_bytes
+    except DefinitionTooLargeError as e:
+        error = too_large_message(e)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    cache_stats = None if xln_ctx.cache is None else xln_ctx.cache.stats()
+    return FileResult(source_fname, output_fnames,
+                      time.perf_counter() - t0, error, cache_stats, n_bytes)
+
+
+def compile_files(xln_ctx, fnames, out_dir, n_jobs, emit_kwargs=None):
+    """
+    Compile all the given files, in 'n_jobs' worker processes (or in
+    this process if 'n_jobs' is 1), returning a list of FileResult
+    instances in the same order as 'fnames'.
+    """
+    if n_jobs == 1:
+        return [compile_file(xln_ctx, fname, out_dir, emit_kwargs)
+                for fname in fnames]
+    # Each task gets its own unpickled copy of the context, so the cache
+    # statistics in each FileResult are for that file alone.
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(compile_file,
+                                   xln_ctx, fname, out_dir, emit_kwargs)
+                   for fname in fnames]
+        return [f.result() for f in futures]
+
+
+def colliding_stems(fnames):
+    seen = {}
+    for fname in fnames:
+        stem = os.path.splitext(os.path.basename(fname))[0]
+        seen.setdefault(stem, []).append(fname)
+    return {stem: fs for stem, fs in seen.items() if len(fs) > 1}
+
+
+@click.command()
+@click.argument('sources', nargs=-1, required=True)
+@click.option('--lambda-arn', required=True,
+              help='ARN of the Lambda function to dispatch calls to.')
+@click.option('--out-dir', required=True,
+              type=click.Path(file_okay=False),
+              help=('Directory in which to write one'
+                    ' <stem>.<function>.json per machine.'))
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+@translation_options
+@output_options
+def main(sources, lambda_arn, out_dir, jobs,
+         function_arn, compact_calls, auto_parallel, fuse_calls,
+         prune_locals, merge_states, offload_values, cache_dir,
+         cache_max_mb, cache_max_age_days, cache_stats,
+         minify, max_definition_bytes, size_report):
+    fnames = source_fnames(sources)
+    collisions = colliding_stems(fnames)
+    if collisions:
+        raise click.UsageError(
+            'source files with the same name would overwrite each'
+            ' other\'s output: {}'.format(
+                '; '.join(', '.join(fs) for fs in collisions.values())))
+
+    os.makedirs(out_dir, exist_ok=True)
+    cache = cache_from_options(cache_dir, cache_max_mb, cache_max_age_days)
+    xln_ctx = TranslationContext(lambda_arns(lambda_arn, function_arn),
+                                 compact_calls=compact_calls,
+                                 auto_parallel=auto_parallel,
+                                 fuse_calls=fuse_calls,
+                                 prune_locals=prune_locals,
+                                 merge_states=merge_states,
+                                 offload_values=offload_values,
+                                 cache=cache)
+
+    t0 = time.perf_counter()
+    results = compile_files(xln_ctx, fnames, out_dir, jobs,
+                            emitter_kwargs(minify, max_definition_bytes))
+    elapsed = time.perf_counter() - t0
+
+    for result in results:
+        click.echo(result.summary_line(), err=True)
+    n_failed = sum(r.error is not None for r in results)
+    n_machines = sum(len(r.output_fnames) for r in results)
+    click.echo('{} file(s), {} machine(s), {} failure(s) in {:.3f}s'
+               .format(len(results), n_machines, n_failed, elapsed),
+               err=True)
+    if size_report:
+        click.echo('definitions: {} bytes in total'
+                   .format(sum(r.n_bytes for r in results)), err=True)
+
+    if cache is not None and jobs > 1:
+        for result in results:
+            cache.add_stats(result.cache_stats)
+    finish_cache(cache, cache_stats)
+
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Choosing what goes into the Lambda bundle.
+
+The code is 'tree-shaken': of its top-level statements which only bind
+names (definitions, imports, and plain assignments), just those
+binding a name reachable from the functions the state machine calls
+are kept.  Dropped statements are blanked out line by line, so line
+numbers in tracebacks still match the original code.  The modules the
+shaken code imports are then found by following the import graph, and
+those not in the standard library are bundled alongside it.
+
+For quicker cold starts, the bundle's modules can be shipped as
+bytecode alone, so the Lambda runtime does not compile them on import,
+and pure-Python packages can be gathered into one zip-file imported
+from by 'zipimport', saving the runtime many small file lookups.
+"""
+
+import ast
+import importlib.util
+import io
+import marshal
+import modulefinder
+import os
+import os.path
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import zipfile
+
+
+########################################################################
+
+def bound_names(stmt):
+    """
+    Return the set of names bound by the given top-level statement, if
+    it does nothing but bind them, or None if it must always be kept.
+    A statement which neither binds nor does anything (the docstring)
+    binds the empty set.
+    """
+    if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef,
+                         ast.ClassDef)):
+        return {stmt.name}
+    if isinstance(stmt, ast.Import):
+        return {a.asname or a.name.split('.')[0] for a in stmt.names}
+    if isinstance(stmt, ast.ImportFrom):
+        if stmt.module == '__future__' or any(a.name == '*'
+                                               for a in stmt.names):
+            return None
+        return {a.asname or a.name for a in stmt.names}
+    if isinstance(stmt, ast.Assign):
+        if all(isinstance(t, ast.Name) for t in stmt.targets):
+            return {t.id for t in stmt.targets}
+        return None
+    if isinstance(stmt, (ast.AnnAssign, ast.AugAssign)):
+        if isinstance(stmt.target, ast.Name):
+            return {stmt.target.id}
+        return None
+    if (isinstance(stmt, ast.Expr)
+            and isinstance(stmt.value, ast.Constant)):
+        return set()
+    return None
+
+
+def referenced_names(node):
+    """
+    Return the set of all names used anywhere within the given node,
+    which over-approximates the globals it needs.
+    """
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def first_lineno(stmt):
+    return min([stmt.lineno]
+               + [d.lineno for d in getattr(stmt, 'decorator_list', [])])
+
+
+def shaken_source(source, root_names, filename='<code>'):
+    """
+    Return the given module source with the top-level statements not
+    needed by the functions named in 'root_names' blanked out, and the
+    sorted list of the names no longer bound.
+    """
+    stmts = ast.parse(source, filename=filename).body
+    bindings = [bound_names(stmt) for stmt in stmts]
+    kept = [names is None for names in bindings]
+    needed = set(root_names)
+    for stmt, is_kept in zip(stmts, kept):
+        if is_kept:
+            needed |= referenced_names(stmt)
+
+    changed = True
+    while changed:
+        changed = False
+        for i, (stmt, names) in enumerate(zip(stmts, bindings)):
+            if not kept[i] and names & needed:
+                kept[i] = True
+                needed |= referenced_names(stmt)
+                changed = True
+
+    kept_lines = set()
+    dropped_lines = set()
+    for stmt, is_kept in zip(stmts, kept):
+        lines = range(first_lineno(stmt), stmt.end_lineno + 1)
+        (kept_lines if is_kept else dropped_lines).update(lines)
+    blank_lines = dropped_lines - kept_lines
+
+    shaken_lines = [('\n' if i in blank_lines else line)
+                    for i, line in enumerate(source.splitlines(True), 1)]
+
+    kept_names = set().union(*(names for names, is_kept
+                               in zip(bindings, kept)
+                               if is_kept and names is not None))
+    dropped_names = set().union(*(names for names, is_kept
+                                  in zip(bindings, kept)
+                                  if not is_kept))
+    return ''.join(shaken_lines), sorted(dropped_names - kept_names)
+
+
+########################################################################
+
+def is_stdlib_file(fname):
+    fname = os.path.realpath(fname)
+    paths = sysconfig.get_paths()
+
+    def under(key):
+        root = os.path.realpath(paths[key])
+        return os.path.commonpath([root, fname]) == root
+
+    if under('purelib') or under('platlib'):
+        return False
+    return under('stdlib') or under('platstdlib')
+
+
+class ModuleFinder(modulefinder.ModuleFinder):
+    """
+    A ModuleFinder which does not follow the imports of standard-library
+    modules, since they import nothing which would be bundled, and
+    following them all takes seconds.
+    """
+    def load_module(self, fqname, fp, pathname, file_info):
+        if not (pathname and is_stdlib_file(pathname)):
+            return super().load_module(fqname, fp, pathname, file_info)
+        module = self.add_module(fqname)
+        module.__file__ = pathname
+        if file_info[2] == modulefinder._PKG_DIRECTORY:
+            module.__path__ = [pathname]
+        return module
+
+
+def module_arcname(module):
+    """
+    Return the path within the bundle of the file of the given module,
+    as found by a ModuleFinder.
+    """
+    parts = module.__name__.split('.')
+    if not module.__path__:
+        parts = parts[:-1]
+    return '/'.join(parts + [os.path.basename(module.__file__)])
+
+
+def bundled_modules(code_filename, source, excludes=()):
+    """
+    Return a list of (filename, arcname) pairs, sorted by arcname, for
+    the non-standard-library modules imported, directly or indirectly,
+    by the given source of the given code file.  Modules are looked for
+    first in the code's directory, and imports of the modules named in
+    'excludes' (and of their submodules) are not followed.
+    """
+    code_dir = os.path.dirname(os.path.abspath(code_filename))
+    finder = ModuleFinder(path=[code_dir] + sys.path,
+                          excludes=list(excludes))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        script_fname = os.path.join(tmp_dir, os.path.basename(code_filename))
+        with open(script_fname, 'wt') as f_out:
+            f_out.write(source)
+        finder.run_script(script_fname)
+
+    modules = []
+    for name, module in finder.modules.items():
+        if name == '__main__' or module.__file__ is None:
+            continue
+        if name.split('.')[0] in excludes or is_stdlib_file(module.__file__):
+            continue
+        modules.append((module.__file__, module_arcname(module)))
+    return sorted(modules, key=lambda m: m[1])
+
+
+def package_files(name):
+    """
+    Return a list of (filename, arcname) pairs for every file of the
+    given top-level package or module, for packages which need data
+    files or import modules in ways the import graph does not show.
+    """
+    finder = ModuleFinder()
+    try:
+        module = finder.import_hook(name)
+    except ImportError:
+        raise ValueError('cannot find package {!r}'.format(name))
+    if not module.__path__:
+        return [(module.__file__, os.path.basename(module.__file__))]
+    files = []
+    pkg_dir = module.__path__[0]
+    parent_dir = os.path.dirname(pkg_dir)
+    for dirpath, dirnames, filenames in os.walk(pkg_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            arcname = os.path.relpath(path, parent_dir)
+            files.append((path, arcname.replace(os.sep, '/')))
+    return files
+
+
+########################################################################
+
+def top_level_name(arcname):
+    """
+    Return the name of the top-level package or module to which the
+    given member of the bundle belongs.
+    """
+    top = arcname.split('/')[0]
+    return top if '/' in arcname else top.split('.')[0]
+
+
+def pyc_bytes(source, dfile, optimize=0):
+    """
+    Return the content of a .pyc file for the given source, as the
+    running Python would import it without the source alongside.  The
+    header gives no modification time or source size, which importing
+    such a 'sourceless' file does not check, so the result depends
+    only on the source.
+    """
+    code = compile(source, dfile, 'exec', dont_inherit=True,
+                   optimize=optimize)
+    return (importlib.util.MAGIC_NUMBER + bytes(12) + marshal.dumps(code))
+
+
+def bytecode_entries(entries, optimize=0):
+    """
+    Return the given list of (arcname, content) pairs with each Python
+    source replaced by its compiled .pyc, except for any which do not
+    compile (e.g., templates which happen to be named '.py').
+    """
+    compiled = []
+    for arcname, content in entries:
+        if arcname.endswith('.py'):
+            try:
+                content = pyc_bytes(content, arcname, optimize)
+                arcname += 'c'
+            except SyntaxError:
+                pass
+        compiled.append((arcname, content))
+    return compiled
+
+
+def zipimport_split(entries, exclude_tops=()):
+    """
+    Split the given list of (arcname, content) pairs into those to leave
+    in the bundle and those to gather into a zip-file for 'zipimport',
+    which can import only Python source and bytecode.  A top-level
+    package goes into the zip-file only if all its files can, and those
+    named in 'exclude_tops' never do.
+    """
+    tops = {}
+    for arcname, content in entries:
+        tops.setdefault(top_level_name(arcname), []).append(
+            (arcname, content))
+    kept, zipped = [], []
+    for top, top_entries in tops.items():
+        importable = all(a.endswith(('.py', '.pyc')) for a, _ in top_entries)
+        if importable and top not in exclude_tops:
+            zipped.extend(top_entries)
+        else:
+            kept.extend(top_entries)
+    return kept, zipped
+
+
+def zip_bytes(entries):
+    f_out = io.BytesIO()
+    with zipfile.ZipFile(f_out, 'w') as f_zip:
+        for arcname, content in entries:
+            f_zip.writestr(zipfile.ZipInfo(arcname), content)
+    return f_out.getvalue()
+
+
+########################################################################
+
+def import_times(importtime_text):
+    """
+    Return a list of (module, self_us, cumulative_us) triples from the
+    output of Python's '-X importtime' option, ignoring other lines.
+    """
+    times = []
+    for line in importtime_text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except (IndexError, ValueError):
+            continue  # the header
+        times.append((fields[2].strip(), self_us, cumulative_us))
+    return times
+
+
+def profile_imports(bundle_dir, module_name='handler'):
+    """
+    Import the given module of the unpacked bundle in a new Python
+    process, as the Lambda runtime would on a cold start, and return
+    its import times, as from import_times().  Raise RuntimeError if the
+    import fails.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {}'.format(module_name)],
+        cwd=bundle_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return import_times(result.stderr)
+
+
+def import_profile_lines(times, n_slowest):
+    yield 'slowest imports (cumulative, self):'
+    slowest = sorted(times, key=lambda t: -t[2])[:n_slowest]
+    width = max((len(t[0]) for t in slowest), default=0)
+    for module, self_us, cumulative_us in slowest:
+        yield '  {:{}}  {:10.3f} ms  {:10.3f} ms'.format(
+            module, width, cumulative_us / 1000, self_us / 1000)
+
+
+########################################################################
+
+def package_sizes(zip_infos):
+    """
+    Return a list of (package, n_bytes, n_compressed_bytes) triples,
+    largest first, from the members of a zip-file, grouped by their
+    top-level package or module.
+    """
+    sizes = {}
+    for zi in zip_infos:
+        top = top_level_name(zi.filename)
+        n_bytes, n_compressed = sizes.get(top, (0, 0))
+        sizes[top] = (n_bytes + zi.file_size,
+                      n_compressed + zi.compress_size)
+    return sorted(((top, n, n_z) for top, (n, n_z) in sizes.items()),
+                  key=lambda s: (-s[1], s[0]))
+
+
+def size_report_lines(zip_infos):
+    sizes = package_sizes(zip_infos)
+    yield 'bundle: {} files, {} bytes ({} compressed)'.format(
+        len(zip_infos), sum(s[1] for s in sizes), sum(s[2] for s in sizes))
+    width = max(len(s[0]) for s in sizes)
+    for top, n_bytes, n_compressed in sizes:
+        yield '  {:{}}  {:10d} bytes ({} compressed)'.format(
+            top, width, n_bytes, n_compressed)
@@ -0,0 +1,188 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import attr
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+
+########################################################################
+
+def cache_key(*parts):
+    """
+    Return a hex digest identifying the given JSON-friendly parts.
+    """
+    text = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def compiler_version():
+    """
+    Return a digest of the source of the whole 'pysfn' package, so that
+    any change to the compiler, or to what it depends on (e.g., the
+    merging of states, or the PSF functions it recognises), invalidates
+    everything it has cached.  The source is read once per process.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for dirpath, dirnames, fnames in os.walk(package_dir):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            if fname.endswith('.py'):
+                path = os.path.join(dirpath, fname)
+                digest.update(os.path.relpath(path, package_dir).encode())
+                with open(path, 'rb') as f_in:
+                    digest.update(f_in.read())
+    return digest.hexdigest()
+
+
+########################################################################
+
+@attr.s
+class CompilationCache:
+    """
+    On-disk store of JSON-friendly objects, one file per entry, under
+    'directory'.  Entries are grouped by 'kind' (e.g., 'machine' or
+    'suite') for the purposes of the hit/miss statistics.  A hit
+    refreshes the entry's modification time, so that evict() discards
+    the least recently used entries first.
+    """
+    directory = attr.ib()
+    max_bytes = attr.ib(default=None)
+    max_age_seconds = attr.ib(default=None)
+    hits = attr.ib(factory=Counter)
+    misses = attr.ib(factory=Counter)
+    n_stored = attr.ib(default=0)
+    n_evicted = attr.ib(default=0)
+    lock = attr.ib(factory=threading.Lock, repr=False, eq=False)
+
+    def __getstate__(self):
+        # Locks cannot be pickled; the copy in a worker process gets a
+        # fresh one.
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def entry_path(self, kind, key):
+        return os.path.join(self.directory, kind, key[:2], key + '.json')
+
+    def get(self, kind, key):
+        path = self.entry_path(kind, key)
+        try:
+            with open(path, 'rt') as f_in:
+                obj = json.load(f_in)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses[kind] += 1
+            return None
+        with self.lock:
+            self.hits[kind] += 1
+        return obj
+
+    def put(self, kind, key, obj):
+        path = self.entry_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial
+        # entry.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'wt') as f_out:
+            json.dump(obj, f_out, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.n_stored += 1
+
+    def entries(self):
+        """
+        Return a list of (path, size, mtime) for all entries.
+        """
+        entries = []
+        for dirpath, _, fnames in os.walk(self.directory):
+            for fname in fnames:
+                if fname.endswith('.json'):
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self, now=None):
+        """
+        Discard entries not used within 'max_age_seconds', and then
+        the least recently used entries until the total size is within
+        'max_bytes'.
+        """
+        now = time.time() if now is None else now
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        if self.max_age_seconds is not None:
+            expired = [e for e in entries
+                       if now - e[2] > self.max_age_seconds]
+            entries = entries[len(expired):]
+            self.remove_entries(expired)
+        if self.max_bytes is not None:
+            total = sum(size for _, size, _ in entries)
+            n_excess = 0
+            while total > self.max_bytes and n_excess < len(entries):
+                total -= entries[n_excess][1]
+                n_excess += 1
+            self.remove_entries(entries[:n_excess])
+
+    def remove_entries(self, entries):
+        for path, _, _ in entries:
+            try:
+                os.remove(path)
+                self.n_evicted += 1
+            except OSError:
+                pass
+
+    def add_stats(self, stats):
+        """
+        Accumulate the (hits, misses, n_stored) from another instance
+        using the same directory, e.g., in a worker process.
+        """
+        hits, misses, n_stored = stats
+        with self.lock:
+            self.hits.update(hits)
+            self.misses.update(misses)
+            self.n_stored += n_stored
+
+    def stats(self):
+        return (dict(self.hits), dict(self.misses), self.n_stored)
+
+    def summary_lines(self):
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            yield ('cache {}: {} hits, {} misses'
+                   .format(kind, self.hits[kind], self.misses[kind]))
+        yield ('cache: {} stored, {} evicted'
+               .format(self.n_stored, self.n_evicted))
@@ -19,10 +19,17 @@
 
 import ast
 import attr
-from functools import reduce
-from operator import concat
 import click
 import json
+import os
+import glob
+import sys
+from functools import lru_cache
+from .. import definition as PSF
+from .cache import CompilationCache, cache_key, compiler_version
+from .merge import merged_definition
+from .emit import (DefinitionTooLargeError, DEFINITION_SIZE_LIMIT,
+                   emit_to_file, emit_to_stream)
 
 
 ########################################################################
@@ -62,23 +69,51 @@ def chained_key(nd):
     if isinstance(nd, ast.Name):
         return [nd.id]
     if isinstance(nd, ast.Subscript):
-        if isinstance(nd.slice, ast.Index):
-            if isinstance(nd.slice.value, ast.Str):
-                suffix = nd.slice.value.s
-                if isinstance(nd.value, ast.Name):
-                    prefix = [nd.value.id]
-                else:
-                    prefix = chained_key(nd.value)
-                return prefix + [suffix]
+        key = nd.slice
+        if isinstance(key, ast.Index):
+            # Python before 3.9 wraps a simple subscript in an Index.
+            key = key.value
+        if isinstance(key, ast.Str):
+            suffix = key.s
+            if isinstance(nd.value, ast.Name):
+                prefix = [nd.value.id]
+            else:
+                prefix = chained_key(nd.value)
+            return prefix + [suffix]
     raise ValueError('expected chained lookup via strings on name')
 
 
+# Python before 3.8 parses literals as ast.Num and ast.Str nodes, rather
+# than as ast.Constant.
+legacy_literal_fields = (((ast.Num, 'n'), (ast.Str, 's'))
+                         if sys.version_info < (3, 8) else ())
+
+
+def literal_value(nd):
+    """
+    Return the value of the given AST node if it is a literal number or
+    string, and otherwise None.
+    """
+    if isinstance(nd, ast.Constant):
+        return nd.value
+    for node_type, field in legacy_literal_fields:
+        if isinstance(nd, node_type):
+            return getattr(nd, field)
+    return None
+
+
 def chained_key_smr(k):
     """
     Convert a sequence of chained lookups into the jsonPath which will
-    refer to its location in the 'locals' object.
+    refer to its location in the 'locals' object.  The same path is
+    returned as the same (interned) string every time.
     """
-    return '.'.join(['$', 'locals'] + k)
+    return locals_path(tuple(k))
+
+
+@lru_cache(maxsize=1024)
+def locals_path(k):
+    return sys.intern('.'.join(('$', 'locals') + k))
 
 
 def lmap(f, xs):
@@ -102,6 +137,8 @@ def maybe_with_next(base_fields, next_state_name):
 ########################################################################
 
 class ChoiceConditionIR:
+    __slots__ = ()
+
     @staticmethod
     def from_ast_node(nd):
         if isinstance(nd, ast.Call):
@@ -111,7 +148,7 @@ class ChoiceConditionIR:
         raise ValueError('expected Call')
 
 
-@attr.s
+@attr.s(slots=True)
 class TestComparisonIR(ChoiceConditionIR):
     predicate_name = attr.ib()
     predicate_variable = attr.ib()
@@ -131,8 +168,43 @@ class TestComparisonIR(ChoiceConditionIR):
              self.predicate_name: self.predicate_literal},
             next_state_name)
 
-
-@attr.s
+    def evaluate(self, locals_obj):
+        """
+        Evaluate the test against a JSON-friendly 'locals' object, as
+        recorded in a state's input.  A missing variable makes the
+        test false.
+        """
+        value = locals_obj
+        for k in self.predicate_variable:
+            if not isinstance(value, dict) or k not in value:
+                return False
+            value = value[k]
+        if self.predicate_name == 'StringEquals':
+            return isinstance(value, str) and value == self.predicate_literal
+        raise ValueError('cannot evaluate predicate {}'
+                         .format(self.predicate_name))
+
+    def n_evaluations(self, locals_obj):
+        return 1
+
+    def used_vars(self):
+        return {self.predicate_variable[0]}
+
+    def reordered(self, locals_objs):
+        return self
+
+    def string_equals_options(self):
+        """
+        Return a pair (variable, literals) such that this test is true
+        exactly when the variable equals one of the literals, or None
+        if the test is not of that form.
+        """
+        if self.predicate_name != 'StringEquals':
+            return None
+        return (tuple(self.predicate_variable), {self.predicate_literal})
+
+
+@attr.s(slots=True)
 class TestCombinatorIR(ChoiceConditionIR):
     opname = attr.ib()
     values = attr.ib()
@@ -155,10 +227,54 @@ class TestCombinatorIR(ChoiceConditionIR):
             {self.opname: terms},
             next_state_name)
 
+    @property
+    def deciding_value(self):
+        # The term value which settles the result without looking at
+        # any further terms.
+        return self.opname == 'Or'
+
+    def evaluate(self, locals_obj):
+        for v in self.values:
+            if v.evaluate(locals_obj) == self.deciding_value:
+                return self.deciding_value
+        return not self.deciding_value
+
+    def used_vars(self):
+        return set.union(*[v.used_vars() for v in self.values])
+
+    def n_evaluations(self, locals_obj):
+        n = 0
+        for v in self.values:
+            n += v.n_evaluations(locals_obj)
+            if v.evaluate(locals_obj) == self.deciding_value:
+                break
+        return n
+
+    def reordered(self, locals_objs):
+        """
+        Return an equivalent combinator whose terms (recursively) are
+        ordered so that, over the given 'locals' objects, the terms
+        which most often settle the result come first.
+        """
+        def n_deciding(v):
+            return sum(v.evaluate(x) == self.deciding_value
+                       for x in locals_objs)
+        values = [v.reordered(locals_objs) for v in self.values]
+        return TestCombinatorIR(self.opname,
+                                sorted(values, key=n_deciding, reverse=True))
+
+    def string_equals_options(self):
+        if self.opname != 'Or':
+            return None
+        options = [v.string_equals_options() for v in self.values]
+        if None in options or len({var for var, _ in options}) != 1:
+            return None
+        return (options[0][0], set.union(*[lits for _, lits in options]))
+
 
 ########################################################################
 
-@attr.s
+@attr.s(slots=True)
 class RetrySpecIR:
     error_equals = attr.ib()
     interval_seconds = attr.ib()
@@ -179,7 +295,7 @@ class RetrySpecIR:
                 'BackoffRate': self.backoff_rate}
 
 
-@attr.s
+@attr.s(slots=True)
 class CatcherIR:
     error_equals = attr.ib()
     body = attr.ib()
@@ -191,8 +307,56 @@ class CatcherIR:
 
 ########################################################################
 
-@attr.s
-class ReturnIR:
+class StatementIR:
+    __slots__ = ()
+
+    @classmethod
+    def from_ast_node(self, nd, defs):
+        if isinstance(nd, ast.Assign):
+            return AssignmentIR.from_ast_node(nd, defs)
+        if isinstance(nd, ast.Try):
+            return TryIR.from_ast_node(nd)
+        if isinstance(nd, ast.If):
+            return IfIR.from_ast_node(nd)
+        if isinstance(nd, ast.Return):
+            return ReturnIR.from_ast_node(nd)
+        if isinstance(nd, ast.Raise):
+            return RaiseIR.from_ast_node(nd)
+        if isinstance(nd, (ast.For, ast.While)):
+            raise ValueError('loops are not supported; for a call on each'
+                             ' item of a list, use'
+                             ' ys = PSF.map(f, xs, max_concurrency=n)')
+        raise ValueError('unexpected node type {} for statement'
+                         .format(type(nd)))
+
+    # Data-flow, for liveness analysis.  Subclasses provide
+    #
+    #     live_in(live_out) --- the set of variables live before the
+    #         statement, given the set live after it;
+    #
+    #     assigned_vars() --- the set of variables certainly assigned
+    #         by the statement, or None if control never passes on
+    #         from it (e.g., 'return').
+
+    def with_pruned_suites(self, live_out, present):
+        """
+        Return this statement with any suites within it pruned by
+        pruned_suite(), given the variables live after the statement
+        and those certainly present before it.
+        """
+        return self
+
+    def with_kept_locals(self, keep):
+        """
+        Return an equivalent statement which also prunes the 'locals'
+        down to just the variables in 'keep', or None if this
+        statement cannot do so without an extra state.
+        """
+        return None
+
+
+@attr.s(slots=True)
+class ReturnIR(StatementIR):
     varname = attr.ib()
 
     @classmethod
@@ -202,14 +366,21 @@ class ReturnIR:
         raise ValueError('expected return of variable')
 
     def as_fragment(self, xln_ctx):
-        s = StateMachineStateIR.from_fields(
-            Type='Succeed',
-            InputPath=chained_key_smr([self.varname]))
+        s = StateMachineStateIR.from_shared_fields(
+            xln_ctx, ('return', self.varname),
+            lambda: {'Type': 'Succeed',
+                     'InputPath': chained_key_smr([self.varname])})
         return StateMachineFragmentIR([s], s, [])
 
+    def live_in(self, live_out):
+        return {self.varname}
 
-@attr.s
-class RaiseIR:
+    def assigned_vars(self):
+        return None
+
+
+@attr.s(slots=True)
+class RaiseIR(StatementIR):
     error = attr.ib()
     cause = attr.ib()
 
@@ -225,13 +396,26 @@ class RaiseIR:
 
     def as_fragment(self, xln_ctx):
         s = StateMachineStateIR.from_fields(
+            xln_ctx,
             Type='Fail', Error=self.error, Cause=self.cause)
         return StateMachineFragmentIR([s], s, [])
 
+    def live_in(self, live_out):
+        return set()
+
+    def assigned_vars(self):
+        return None
+
 
 class AssignmentSourceIR:
+    __slots__ = ()
+
     @classmethod
     def from_ast_node(cls, nd, defs):
+        if isinstance(nd, ast.Await) and isinstance(nd.value, ast.Call):
+            # Within a coroutine branch of PSF.parallel(); the dispatcher
+            # runs a coroutine function's result to completion.
+            return FunctionCallIR.from_ast_node(nd.value)
         if isinstance(nd, ast.Call):
             if (isinstance(nd.func, ast.Name)
                     or (isinstance(nd.func, ast.Attribute)
@@ -240,15 +424,22 @@ class AssignmentSourceIR:
             if (isinstance(nd.func, ast.Attribute)
                     and psf_attr(nd.func) == 'parallel'):
                 return ParallelIR.from_ast_node_and_defs(nd, defs)
+            if (isinstance(nd.func, ast.Attribute)
+                    and psf_attr(nd.func) == 'map'):
+                return MapIR.from_ast_node(nd)
         raise ValueError('expected fn(x, y)'
-                         ' or PSF.with_retry_spec(fn, (x, y), s1, s2)')
+                         ' or PSF.with_retry_spec(fn, (x, y), s1, s2)'
+                         ' or PSF.map(fn, xs)')
 
 
-@attr.s
+@attr.s(slots=True)
 class FunctionCallIR(AssignmentSourceIR):
     fun_name = attr.ib()
     arg_names = attr.ib()
     retry_spec = attr.ib()
+    # Whether the dispatcher may put a large result in a blob store,
+    # leaving a reference in the state; see offloading_suite().
+    offload = attr.ib(default=False)
 
     @classmethod
     def from_ast_node(cls, nd):
@@ -265,26 +456,76 @@ class FunctionCallIR(AssignmentSourceIR):
                          ' retry_spec_1, retry_spec_2)')
 
     def call_descriptor(self):
-        return {"function": self.fun_name, "arg_names": self.arg_names}
+        descr = {"function": self.fun_name, "arg_names": self.arg_names}
+        if self.offload:
+            descr['offload'] = True
+        return descr
+
+    def compact_parameters(self):
+        """
+        Return the 'Parameters' for a Task which passes the call
+        descriptor and just the named arguments to the Lambda function.
+        The 'locals' sub-object holds only those arguments, so the
+        dispatcher can look them up exactly as it would in the full
+        state.
+        """
+        return {'call_descr': self.call_descriptor(),
+                'locals': {f'{a}.$': chained_key_smr([a])
+                           for a in self.arg_names}}
 
     def as_fragment(self, xln_ctx, target_varname):
-        s_pass = StateMachineStateIR.from_fields(Type='Pass',
-                                                 Result=self.call_descriptor(),
-                                                 ResultPath='$.call_descr')
+        if xln_ctx.compact_calls:
+            return self.as_compact_fragment(xln_ctx, target_varname)
 
-        task_fields = {'Type': 'Task',
-                       'Resource': xln_ctx.lambda_arn,
-                       'ResultPath': chained_key_smr([target_varname])}
-        if self.retry_spec is not None:
-            task_fields['Retry'] = [s.as_json_obj() for s in self.retry_spec]
-        s_task = StateMachineStateIR.from_fields(**task_fields)
+        s_pass = StateMachineStateIR.from_shared_fields(
+            xln_ctx, ('call-pass', self.fun_name, tuple(self.arg_names),
+                      self.offload),
+            lambda: {'Type': 'Pass',
+                     'Result': self.call_descriptor(),
+                     'ResultPath': '$.call_descr'})
+
+        s_task = self.task_state(xln_ctx, target_varname)
 
         s_pass.next_state_name = s_task.name
 
         return StateMachineFragmentIR([s_pass, s_task], s_pass, [s_task])
 
+    def as_compact_fragment(self, xln_ctx, target_varname):
+        # A single Task, with the call descriptor and argument values
+        # injected via 'Parameters' rather than a preceding Pass state.
+        s_task = self.task_state(xln_ctx, target_varname, compact=True)
+        return StateMachineFragmentIR([s_task], s_task, [s_task])
 
-@attr.s
+    def used_vars(self):
+        return set(self.arg_names)
+
+    def task_state(self, xln_ctx, target_varname, compact=False):
+        def make_fields():
+            fields = self.task_fields(xln_ctx, target_varname)
+            if compact:
+                fields['Parameters'] = self.compact_parameters()
+            return fields
+
+        if self.retry_spec is not None:
+            # Retry-specs are not hashable, and are rare enough not to
+            # be worth sharing.
+            return StateMachineStateIR.from_fields(xln_ctx, **make_fields())
+        key = ('task', target_varname, xln_ctx.function_arn(self.fun_name))
+        if compact:
+            key += (self.fun_name, tuple(self.arg_names), self.offload)
+        return StateMachineStateIR.from_shared_fields(xln_ctx, key,
+                                                      make_fields)
+
+    def task_fields(self, xln_ctx, target_varname):
+        fields = {'Type': 'Task',
+                  'Resource': xln_ctx.function_arn(self.fun_name),
+                  'ResultPath': chained_key_smr([target_varname])}
+        if self.retry_spec is not None:
+            fields['Retry'] = [s.as_json_obj() for s in self.retry_spec]
+        return fields
+
+
+@attr.s(slots=True)
 class ParallelIR:
     branches = attr.ib()
 
@@ -299,31 +540,135 @@ class ParallelIR:
         # This is in contrast to 'If' or 'Try' where the bodies
         # contribute their states to the top-level state machine.
         s_parallel = StateMachineStateIR.from_fields(
+            xln_ctx,
             Type='Parallel',
             Branches=[branch.as_fragment(xln_ctx).as_json_obj()
                       for branch in self.branches],
             ResultPath=chained_key_smr([target_varname]))
         return StateMachineFragmentIR([s_parallel], s_parallel, [s_parallel])
 
+    def used_vars(self):
+        return set.union(*[b.live_in(set()) for b in self.branches])
+
+
+@attr.s(slots=True)
+class ItemSourceIR:
+    """
+    An object in S3 whose items (lines of JSONL, rows of CSV with a
+    header, or elements of a JSON array) a 'Map' state reads itself,
+    rather than taking them from the state.  Built from a call of
+    PSF.items_from().
+    """
+    bucket = attr.ib()
+    key = attr.ib()
+    input_type = attr.ib()
 
-class StatementIR:
     @classmethod
-    def from_ast_node(self, nd, defs):
-        if isinstance(nd, ast.Assign):
-            return AssignmentIR.from_ast_node(nd, defs)
-        if isinstance(nd, ast.Try):
-            return TryIR.from_ast_node(nd)
-        if isinstance(nd, ast.If):
-            return IfIR.from_ast_node(nd)
-        if isinstance(nd, ast.Return):
-            return ReturnIR.from_ast_node(nd)
-        if isinstance(nd, ast.Raise):
-            return RaiseIR.from_ast_node(nd)
-        raise ValueError('unexpected node type {} for statement'
-                         .format(type(nd)))
+    def from_ast_node(cls, nd):
+        keywords = {kw.arg: literal_value(kw.value) for kw in nd.keywords}
+        args = [literal_value(a) for a in nd.args]
+        if (psf_attr(nd.func, raise_if_not=False) == 'items_from'
+                and len(args) == 1
+                and set(keywords) <= {'input_type'}
+                and all(isinstance(a, str)
+                        for a in args + list(keywords.values()))):
+            bucket, key = PSF.s3_location(args[0])
+            return cls(bucket, key, PSF.item_input_type(
+                key, keywords.get('input_type')))
+        raise ValueError('expected PSF.items_from("s3://bucket/key")'
+                         ' or PSF.items_from("s3://bucket/key",'
+                         ' input_type="JSONL")')
+
+    def item_reader(self):
+        reader_config = {'InputType': self.input_type}
+        if self.input_type == 'CSV':
+            reader_config['CSVHeaderLocation'] = 'FIRST_ROW'
+        return {'Resource': 'arn:aws:states:::s3:getObject',
+                'ReaderConfig': reader_config,
+                'Parameters': {'Bucket': self.bucket, 'Key': self.key}}
+
+
+@attr.s(slots=True)
+class MapIR(AssignmentSourceIR):
+    """
+    A call of one function on each item of a list, made by a 'Map'
+    state running up to 'max_concurrency' calls at once (with zero
+    meaning no limit).  The items come either from a local variable
+    or, for a distributed 'Map', from an 'item_source'.
+    """
+    fun_name = attr.ib()
+    items_varname = attr.ib()
+    max_concurrency = attr.ib(default=0)
+    item_source = attr.ib(default=None)
+    offload = attr.ib(default=False)
 
+    # Name under which each call sees its item in 'locals'.
+    item_varname = 'item'
 
-@attr.s
+    @classmethod
+    def from_ast_node(cls, nd):
+        keywords = {kw.arg: kw.value for kw in nd.keywords}
+        if (len(nd.args) == 2
+                and isinstance(nd.args[0], ast.Name)
+                and set(keywords) <= {'max_concurrency'}):
+            max_concurrency = (literal_value(keywords['max_concurrency'])
+                               if 'max_concurrency' in keywords else 0)
+            if type(max_concurrency) is int and max_concurrency >= 0:
+                items = nd.args[1]
+                if isinstance(items, ast.Name):
+                    return cls(nd.args[0].id, items.id, max_concurrency)
+                if isinstance(items, ast.Call):
+                    return cls(nd.args[0].id, None, max_concurrency,
+                               ItemSourceIR.from_ast_node(items))
+        raise ValueError('expected PSF.map(fun, items)'
+                         ' or PSF.map(fun, items, max_concurrency=n),'
+                         ' where items is a variable or'
+                         ' PSF.items_from("s3://bucket/key")')
+
+    def call_descriptor(self):
+        descr = {'function': self.fun_name,
+                 'arg_names': [self.item_varname]}
+        if self.offload:
+            descr['offload'] = True
+        return descr
+
+    def as_fragment(self, xln_ctx, target_varname):
+        # Each iteration is one Task, given the call descriptor and its
+        # item as a one-variable 'locals', so the dispatcher handles it
+        # like any other call.
+        s_call = StateMachineStateIR.from_fields(
+            xln_ctx,
+            Type='Task', Resource=xln_ctx.function_arn(self.fun_name),
+            End=True)
+        processor = StateMachineFragmentIR([s_call], s_call, [s_call])
+        if self.item_source is None:
+            fields = {'Type': 'Map',
+                      'ItemsPath': chained_key_smr([self.items_varname])}
+            processor_config = {'Mode': 'INLINE'}
+        else:
+            fields = {'Type': 'Map',
+                      'ItemReader': self.item_source.item_reader()}
+            processor_config = {'Mode': 'DISTRIBUTED',
+                                'ExecutionType': 'STANDARD'}
+        if self.max_concurrency:
+            fields['MaxConcurrency'] = self.max_concurrency
+        fields.update(
+            ItemSelector={
+                'call_descr': self.call_descriptor(),
+                'locals': {f'{self.item_varname}.$': '$$.Map.Item.Value'}},
+            ItemProcessor=dict(processor.as_json_obj(),
+                               ProcessorConfig=processor_config),
+            ResultPath=chained_key_smr([target_varname]))
+        s_map = StateMachineStateIR.from_fields(xln_ctx, **fields)
+        return StateMachineFragmentIR([s_map], s_map, [s_map])
+
+    def used_vars(self):
+        if self.item_source is not None:
+            return set()
+        return {self.items_varname}
+
+
+@attr.s(slots=True)
 class AssignmentIR(StatementIR):
     target_varname = attr.ib()
     source = attr.ib()
@@ -338,8 +683,21 @@ class AssignmentIR(StatementIR):
     def as_fragment(self, xln_ctx):
         return self.source.as_fragment(xln_ctx, self.target_varname)
 
+    def live_in(self, live_out):
+        return (live_out - {self.target_varname}) | self.source.used_vars()
 
-@attr.s
+    def assigned_vars(self):
+        return {self.target_varname}
+
+    def with_pruned_suites(self, live_out, present):
+        if isinstance(self.source, ParallelIR):
+            return attr.evolve(self, source=ParallelIR(
+                [pruned_suite(b, set(), present)
+                 for b in self.source.branches]))
+        return self
+
+
+@attr.s(slots=True)
 class TryIR(StatementIR):
     body = attr.ib()
     catchers = attr.ib()
@@ -353,25 +711,36 @@ class TryIR(StatementIR):
     def as_fragment(self, xln_ctx):
         body = self.body.as_fragment(xln_ctx)
         catcher_fragments = [c.body.as_fragment(xln_ctx) for c in self.catchers]
-        s_task = body.all_states[1]
+        s_task = body.exit_states[0]
         assert s_task.fields['Type'] == 'Task'
-        s_task.fields['Catch'] = [
+        s_task.fields = dict(s_task.fields, Catch=[
             {'ErrorEquals': c.error_equals, 'Next': f.enter_state.name}
-            for (c, f) in zip(self.catchers, catcher_fragments)]
-
-        all_catcher_states = reduce(
-            concat, [f.all_states for f in catcher_fragments], [])
-
-        all_catcher_exits = reduce(
-            concat, [f.exit_states for f in catcher_fragments], [])
+            for (c, f) in zip(self.catchers, catcher_fragments)])
 
         return StateMachineFragmentIR(
-            body.all_states + all_catcher_states,
+            [body] + catcher_fragments,
             body.enter_state,
-            body.exit_states + all_catcher_exits)
+            [body] + catcher_fragments)
 
+    def live_in(self, live_out):
+        return set.union(self.body.live_in(live_out),
+                         *[c.body.live_in(live_out) for c in self.catchers])
 
-@attr.s
+    def assigned_vars(self):
+        return vars_assigned_by_all([self.body]
+                                    + [c.body for c in self.catchers])
+
+    def with_pruned_suites(self, live_out, present):
+        # The body is left alone: it must remain a single Task.
+        return attr.evolve(
+            self,
+            catchers=[attr.evolve(c, body=pruned_suite(c.body,
+                                                       live_out,
+                                                       present))
+                      for c in self.catchers])
+
+
+@attr.s(slots=True)
 class IfIR(StatementIR):
     test = attr.ib()
     true_body = attr.ib()
@@ -379,30 +748,100 @@ class IfIR(StatementIR):
 
     @classmethod
     def from_ast_node(cls, nd):
-        return cls(ChoiceConditionIR.from_ast_node(nd.test),
-                   SuiteIR.from_ast_nodes(nd.body),
-                   SuiteIR.from_ast_nodes(nd.orelse))
+        # Follow an if/elif chain along, rather than recursing down it,
+        # so that long chains do not exhaust the stack.
+        chain = [nd]
+        while (len(chain[-1].orelse) == 1
+               and isinstance(chain[-1].orelse[0], ast.If)):
+            chain.append(chain[-1].orelse[0])
+        return cls.from_arms(
+            [(ChoiceConditionIR.from_ast_node(link.test),
+              SuiteIR.from_ast_nodes(link.body))
+             for link in chain],
+            SuiteIR.from_ast_nodes(chain[-1].orelse))
+
+    @classmethod
+    def from_arms(cls, arms, default_body):
+        """
+        Build the if/elif chain having the given arms and default
+        body; the inverse of choice_arms().
+        """
+        false_body = default_body
+        for test, body in reversed(arms):
+            ir = cls(test, body, false_body)
+            false_body = SuiteIR([ir])
+        return ir
+
+    def choice_arms(self):
+        """
+        Return a pair (arms, default_body), where 'arms' is a list of
+        (test, body) pairs, one for this 'if' and one for each 'elif'
+        chained onto it via a false-body consisting of just another
+        'if' statement.  The 'default_body' is the final 'else' suite.
+        """
+        arms = [(self.test, self.true_body)]
+        false_body = self.false_body
+        while (len(false_body.body) == 1
+               and isinstance(false_body.body[0], IfIR)):
+            elif_ir = false_body.body[0]
+            arms.append((elif_ir.test, elif_ir.true_body))
+            false_body = elif_ir.false_body
+        return arms, false_body
 
     def as_fragment(self, xln_ctx):
-        true_frag = self.true_body.as_fragment(xln_ctx)
-        false_frag = self.false_body.as_fragment(xln_ctx)
+        # An if/elif/.../else chain becomes a single Choice state, with
+        # one choice rule per test, rather than a chain of Choices.
+        arms, default_body = self.choice_arms()
+        arm_frags = [body.as_fragment(xln_ctx) for _, body in arms]
+        default_frag = default_body.as_fragment(xln_ctx)
 
-        choice_rule = self.test.as_choice_rule_smr(true_frag.enter_state.name)
         choice_state = StateMachineStateIR.from_fields(
+            xln_ctx,
             Type='Choice',
-            Choices=[choice_rule],
-            Default=false_frag.enter_state.name)
-
-        all_states = ([choice_state]
-                      + true_frag.all_states
-                      + false_frag.all_states)
-
-        exit_states = true_frag.exit_states + false_frag.exit_states
-
-        return StateMachineFragmentIR(all_states, choice_state, exit_states)
-
-
-@attr.s
+            Choices=None,
+            Default=default_frag.enter_state.name)
+
+        # The rules can only be ordered once we know the state's name,
+        # because that is how recorded executions identify it.
+        tests_and_frags = [(test, frag)
+                           for (test, _), frag in zip(arms, arm_frags)]
+        if xln_ctx.branch_profile is not None:
+            tests_and_frags = xln_ctx.branch_profile.ordered_arms(
+                choice_state.name, tests_and_frags)
+
+        choice_state.fields = dict(choice_state.fields, Choices=[
+            test.as_choice_rule_smr(frag.enter_state.name)
+            for test, frag in tests_and_frags])
+
+        branch_frags = arm_frags + [default_frag]
+
+        return StateMachineFragmentIR([choice_state] + branch_frags,
+                                      choice_state,
+                                      branch_frags)
+
+    def live_in(self, live_out):
+        arms, default_body = self.choice_arms()
+        return set.union(default_body.live_in(live_out),
+                         *[test.used_vars() | body.live_in(live_out)
+                           for test, body in arms])
+
+    def assigned_vars(self):
+        arms, default_body = self.choice_arms()
+        return vars_assigned_by_all([body for _, body in arms]
+                                    + [default_body])
+
+    def with_pruned_suites(self, live_out, present):
+        # Rebuild the if/elif chain from its arms so that no pruning
+        # is inserted between an 'else' and its 'if', which would stop
+        # the chain being merged into one Choice state.
+        arms, default_body = self.choice_arms()
+        return IfIR.from_arms(
+            [(test, pruned_suite(body, live_out, present))
+             for test, body in arms],
+            pruned_suite(default_body, live_out, present))
+
+
+@attr.s(slots=True)
 class SuiteIR:
     body = attr.ib()
 
@@ -411,27 +850,724 @@ class SuiteIR:
         body = []
         defs = {}
         for nd in nds:
-            if isinstance(nd, ast.FunctionDef):
+            if isinstance(nd, (ast.FunctionDef, ast.AsyncFunctionDef)):
                 defs[nd.name] = SuiteIR.from_ast_nodes(nd.body)
             else:
                 body.append(StatementIR.from_ast_node(nd, defs))
         return cls(body)
 
     def as_fragment(self, xln_ctx):
+        # Cached fragments would not carry the reports of, or have
+        # their names consistent with, a branch profile.  Small suites
+        # are quicker to translate than to look up.
+        if (xln_ctx.cache is not None and xln_ctx.branch_profile is None
+                and n_statements(self) >= min_cached_suite_statements):
+            return xln_ctx.cached_suite_fragment(self)
+        return self.translated_fragment(xln_ctx)
+
+    def translated_fragment(self, xln_ctx):
         fragments = [stmt.as_fragment(xln_ctx) for stmt in self.body]
         for f0, f1 in zip(fragments[:-1], fragments[1:]):
             f0.set_next_state(f1.enter_state.name)
         return StateMachineFragmentIR(
-            reduce(concat, [f.all_states for f in fragments], []),
+            fragments,
             fragments[0].enter_state,
-            fragments[-1].exit_states)
+            [fragments[-1]])
+
+    def live_in(self, live_out):
+        live = live_out
+        for stmt in reversed(self.body):
+            live = stmt.live_in(live)
+        return live
+
+    def assigned_vars(self):
+        assigned = set()
+        for stmt in self.body:
+            stmt_assigned = stmt.assigned_vars()
+            if stmt_assigned is None:
+                return None
+            assigned |= stmt_assigned
+        return assigned
+
+
+@attr.s(slots=True)
+class AutoParallelIR(StatementIR):
+    """
+    Independent call-assignments gathered, by the compiler rather than
+    the programmer, into one Parallel state.
+    """
+    assignments = attr.ib()
+    keep_locals = attr.ib(default=None)
+
+    def as_fragment(self, xln_ctx):
+        branches = []
+        for a in self.assignments:
+            branch = a.as_fragment(xln_ctx)
+            for s in branch.exit_states:
+                s.fields = dict(s.fields, End=True)
+            branches.append(branch.as_json_obj())
+
+        # Each branch's output is its whole state; pick out the one
+        # new local from each, then merge them all into '$.locals'.
+        s_parallel = StateMachineStateIR.from_fields(
+            xln_ctx,
+            Type='Parallel',
+            Branches=branches,
+            ResultSelector={
+                f'{a.target_varname}.$':
+                    f'$[{i}].locals.{a.target_varname}'
+                for i, a in enumerate(self.assignments)},
+            ResultPath='$.parallel_result')
+        s_merge = StateMachineStateIR.from_fields(
+            xln_ctx,
+            Type='Pass', Parameters=self.merge_parameters())
+        s_parallel.next_state_name = s_merge.name
+        return StateMachineFragmentIR([s_parallel, s_merge],
+                                      s_parallel,
+                                      [s_merge])
+
+    def merge_parameters(self):
+        if self.keep_locals is None:
+            return {'locals.$': ('States.JsonMerge($.locals,'
+                                 ' $.parallel_result, false)')}
+        # Build the new 'locals' from just the variables to keep.
+        targets = self.assigned_vars()
+        return {'locals': {
+            f'{v}.$': ('$.parallel_result.' if v in targets else '$.locals.') + v
+            for v in self.keep_locals}}
+
+    def live_in(self, live_out):
+        return ((live_out - self.assigned_vars())
+                | set.union(*[a.source.used_vars()
+                              for a in self.assignments]))
+
+    def assigned_vars(self):
+        return {a.target_varname for a in self.assignments}
+
+    def with_kept_locals(self, keep):
+        return attr.evolve(self, keep_locals=keep)
+
+
+@attr.s(slots=True)
+class FusedCallIR(StatementIR):
+    """
+    A run of call-assignments performed by one invocation of the Lambda
+    function, which makes the calls in sequence and returns the
+    updated 'locals' object.
+    """
+    assignments = attr.ib()
+    keep_locals = attr.ib(default=None)
+
+    def call_descriptor(self):
+        descr = {'calls': [dict(a.source.call_descriptor(),
+                                target=a.target_varname)
+                           for a in self.assignments]}
+        if self.keep_locals is not None:
+            descr['keep_locals'] = self.keep_locals
+        return descr
+
+    def as_fragment(self, xln_ctx):
+        # All the calls are of functions with the same ARN; see
+        # fused_stmts().
+        fun_name = self.assignments[0].source.fun_name
+        task_fields = {'Type': 'Task',
+                       'Resource': xln_ctx.function_arn(fun_name),
+                       'ResultPath': '$.locals'}
+
+        if xln_ctx.compact_calls:
+            task_fields['Parameters'] = {'call_descr': self.call_descriptor(),
+                                         'locals.$': '$.locals'}
+            s_task = StateMachineStateIR.from_fields(xln_ctx, **task_fields)
+            return StateMachineFragmentIR([s_task], s_task, [s_task])
+
+        s_pass = StateMachineStateIR.from_fields(
+            xln_ctx,
+            Type='Pass',
+            Result=self.call_descriptor(),
+            ResultPath='$.call_descr')
+        s_task = StateMachineStateIR.from_fields(xln_ctx, **task_fields)
+        s_pass.next_state_name = s_task.name
+        return StateMachineFragmentIR([s_pass, s_task], s_pass, [s_task])
+
+    def live_in(self, live_out):
+        live = live_out
+        for a in reversed(self.assignments):
+            live = a.live_in(live)
+        return live
+
+    def assigned_vars(self):
+        return {a.target_varname for a in self.assignments}
+
+    def with_kept_locals(self, keep):
+        return attr.evolve(self, keep_locals=keep)
+
+
+@attr.s(slots=True)
+class PruneLocalsIR(StatementIR):
+    """
+    Drop from the 'locals' all variables except those to keep.
+    """
+    keep = attr.ib()
+
+    def as_fragment(self, xln_ctx):
+        s = StateMachineStateIR.from_fields(
+            xln_ctx,
+            Type='Pass',
+            Parameters={'locals': {f'{v}.$': chained_key_smr([v])
+                                   for v in self.keep}})
+        return StateMachineFragmentIR([s], s, [s])
+
+    def live_in(self, live_out):
+        return set(self.keep)
+
+    def assigned_vars(self):
+        return set()
+
+
+########################################################################
+
+def is_call_assignment(stmt):
+    return (isinstance(stmt, AssignmentIR)
+            and isinstance(stmt.source, FunctionCallIR))
+
+
+def call_assignment_levels(assignments):
+    """
+    Given a run of call-assignments, build their def-use dependency
+    graph and return the earliest 'level' at which each can run, such
+    that running each level's calls in parallel, and the levels in
+    sequence, gives the same final values as running the original
+    sequence.
+
+    A call reading a variable assigned earlier in the run, or assigning
+    a variable assigned earlier, must run at a later level.  A call
+    assigning a variable read earlier may share that earlier call's
+    level, because all calls in a level see the state before the level.
+    """
+    # Only the highest level writing, and the highest level reading,
+    # each variable so far matter, so track those rather than compare
+    # every pair of calls.
+    write_level = {}
+    read_level = {}
+    levels = []
+    for a in assignments:
+        target = a.target_varname
+        level = max([write_level[v] + 1
+                     for v in a.source.arg_names + [target]
+                     if v in write_level]
+                    + [read_level.get(target, 0)])
+        levels.append(level)
+        write_level[target] = max(write_level.get(target, 0), level)
+        for v in a.source.arg_names:
+            read_level[v] = max(read_level.get(v, 0), level)
+    return levels
+
+
+def parallelised_run(assignments):
+    levels = call_assignment_levels(assignments)
+    groups = [[] for _ in range(max(levels) + 1)]
+    for a, level in zip(assignments, levels):
+        groups[level].append(a)
+    return [AutoParallelIR(group) if len(group) > 1 else group[0]
+            for group in groups]
+
+
+def parallelised_stmts(stmts, is_eligible):
+    """
+    Return a new list of statements where each maximal run of
+    consecutive eligible call-assignments is rescheduled via
+    parallelised_run().
+    """
+    new_stmts = []
+    run = []
+    for stmt in stmts + [None]:
+        if is_call_assignment(stmt) and is_eligible(stmt.source):
+            run.append(stmt)
+            continue
+        if run:
+            new_stmts.extend(parallelised_run(run))
+            run = []
+        if stmt is not None:
+            new_stmts.append(stmt)
+    return new_stmts
+
+
+def fused_stmts(stmts, function_arn=lambda fun_name: None):
+    """
+    Return a new list of statements where each run of two or more
+    consecutive call-assignments without retry-specs, of functions with
+    the same ARN (as given by 'function_arn'), is replaced by a
+    FusedCallIR.  The body of a 'try' is a separate suite, which is
+    never rewritten, so 'Catch' clauses still apply to a single call.
+    """
+    new_stmts = []
+    run = []
+
+    def end_run():
+        if len(run) > 1:
+            new_stmts.append(FusedCallIR(list(run)))
+        else:
+            new_stmts.extend(run)
+        run.clear()
+
+    for stmt in stmts + [None]:
+        if is_call_assignment(stmt) and stmt.source.retry_spec is None:
+            if run and (function_arn(stmt.source.fun_name)
+                        != function_arn(run[0].source.fun_name)):
+                end_run()
+            run.append(stmt)
+            continue
+        end_run()
+        if stmt is not None:
+            new_stmts.append(stmt)
+    return new_stmts
+
+
+def state_read_vars(suite):
+    """
+    Return the set of variables whose values the state machine itself
+    looks at (in Choice conditions, as the items of a Map, or as a
+    result), anywhere in the given SuiteIR or the suites within it.
+    """
+    names = set()
+    pending = [suite]
+    while pending:
+        for stmt in pending.pop().body:
+            if isinstance(stmt, ReturnIR):
+                names.add(stmt.varname)
+            elif isinstance(stmt, IfIR):
+                arms, default_body = stmt.choice_arms()
+                for test, body in arms:
+                    names |= test.used_vars()
+                    pending.append(body)
+                pending.append(default_body)
+            elif isinstance(stmt, TryIR):
+                pending.append(stmt.body)
+                pending.extend(c.body for c in stmt.catchers)
+            elif isinstance(stmt, AssignmentIR):
+                if isinstance(stmt.source, ParallelIR):
+                    pending.extend(stmt.source.branches)
+                elif isinstance(stmt.source, MapIR):
+                    names |= stmt.source.used_vars()
+    return names
+
+
+# Suites with fewer statements than this, counting those in nested
+# suites, are translated afresh rather than looked up in the cache.
+min_cached_suite_statements = 50
+
+
+def n_statements(suite):
+    """
+    Return the number of statements in the given SuiteIR, counting those
+    in the suites within it.
+    """
+    n = 0
+    pending = [suite]
+    while pending:
+        body = pending.pop().body
+        n += len(body)
+        for stmt in body:
+            if isinstance(stmt, IfIR):
+                pending.extend([stmt.true_body, stmt.false_body])
+            elif isinstance(stmt, TryIR):
+                pending.append(stmt.body)
+                pending.extend(c.body for c in stmt.catchers)
+            elif (isinstance(stmt, AssignmentIR)
+                  and isinstance(stmt.source, ParallelIR)):
+                pending.extend(stmt.source.branches)
+    return n
+
+
+def offloading_suite(suite):
+    """
+    Return a copy of the given SuiteIR in which every call whose result
+    the state machine does not itself look at (see state_read_vars())
+    is marked as offloadable.  This must be done before calls are
+    gathered into AutoParallelIR or FusedCallIR statements.
+    """
+    state_read = state_read_vars(suite)
+
+    def offloading(stmt):
+        if (isinstance(stmt, AssignmentIR)
+                and isinstance(stmt.source, (FunctionCallIR, MapIR))
+                and stmt.target_varname not in state_read):
+            return attr.evolve(stmt, source=attr.evolve(stmt.source,
+                                                        offload=True))
+        if isinstance(stmt, TryIR):
+            # The body of a 'try' is not rewritten by rewrite_suites().
+            return attr.evolve(stmt, body=SuiteIR(
+                [offloading(s) for s in stmt.body.body]))
+        return stmt
+
+    return rewrite_suites(suite, lambda stmts: [offloading(s)
+                                                for s in stmts])
+
+
+def vars_assigned_by_all(suites):
+    """
+    Return the variables certainly assigned by whichever of the given
+    suites runs, ignoring suites from which control never passes on.
+    If control never passes on from any of them, return None.
+    """
+    assigned = [a for a in (s.assigned_vars() for s in suites)
+                if a is not None]
+    if not assigned:
+        return None
+    return set.intersection(*assigned)
+
+
+def pruned_suite(suite, live_out, present):
+    """
+    Return a copy of the given SuiteIR where, after each point at which
+    some variable in the 'locals' dies (is never read again), the
+    'locals' are pruned down to the live variables.  The variables
+    live after the suite, and those certainly present in the 'locals'
+    before it, must be given.
+
+    Pruning rebuilds the 'locals' from the live variables, so can only
+    be done where every live variable is certainly present.  Where a
+    statement can do the pruning itself (see with_kept_locals()), it
+    does, to avoid the cost of an extra state.
+    """
+    live = live_out
+    lives_after = []
+    for stmt in reversed(suite.body):
+        lives_after.append(live)
+        live = stmt.live_in(live)
+    lives_after.reverse()
+
+    present = set(present)
+    new_stmts = []
+
+    def maybe_prune(live, next_stmt):
+        # Nothing is gained by pruning just before a terminal state.
+        # At the end of the suite, leave it to the enclosing suite,
+        # which prunes after the whole compound statement.
+        if (next_stmt is None
+                or isinstance(next_stmt, (ReturnIR, RaiseIR))
+                or not (present - live)
+                or not (live <= present)):
+            return False
+        keep = sorted(live)
+        pruning_stmt = new_stmts and new_stmts[-1].with_kept_locals(keep)
+        if pruning_stmt:
+            new_stmts[-1] = pruning_stmt
+        else:
+            new_stmts.append(PruneLocalsIR(keep))
+        return True
+
+    next_stmts = suite.body[1:] + [None]
+
+    if maybe_prune(live, suite.body[0]):
+        present = live
+
+    for stmt, live, next_stmt in zip(suite.body, lives_after, next_stmts):
+        new_stmts.append(stmt.with_pruned_suites(live, present))
+        assigned = stmt.assigned_vars()
+        if assigned is None:
+            # Control never gets to any following statements.
+            break
+        present |= assigned
+        if maybe_prune(live, next_stmt):
+            present = set(live)
+
+    return SuiteIR(new_stmts)
+
+
+def rewrite_suites(suite, rewrite_stmts):
+    """
+    Return a copy of the given SuiteIR where the statement list of it
+    and of every suite nested within it (bodies of 'if' and 'except'
+    clauses, and branches of 'Parallel' states) has been passed
+    through rewrite_stmts().  Inner suites are rewritten first.
+    """
+    def rewrite(s):
+        return rewrite_suites(s, rewrite_stmts)
+
+    def rewrite_stmt(stmt):
+        if isinstance(stmt, IfIR):
+            # Rewrite an if/elif chain arm by arm, rather than recursing
+            # down it.
+            arms, default_body = stmt.choice_arms()
+            return IfIR.from_arms([(test, rewrite(body))
+                                   for test, body in arms],
+                                  rewrite(default_body))
+        if isinstance(stmt, TryIR):
+            return attr.evolve(stmt,
+                               catchers=[attr.evolve(c, body=rewrite(c.body))
+                                         for c in stmt.catchers])
+        if (isinstance(stmt, AssignmentIR)
+                and isinstance(stmt.source, ParallelIR)):
+            return attr.evolve(stmt, source=ParallelIR(
+                [rewrite(b) for b in stmt.source.branches]))
+        return stmt
+
+    return SuiteIR(rewrite_stmts([rewrite_stmt(s) for s in suite.body]))
 
 
 ########################################################################
 
+def arms_mutually_exclusive(tests):
+    """
+    Return whether at most one of the given tests can be true at once,
+    as far as we can tell statically.  This is so when they all test
+    the same variable for equality against disjoint sets of strings.
+    """
+    options = [t.string_equals_options() for t in tests]
+    if None in options or len({var for var, _ in options}) > 1:
+        return False
+    all_literals = [lit for _, lits in options for lit in lits]
+    return len(all_literals) == len(set(all_literals))
+
+
+def arms_cost(tests, locals_obj):
+    """
+    Return the number of rule evaluations needed to choose an arm for
+    the given 'locals' object, checking the tests in order.
+    """
+    n_evaluations = 0
+    for test in tests:
+        n_evaluations += test.n_evaluations(locals_obj)
+        if test.evaluate(locals_obj):
+            break
+    return n_evaluations
+
+
+@attr.s
+class ChoiceProfileReport:
+    state_name = attr.ib()
+    n_visits = attr.ib()
+    n_evaluations_before = attr.ib()
+    n_evaluations_after = attr.ib()
+    arms_reordered = attr.ib()
+
+    @property
+    def n_evaluations_saved(self):
+        return self.n_evaluations_before - self.n_evaluations_after
+
+
+@attr.s
+class BranchProfile:
+    """
+    Recorded inputs to Choice states, taken from execution histories
+    (as written by 'aws stepfunctions get-execution-history'), used to
+    put the common cases of each Choice state first.
+    """
+    inputs_by_state = attr.ib()
+    n_executions = attr.ib()
+    reports = attr.ib(factory=list)
+
+    @classmethod
+    def from_history_files(cls, fnames):
+        inputs_by_state = {}
+        for fname in fnames:
+            with open(fname, 'rt') as f_in:
+                history = json.load(f_in)
+            for event in history['events']:
+                if event['type'] == 'ChoiceStateEntered':
+                    details = event['stateEnteredEventDetails']
+                    state_input = json.loads(details['input'])
+                    inputs_by_state.setdefault(details['name'], []).append(
+                        state_input.get('locals', {}))
+        return cls(inputs_by_state, len(fnames))
+
+    def ordered_arms(self, state_name, tests_and_xs):
+        """
+        Given the (test, x) pairs of the named Choice state, return
+        them reordered according to the recorded inputs to that state.
+        The terms of each 'Or'/'And' test are always free to move; the
+        arms themselves are only moved if their tests are mutually
+        exclusive, because otherwise order affects which arm is taken.
+        """
+        locals_objs = self.inputs_by_state.get(state_name, [])
+        if not locals_objs:
+            return tests_and_xs
+
+        tests = [t for t, _ in tests_and_xs]
+        n_evaluations_before = sum(arms_cost(tests, x) for x in locals_objs)
+
+        reordered = [(t.reordered(locals_objs), x) for t, x in tests_and_xs]
+        arms_reordered = arms_mutually_exclusive(tests)
+        if arms_reordered:
+            def n_taken(arm):
+                return sum(arm[0].evaluate(x) for x in locals_objs)
+            reordered.sort(key=n_taken, reverse=True)
+
+        new_tests = [t for t, _ in reordered]
+        n_evaluations_after = sum(arms_cost(new_tests, x)
+                                  for x in locals_objs)
+
+        self.reports.append(ChoiceProfileReport(
+            state_name,
+            len(locals_objs),
+            n_evaluations_before,
+            n_evaluations_after,
+            arms_reordered))
+
+        return reordered
+
+    def summary_lines(self):
+        n_executions = max(self.n_executions, 1)
+        for r in self.reports:
+            yield ('{}: {} visits; rules {}; rule evaluations {} -> {}'
+                   .format(r.state_name, r.n_visits,
+                           'reordered' if r.arms_reordered else 'kept',
+                           r.n_evaluations_before, r.n_evaluations_after))
+        n_evals = sum(r.n_evaluations_saved for r in self.reports)
+        yield ('expected per execution: {:.2f} rule evaluations saved'
+               .format(n_evals / n_executions))
+
+
+def history_fnames(paths):
+    """
+    Expand the given paths, each a history JSON file or a directory of
+    them, into a list of file names.
+    """
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnames.extend(sorted(glob.glob(os.path.join(path, '*.json'))))
+        else:
+            fnames.append(path)
+    return fnames
+
+
 @attr.s
 class TranslationContext:
+    # The ARN of the Lambda function to call, where any '{function}' is
+    # replaced by the name of the function called; or a dict mapping
+    # function names to such ARNs, with the key '*' for any others.
     lambda_arn = attr.ib()
+    compact_calls = attr.ib(default=False)
+    branch_profile = attr.ib(default=None)
+    auto_parallel = attr.ib(default=None)
+    fuse_calls = attr.ib(default=False)
+    prune_locals = attr.ib(default=False)
+    merge_states = attr.ib(default=False)
+    offload_values = attr.ib(default=False)
+    cache = attr.ib(default=None)
+    next_id = attr.ib(default=0)
+    shared_fields = attr.ib(factory=dict, repr=False, eq=False)
+    _options_key = attr.ib(default=None, init=False, repr=False, eq=False)
+
+    def new_state_name(self):
+        name = 'n{}'.format(self.next_id)
+        self.next_id += 1
+        return name
+
+    def function_arn(self, fun_name):
+        """
+        Return the ARN of the Lambda function which runs calls of the
+        named function.
+        """
+        arn = self.lambda_arn
+        if isinstance(arn, dict):
+            arn = arn.get(fun_name, arn.get('*'))
+            if arn is None:
+                raise ValueError('no Lambda ARN for function {!r}'
+                                 .format(fun_name))
+        return arn.replace('{function}', fun_name)
+
+    def shared_state_fields(self, key, make_fields):
+        """
+        Return the fields for a state, shared with every other state of
+        this translation made under the same (small, hashable) key, so
+        that, e.g., repeated identical calls do not each hold a copy.
+        """
+        fields = self.shared_fields.get(key)
+        if fields is None:
+            fields = self.shared_fields[key] = make_fields()
+        return fields
+
+    def options_key(self):
+        """
+        Return a digest of options_obj(), made once per context.
+        """
+        if self._options_key is None:
+            self._options_key = cache_key(self.options_obj())
+        return self._options_key
+
+    def options_obj(self):
+        """
+        Return a JSON-friendly description of everything, other than
+        the source program, which affects the translation.
+        """
+        profile = self.branch_profile
+        return {'compiler_version': compiler_version(),
+                'lambda_arn': self.lambda_arn,
+                'compact_calls': self.compact_calls,
+                'auto_parallel': self.auto_parallel,
+                'fuse_calls': self.fuse_calls,
+                'prune_locals': self.prune_locals,
+                'merge_states': self.merge_states,
+                'offload_values': self.offload_values,
+                'branch_profile': (None if profile is None
+                                   else cache_key(profile.inputs_by_state))}
+
+    def machine_cache_key(self, syntax_tree, fun=None):
+        """
+        Return the cache key for the whole state machine, made from the
+        main function's AST, together with the names and decorators of
+        the top-level definitions it refers to (which is all of theirs
+        that the translation looks at), and the options.
+        """
+        if fun is None:
+            fun = self.state_machine_main_fundef(syntax_tree)
+        names_used = {nd.id for nd in ast.walk(fun)
+                      if isinstance(nd, ast.Name)}
+        defs_used = [[fd.name, [ast.dump(d) for d in fd.decorator_list]]
+                     for fd in syntax_tree.body
+                     if (isinstance(fd, ast.FunctionDef)
+                         and fd.name in names_used)]
+        return cache_key(self.options_key(), ast.dump(fun), defs_used)
+
+    def cached_suite_fragment(self, suite):
+        key = cache_key(self.options_key(), repr(suite))
+        obj = self.cache.get('suite', key)
+        if obj is not None:
+            return StateMachineFragmentIR.from_cacheable_obj(obj, self)
+        base_id = self.next_id
+        fragment = suite.translated_fragment(self)
+        self.cache.put('suite', key,
+                       fragment.as_cacheable_obj(base_id, self.next_id))
+        return fragment
+
+    def state_machine_json_obj(self, syntax_tree, fun=None):
+        """
+        Return the JSON-friendly form of the top-level state machine for
+        the given main function (by default, the unique one), from the
+        cache if possible.
+        """
+        if self.cache is None:
+            return self.translated_json_obj(syntax_tree, fun)
+        key = self.machine_cache_key(syntax_tree, fun)
+        obj = self.cache.get('machine', key)
+        if obj is None:
+            obj = self.translated_json_obj(syntax_tree, fun)
+            self.cache.put('machine', key, obj)
+        return obj
+
+    def translated_json_obj(self, syntax_tree, fun=None):
+        obj = self.top_level_state_machine(syntax_tree, fun).as_json_obj()
+        if self.merge_states:
+            obj = merged_definition(obj)
+        return obj
+
+    def state_machine_definition(self, syntax_tree, fun=None):
+        """
+        Return a pair (state_items, start_at) for the top-level state
+        machine, where 'state_items' is an iterable of the (name,
+        value) pairs of its states, suitable for StateMachineEmitter.
+        Without a cache, and unless merging states (which needs the
+        whole definition), the values are built one by one as the
+        iterable is consumed.
+        """
+        if self.cache is None and not self.merge_states:
+            fragment = self.top_level_state_machine(syntax_tree, fun)
+            return fragment.json_items(), fragment.enter_state.name
+        obj = self.state_machine_json_obj(syntax_tree, fun)
+        return obj['States'].items(), obj['StartAt']
 
     @staticmethod
     def is_main_fundef(fd):
@@ -440,41 +1576,172 @@ class TranslationContext:
             and len(fd.decorator_list) == 1
             and psf_attr(fd.decorator_list[0], raise_if_not=False) == 'main')
 
+    @staticmethod
+    def is_pure_fundef(fd):
+        return (
+            isinstance(fd, ast.FunctionDef)
+            and any(psf_attr(d, raise_if_not=False) == 'pure'
+                    for d in fd.decorator_list))
+
+    def parallelisation_predicate(self, syntax_tree):
+        """
+        Return a predicate saying whether a FunctionCallIR may be run
+        in parallel with its neighbours, according to the
+        'auto_parallel' setting: None (never), 'pure' (only calls of
+        functions decorated with PSF.pure), or 'all'.
+        """
+        if self.auto_parallel == 'all':
+            return lambda call: True
+        if self.auto_parallel == 'pure':
+            pure_names = {fd.name for fd in syntax_tree.body
+                          if self.is_pure_fundef(fd)}
+            return lambda call: call.fun_name in pure_names
+        raise ValueError('unknown auto_parallel setting {!r}'
+                         .format(self.auto_parallel))
+
+    def optimised_suite(self, suite, syntax_tree, params):
+        if self.offload_values:
+            suite = offloading_suite(suite)
+        if self.auto_parallel is not None:
+            is_eligible = self.parallelisation_predicate(syntax_tree)
+            suite = rewrite_suites(
+                suite,
+                lambda stmts: parallelised_stmts(stmts, is_eligible))
+        if self.fuse_calls:
+            suite = rewrite_suites(
+                suite, lambda stmts: fused_stmts(stmts, self.function_arn))
+        if self.prune_locals:
+            suite = pruned_suite(suite, set(), params)
+        return suite
+
+    def main_fundefs(self, syntax_tree):
+        return [x for x in syntax_tree.body if self.is_main_fundef(x)]
+
     def state_machine_main_fundef(self, syntax_tree):
-        candidates = [x for x in syntax_tree.body if self.is_main_fundef(x)]
+        candidates = self.main_fundefs(syntax_tree)
         if len(candidates) != 1:
             raise ValueError('no unique PSF.main function')
         return candidates[0]
 
-    def top_level_state_machine(self, syntax_tree):
-        fun = self.state_machine_main_fundef(syntax_tree)
+    def top_level_state_machine(self, syntax_tree, fun=None):
+        """
+        Translate the given main function (by default, the unique one).
+        This does not modify 'self' or 'syntax_tree', so one context
+        can serve concurrent translations from many threads; each
+        translation numbers its states from zero.
+        """
+        if fun is None:
+            fun = self.state_machine_main_fundef(syntax_tree)
+        xln_ctx = attr.evolve(self, next_id=0, shared_fields={})
         suite = SuiteIR.from_ast_nodes(fun.body)
-        return suite.as_fragment(self)
+        params = {a.arg for a in fun.args.args}
+        suite = xln_ctx.optimised_suite(suite, syntax_tree, params)
+        return suite.as_fragment(xln_ctx)
 
 
-@attr.s
+@attr.s(slots=True)
 class StateMachineStateIR:
+    """
+    A single state.  Its 'fields' dict may be shared with other states
+    (see TranslationContext.shared_state_fields()), so must be replaced
+    rather than modified.
+    """
     name = attr.ib()
     fields = attr.ib()
     next_state_name = attr.ib()
 
-    next_id = 0
+    @classmethod
+    def from_fields(cls, xln_ctx, **kwargs):
+        return cls(xln_ctx.new_state_name(), kwargs, None)
 
     @classmethod
-    def from_fields(cls, **kwargs):
-        name = 'n{}'.format(cls.next_id)
-        cls.next_id += 1
-        return cls(name, kwargs, None)
+    def from_shared_fields(cls, xln_ctx, key, make_fields):
+        return cls(xln_ctx.new_state_name(),
+                   xln_ctx.shared_state_fields(key, make_fields),
+                   None)
 
     def value_as_json_obj(self):
         return maybe_with_next(self.fields, self.next_state_name)
 
 
-@attr.s
+def relocated_state_name(name, offset):
+    return 'n{}'.format(int(name[1:]) + offset)
+
+
+payload_slots = frozenset(['Result', 'Parameters', 'ResultSelector',
+                           'ItemSelector', 'Error', 'Cause'])
+
+
+def relocated_state_names(obj, offset):
+    """
+    Return a copy of the given JSON-friendly object, with every state
+    name 'n<id>' it refers to (as a key of a 'States' object, or as the
+    value of a 'Next', 'Default' or 'StartAt' slot) changed to
+    'n<id + offset>'.  Payload slots ('Result', 'Parameters', etc.) hold
+    user data rather than state structure, so are copied unchanged.
+    """
+    def relocate(name):
+        return relocated_state_name(name, offset)
+
+    if isinstance(obj, list):
+        return [relocated_state_names(x, offset) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    relocated = {}
+    for k, v in obj.items():
+        if k == 'States':
+            v = {relocate(name): relocated_state_names(state, offset)
+                 for name, state in v.items()}
+        elif k in ('Next', 'Default', 'StartAt'):
+            v = relocate(v)
+        elif k in payload_slots:
+            pass
+        else:
+            v = relocated_state_names(v, offset)
+        relocated[k] = v
+    return relocated
+
+
+@attr.s(slots=True)
 class StateMachineFragmentIR:
-    all_states = attr.ib()
+    """
+    A piece of state machine, entered at 'enter_state', and left via
+    the 'Next' of each of its exit states.
+
+    Compound statements build their fragments out of those of their
+    parts, so to keep assembly linear in the number of states, the
+    states and the exit states are each held as a list of 'parts',
+    where a part is either a StateMachineStateIR or a sub-fragment
+    standing for all of its states (or exit states).  The parts are
+    only flattened when 'all_states' or 'exit_states' is needed.
+    """
+    state_parts = attr.ib(converter=tuple)
     enter_state = attr.ib()
-    exit_states = attr.ib()
+    exit_parts = attr.ib(converter=tuple)
+
+    @staticmethod
+    def flattened(parts, parts_of_fragment):
+        # Iterative rather than recursive, since fragments nest as
+        # deeply as the Python source does.
+        states = []
+        stack = [iter(parts)]
+        while stack:
+            part = next(stack[-1], None)
+            if part is None:
+                stack.pop()
+            elif isinstance(part, StateMachineFragmentIR):
+                stack.append(iter(parts_of_fragment(part)))
+            else:
+                states.append(part)
+        return states
+
+    @property
+    def all_states(self):
+        return self.flattened(self.state_parts, lambda f: f.state_parts)
+
+    @property
+    def exit_states(self):
+        return self.flattened(self.exit_parts, lambda f: f.exit_parts)
 
     @property
     def n_states(self):
@@ -485,23 +1752,219 @@ class StateMachineFragmentIR:
             s.next_state_name = next_state_name
 
     def as_json_obj(self):
-        return {'States': {s.name: s.value_as_json_obj()
-                           for s in self.all_states},
+        return {'States': dict(self.json_items()),
                 'StartAt': self.enter_state.name}
 
+    def json_items(self):
+        """
+        Yield the (name, JSON-friendly value) pair of each state in
+        turn, building each value only when asked for it.
+        """
+        for s in self.all_states:
+            yield s.name, s.value_as_json_obj()
+
+    def as_cacheable_obj(self, base_id, next_id):
+        """
+        Return a JSON-friendly form of this fragment, which must have
+        been translated with state ids from 'base_id' up to (but not
+        including) 'next_id'.
+        """
+        index = {id(s): i for i, s in enumerate(self.all_states)}
+        return {'base_id': base_id,
+                'n_ids': next_id - base_id,
+                'states': [[s.name, s.fields, s.next_state_name]
+                           for s in self.all_states],
+                'enter': index[id(self.enter_state)],
+                'exits': [index[id(s)] for s in self.exit_states]}
+
+    @classmethod
+    def from_cacheable_obj(cls, obj, xln_ctx):
+        """
+        Rebuild a fragment from the result of as_cacheable_obj(), with
+        its states renamed to take the next available ids of 'xln_ctx',
+        as if the fragment had just been translated.
+        """
+        offset = xln_ctx.next_id - obj['base_id']
+        xln_ctx.next_id += obj['n_ids']
+        states = [StateMachineStateIR(
+                      relocated_state_name(name, offset),
+                      relocated_state_names(fields, offset),
+                      (None if next_name is None
+                       else relocated_state_name(next_name, offset)))
+                  for name, fields, next_name in obj['states']]
+        return cls(states,
+                   states[obj['enter']],
+                   [states[i] for i in obj['exits']])
+
 
 ########################################################################
 
+def parse_function_arns(ctx, param, values):
+    pairs = []
+    for value in values:
+        fun_name, sep, arn = value.partition('=')
+        if not (sep and fun_name and arn):
+            raise click.BadParameter('expected FUNCTION=ARN, not {!r}'
+                                     .format(value))
+        pairs.append((fun_name, arn))
+    return pairs
+
+
+def lambda_arns(lambda_arn, function_arn):
+    """
+    Return the 'lambda_arn' for a TranslationContext from the LAMBDA_ARN
+    argument and the (function, ARN) pairs of the --function-arn option.
+    """
+    if not function_arn:
+        return lambda_arn
+    return dict(function_arn, **{'*': lambda_arn})
+
+
+def translation_options(fun):
+    """
+    Add to the given click command the options which control how the
+    state machine is generated.
+    """
+    options = [
+        click.option('--function-arn', multiple=True,
+                     metavar='FUNCTION=ARN', callback=parse_function_arns,
+                     help=('ARN of the Lambda function for calls of the'
+                           ' given function, rather than the default ARN'
+                           ' (in which \'{function}\' is replaced by the'
+                           ' name of the function called); may be'
+                           ' repeated.')),
+        click.option('--compact-calls', is_flag=True,
+                     help=('Use one Task per call, passing only its'
+                           ' arguments.')),
+        click.option('--auto-parallel', type=click.Choice(['pure', 'all']),
+                     help=('Gather independent calls (of PSF.pure functions,'
+                           ' or of all functions) into Parallel states.')),
+        click.option('--fuse-calls', is_flag=True,
+                     help=('Make runs of consecutive calls in one invocation'
+                           ' of the Lambda function.')),
+        click.option('--prune-locals', is_flag=True,
+                     help=('Drop each local variable from the state once it'
+                           ' will not be used again.')),
+        click.option('--merge-states', is_flag=True,
+                     help=('Merge identical states, and so identical'
+                           ' subgraphs, into one copy.')),
+        click.option('--offload-values', is_flag=True,
+                     help=('Let the Lambda handler put large call results'
+                           ' in a blob store, if it has one, leaving only'
+                           ' references in the state.')),
+        click.option('--cache-dir', type=click.Path(file_okay=False),
+                     help='Directory in which to cache translations.'),
+        click.option('--cache-max-mb', type=float, default=256,
+                     show_default=True,
+                     help=('Evict least recently used cache entries beyond'
+                           ' this.')),
+        click.option('--cache-max-age-days', type=float, default=30,
+                     show_default=True,
+                     help='Evict cache entries unused for this long.'),
+        click.option('--cache-stats', is_flag=True,
+                     help='Report cache hits and misses on stderr.')]
+    for option in reversed(options):
+        fun = option(fun)
+    return fun
+
+
+def output_options(fun):
+    """
+    Add to the given click command the options which control how the
+    state machine definition is written.
+    """
+    options = [
+        click.option('--minify', is_flag=True,
+                     help='Write compact JSON rather than indented.'),
+        click.option('--max-definition-bytes', type=click.IntRange(min=0),
+                     default=DEFINITION_SIZE_LIMIT, show_default=True,
+                     help=('Fail if the definition, minified, would exceed'
+                           ' this size (0 for no limit).')),
+        click.option('--size-report', is_flag=True,
+                     help='Report the size of the definition on stderr.')]
+    for option in reversed(options):
+        fun = option(fun)
+    return fun
+
+
+def emitter_kwargs(minify, max_definition_bytes):
+    return {'minify': minify,
+            'max_bytes': max_definition_bytes or None}
+
+
+def too_large_message(err):
+    return '\n'.join([str(err)] + list(err.breakdown_lines()))
+
+
+def cache_from_options(cache_dir, cache_max_mb, cache_max_age_days):
+    if not cache_dir:
+        return None
+    return CompilationCache(cache_dir,
+                            max_bytes=int(cache_max_mb * 2**20),
+                            max_age_seconds=cache_max_age_days * 86400)
+
+
+def finish_cache(cache, cache_stats):
+    if cache is not None:
+        cache.evict()
+        if cache_stats:
+            for line in cache.summary_lines():
+                click.echo(line, err=True)
+
+
 @click.command()
 @click.argument('source_fname')
 @click.argument('lambda_arn')
-def main(source_fname, lambda_arn):
+@click.option('--branch-profile', multiple=True,
+              type=click.Path(exists=True),
+              help=('Execution-history JSON file, or directory of them,'
+                    ' used to order Choice rules; may be repeated.'))
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help=('Write the definition to this file (only if it is'
+                    ' successfully generated) rather than stdout.'))
+@translation_options
+@output_options
+def main(source_fname, lambda_arn, branch_profile, output,
+         function_arn, compact_calls, auto_parallel, fuse_calls,
+         prune_locals, merge_states, offload_values, cache_dir,
+         cache_max_mb, cache_max_age_days, cache_stats,
+         minify, max_definition_bytes, size_report):
     syntax_tree = ast.parse(source=open(source_fname, 'rt').read(),
                             filename=source_fname)
 
-    xln_ctx = TranslationContext(lambda_arn)
-    state_machine = xln_ctx.top_level_state_machine(syntax_tree)
-    print(json.dumps(state_machine.as_json_obj(), indent=2))
+    profile = (BranchProfile.from_history_files(history_fnames(branch_profile))
+               if branch_profile else None)
+
+    cache = cache_from_options(cache_dir, cache_max_mb, cache_max_age_days)
+
+    xln_ctx = TranslationContext(lambda_arns(lambda_arn, function_arn),
+                                 compact_calls=compact_calls,
+                                 branch_profile=profile,
+                                 auto_parallel=auto_parallel,
+                                 fuse_calls=fuse_calls,
+                                 prune_locals=prune_locals,
+                                 merge_states=merge_states,
+                                 offload_values=offload_values,
+                                 cache=cache)
+    state_items, start_at = xln_ctx.state_machine_definition(syntax_tree)
+    kwargs = emitter_kwargs(minify, max_definition_bytes)
+    try:
+        if output:
+            emitter = emit_to_file(output, state_items, start_at, **kwargs)
+        else:
+            emitter = emit_to_stream(sys.stdout, state_items, start_at,
+                                     **kwargs)
+    except DefinitionTooLargeError as err:
+        raise click.ClickException(too_large_message(err))
+
+    if size_report:
+        click.echo(emitter.summary_line(), err=True)
+
+    if profile is not None:
+        for line in profile.summary_lines():
+            click.echo(line, err=True)
+
+    finish_cache(cache, cache_stats)
 
 
 if __name__ == '__main__':
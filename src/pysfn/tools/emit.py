@@ -0,0 +1,218 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import attr
+import json
+import os
+import os.path
+import shutil
+import tempfile
+from itertools import chain
+
+
+# The service's limit on the size of a state machine definition.
+DEFINITION_SIZE_LIMIT = 1048576
+
+
+class DefinitionTooLargeError(ValueError):
+    """
+    The definition being emitted would exceed the size limit.  Carries
+    the sizes of the states emitted so far, including the one which
+    would have taken the definition over the limit.
+    """
+    def __init__(self, n_bytes, max_bytes, state_sizes):
+        super().__init__('state machine definition exceeds {} bytes'
+                         ' (reached {} bytes after {} states)'
+                         .format(max_bytes, n_bytes, len(state_sizes)))
+        self.n_bytes = n_bytes
+        self.max_bytes = max_bytes
+        self.state_sizes = state_sizes
+
+    def breakdown_lines(self, n_largest=10):
+        largest = sorted(self.state_sizes,
+                         key=lambda s: s[2], reverse=True)[:n_largest]
+        yield 'largest states:'
+        for name, state_type, n_bytes in largest:
+            yield '  {:>10} bytes  {} ({})'.format(n_bytes, name, state_type)
+
+
+@attr.s
+class StateMachineEmitter:
+    """
+    Write a state machine definition to 'f_out' one state at a time,
+    without building the whole JSON object or text in memory.  The
+    output is identical to json.dumps(definition, indent=2), or, if
+    'minify', to the most compact JSON, followed by a newline.  If the
+    definition would exceed 'max_bytes' (None for no limit), raise
+    DefinitionTooLargeError.  The limit applies to the definition's
+    minified size, whichever form is written, as that is what it can be
+    deployed as.  Text may already have been written when the error is
+    raised; emit_to_file() and emit_to_stream() write nothing unless
+    the whole definition is emitted.
+
+    Each state's text is buffered until complete, or until it exceeds
+    'buffer_bytes', so that even one very large state (e.g., a Parallel
+    with many branches) is not held in memory as a whole.
+    """
+    f_out = attr.ib()
+    minify = attr.ib(default=False)
+    max_bytes = attr.ib(default=DEFINITION_SIZE_LIMIT)
+    buffer_bytes = attr.ib(default=65536)
+    n_bytes = attr.ib(default=0)
+    n_minified_bytes = attr.ib(default=0)
+    state_sizes = attr.ib(factory=list)
+
+    # json.dumps() escapes all non-ASCII characters, so the length of
+    # the text is its size in bytes.
+    indented_encoder = json.JSONEncoder(indent=2)
+    minified_encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def minified_chunks(self, name, value):
+        yield '{}:'.format(json.dumps(name))
+        yield from self.minified_encoder.iterencode(value)
+
+    def indented_chunks(self, name, value):
+        # A state is nested two levels deep.  JSON strings cannot
+        # contain a literal newline, so re-indenting is safe.
+        yield '    {}: '.format(json.dumps(name))
+        for chunk in self.indented_encoder.iterencode(value):
+            yield chunk.replace('\n', '\n    ')
+
+    def count(self, n_bytes, n_reserved=0):
+        """
+        Count 'n_bytes' more of the minified definition, checking that
+        this leaves room for 'n_reserved' more.
+        """
+        n_total = self.n_minified_bytes + n_bytes
+        if (self.max_bytes is not None
+                and n_total + n_reserved > self.max_bytes):
+            raise DefinitionTooLargeError(n_total + n_reserved,
+                                          self.max_bytes,
+                                          self.state_sizes)
+        self.n_minified_bytes = n_total
+
+    def counted(self, chunks, state_size, n_reserved):
+        for chunk in chunks:
+            state_size[2] += len(chunk)
+            self.count(len(chunk), n_reserved)
+            yield chunk
+
+    def write(self, chunks):
+        """
+        Write the given chunks, joined into pieces of about
+        'buffer_bytes'.
+        """
+        pending, n_pending = [], 0
+        for chunk in chunks:
+            pending.append(chunk)
+            n_pending += len(chunk)
+            if n_pending > self.buffer_bytes:
+                self.f_out.write(''.join(pending))
+                self.n_bytes += n_pending
+                pending, n_pending = [], 0
+        self.f_out.write(''.join(pending))
+        self.n_bytes += n_pending
+
+    def emit(self, state_items, start_at):
+        """
+        Write the definition with the given (name, value) pairs of
+        states, in order, and the given 'StartAt' state name.
+        """
+        minified_head = '{"States":{'
+        minified_tail = '}},"StartAt":{}}}'.format(json.dumps(start_at))
+        if self.minify:
+            head, separator, tail = minified_head, ',', minified_tail
+        else:
+            head, separator = '{\n  "States": {\n', ',\n'
+            tail = '\n  }},\n  "StartAt": {}\n}}'.format(
+                json.dumps(start_at))
+        n_reserved = len(minified_tail)
+        self.count(len(minified_head), n_reserved)
+        self.write([head])
+        for i, (name, value) in enumerate(state_items):
+            state_size = [name, value.get('Type'), 0]
+            self.state_sizes.append(state_size)
+            chunks = self.minified_chunks(name, value)
+            try:
+                if i:
+                    self.count(1, n_reserved)
+                if self.minify:
+                    # What is written is what is counted.
+                    state_chunks = self.counted(chunks, state_size,
+                                                n_reserved)
+                else:
+                    for _ in self.counted(chunks, state_size, n_reserved):
+                        pass
+                    state_chunks = self.indented_chunks(name, value)
+                if i:
+                    state_chunks = chain([separator], state_chunks)
+                self.write(state_chunks)
+            except DefinitionTooLargeError:
+                # Measure the rest of this state for the breakdown.
+                state_size[2] += sum(len(chunk) for chunk in chunks)
+                raise
+        self.count(len(minified_tail))
+        self.write([tail, '\n'])
+
+    def summary_line(self):
+        line = 'definition: {} bytes'.format(self.n_bytes)
+        if not self.minify:
+            line += ' ({} minified)'.format(self.n_minified_bytes)
+        line += ', {} states'.format(len(self.state_sizes))
+        if self.max_bytes is not None:
+            line += ' ({:.1f}% of {}-byte limit)'.format(
+                100.0 * self.n_minified_bytes / self.max_bytes,
+                self.max_bytes)
+        return line
+
+
+def emit_to_file(fname, state_items, start_at, **kwargs):
+    """
+    Emit a definition to the named file via a StateMachineEmitter made
+    with the given keyword arguments, and return the emitter.  The
+    file is only created (or replaced) if the whole definition is
+    emitted successfully.
+    """
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fname)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wt') as f_out:
+            emitter = StateMachineEmitter(f_out, **kwargs)
+            emitter.emit(state_items, start_at)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+    return emitter
+
+
+def emit_to_stream(f_out, state_items, start_at, **kwargs):
+    """
+    Emit a definition to the file object 'f_out' (e.g., sys.stdout) via
+    a StateMachineEmitter made with the given keyword arguments, and
+    return the emitter.  The text is staged in a temporary file, so
+    nothing is written to 'f_out' unless the whole definition is
+    emitted successfully.
+    """
+    with tempfile.TemporaryFile('w+t') as f_tmp:
+        emitter = StateMachineEmitter(f_tmp, **kwargs)
+        emitter.emit(state_items, start_at)
+        f_tmp.seek(0)
+        shutil.copyfileobj(f_tmp, f_out)
+    return emitter
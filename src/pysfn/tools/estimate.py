@@ -0,0 +1,399 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Static estimates of the cost and latency of a compiled state machine:
+the number of state transitions (which AWS bills for) and of Lambda
+invocations, and the length of the critical path, each as a minimum
+and maximum over all paths and as an expectation given the
+probability of each branch.
+"""
+
+import ast
+import attr
+import click
+import json
+import math
+import sys
+
+from .compile import (TranslationContext, translation_options, lambda_arns,
+                      cache_from_options, finish_cache)
+from .merge import successor_names, postorder_names
+
+
+########################################################################
+
+@attr.s(frozen=True, slots=True)
+class Cost:
+    """
+    The cost of running part of a state machine: the number of state
+    transitions and of Lambda invocations made, and the time taken and
+    number of states passed through along its critical path.
+    """
+    transitions = attr.ib(default=0)
+    invocations = attr.ib(default=0)
+    latency = attr.ib(default=0.0)
+    n_path_states = attr.ib(default=0)
+
+    def then(self, other):
+        return Cost(self.transitions + other.transitions,
+                    self.invocations + other.invocations,
+                    self.latency + other.latency,
+                    self.n_path_states + other.n_path_states)
+
+    def alongside(self, other):
+        return Cost(self.transitions + other.transitions,
+                    self.invocations + other.invocations,
+                    max(self.latency, other.latency),
+                    max(self.n_path_states, other.n_path_states))
+
+    def repeated(self, n_times, n_rounds):
+        """
+        Return the cost of running this 'n_times' times, in 'n_rounds'
+        rounds one after another.
+        """
+        return Cost(n_times * self.transitions,
+                    n_times * self.invocations,
+                    n_rounds * self.latency,
+                    n_rounds * self.n_path_states)
+
+    @staticmethod
+    def componentwise(fun, costs):
+        return Cost(*[fun(values) for values in
+                      zip(*[attr.astuple(c) for c in costs])])
+
+
+@attr.s(frozen=True, slots=True)
+class Estimate:
+    """
+    The least, greatest, and expected Cost of running part of a state
+    machine.  The least and greatest are found separately for each
+    component, so need not come from the same path.
+    """
+    least = attr.ib(default=Cost())
+    greatest = attr.ib(default=Cost())
+    expected = attr.ib(default=Cost())
+
+    @classmethod
+    def exact(cls, cost):
+        return cls(cost, cost, cost)
+
+    def then(self, other):
+        return Estimate(self.least.then(other.least),
+                        self.greatest.then(other.greatest),
+                        self.expected.then(other.expected))
+
+    def alongside(self, other):
+        return Estimate(self.least.alongside(other.least),
+                        self.greatest.alongside(other.greatest),
+                        self.expected.alongside(other.expected))
+
+    def repeated(self, n_times, n_rounds):
+        return Estimate(self.least.repeated(n_times, n_rounds),
+                        self.greatest.repeated(n_times, n_rounds),
+                        self.expected.repeated(n_times, n_rounds))
+
+    @classmethod
+    def one_of(cls, estimates_and_probabilities):
+        """
+        Return the Estimate for running exactly one of the given
+        alternatives, each taken with the given probability.
+        """
+        estimates = [e for e, _ in estimates_and_probabilities]
+
+        def expectation(values):
+            return sum(p * v for (_, p), v
+                       in zip(estimates_and_probabilities, values))
+
+        return cls(Cost.componentwise(min, [e.least for e in estimates]),
+                   Cost.componentwise(max, [e.greatest for e in estimates]),
+                   Cost.componentwise(expectation,
+                                      [e.expected for e in estimates]))
+
+    def as_json_obj(self):
+        def stats(field):
+            return {'min': getattr(self.least, field),
+                    'max': getattr(self.greatest, field),
+                    'expected': getattr(self.expected, field)}
+        return {'transitions': stats('transitions'),
+                'lambda_invocations': stats('invocations'),
+                'critical_path': {
+                    'states': self.greatest.n_path_states,
+                    'seconds': self.greatest.latency,
+                    'expected_seconds': self.expected.latency}}
+
+
+########################################################################
+
+def call_descriptors(states):
+    """
+    Return a dict mapping the name of each Task state which has one to
+    its call descriptor, whether given in its 'Parameters' or put in
+    place by the Pass state before it.
+    """
+    descrs = {}
+    for name, value in states.items():
+        if value['Type'] == 'Task':
+            descr = value.get('Parameters', {}).get('call_descr')
+            if descr is not None:
+                descrs[name] = descr
+        elif (value['Type'] == 'Pass'
+              and value.get('ResultPath') == '$.call_descr'
+              and 'Next' in value):
+            descrs[value['Next']] = value['Result']
+    return descrs
+
+
+def retry_attempts_and_waits(retriers):
+    """
+    Return the greatest number of retries the given retriers can make
+    of a failing Task, and the time spent waiting between them.
+    """
+    n_attempts = 0
+    wait = 0.0
+    for r in retriers:
+        max_attempts = r.get('MaxAttempts', 3)
+        interval = r.get('IntervalSeconds', 1)
+        backoff = r.get('BackoffRate', 2.0)
+        n_attempts += max_attempts
+        wait += sum(interval * backoff ** i for i in range(max_attempts))
+    return n_attempts, wait
+
+
+@attr.s
+class Estimator:
+    """
+    Estimates the cost of a state machine, given the probability of
+    each successor of each state, by state name, as a dict of dicts
+    {state: {successor: probability}}, and the latency of each
+    function, by name, in seconds.  Unspecified probabilities are shared
+    equally among a Choice state's other successors, and are zero for
+    a Task's Catch targets.  Each Map is assumed to have 'map_items'
+    items.
+    """
+    probabilities = attr.ib(factory=dict)
+    latencies = attr.ib(factory=dict)
+    default_latency = attr.ib(default=0.0)
+    map_items = attr.ib(default=1)
+
+    def definition_estimate(self, defn, call_descr=None):
+        """
+        Return the Estimate for the given definition (a dict with
+        'States' and 'StartAt').  If given, 'call_descr' is the call
+        descriptor for any Task state which does not have its own, as
+        in the processor of a Map.
+        """
+        states = defn['States']
+        descrs = call_descriptors(states)
+        estimates = {}
+        for name in postorder_names(states, defn['StartAt']):
+            value = states[name]
+            own = self.state_estimate(value, descrs.get(name, call_descr))
+            successors = list(dict.fromkeys(successor_names(value)))
+            if any(s not in estimates for s in successors):
+                raise ValueError('cannot estimate cost of a state machine'
+                                 ' with a loop through {}'.format(name))
+            alternatives = [estimates[s] for s in successors]
+            if value['Type'] not in ('Choice', 'Succeed', 'Fail') \
+                    and 'Next' not in value:
+                # The machine can end here.
+                successors.append(None)
+                alternatives.append(Estimate())
+            if alternatives:
+                probabilities = self.successor_probabilities(
+                    name, value, successors)
+                own = own.then(Estimate.one_of(
+                    list(zip(alternatives, probabilities))))
+            estimates[name] = own
+        return estimates[defn['StartAt']]
+
+    def successor_probabilities(self, name, value, successors):
+        given = self.probabilities.get(name, {})
+        unknown = set(given) - set(successors)
+        if unknown:
+            raise ValueError('{} has no successor(s) {}'
+                             .format(name, ', '.join(sorted(unknown))))
+        rest = 1.0 - sum(given.values())
+        if rest < -1e-9:
+            raise ValueError('probabilities for {} add up to more than 1'
+                             .format(name))
+        if value['Type'] == 'Choice':
+            n_unspecified = sum(s not in given for s in successors)
+            share = rest / n_unspecified if n_unspecified else 0.0
+            return [given.get(s, share) for s in successors]
+        # Otherwise the normal successor (or the end) is taken unless
+        # the state fails into one of its Catch targets.
+        normal = value.get('Next')
+        return [given.get(s, rest if s == normal else 0.0)
+                for s in successors]
+
+    def call_latency(self, call_descr):
+        if call_descr is None:
+            return self.default_latency
+        if 'calls' in call_descr:
+            return sum(self.call_latency(c) for c in call_descr['calls'])
+        return self.latencies.get(call_descr['function'],
+                                  self.default_latency)
+
+    def state_estimate(self, value, call_descr):
+        """
+        Return the Estimate for the given state alone, not counting
+        any of its successors.
+        """
+        state_type = value['Type']
+        own = Estimate.exact(Cost(1, 0, 0.0, 1))
+        if state_type == 'Task':
+            is_lambda = not value['Resource'].startswith('arn:aws:states:::')
+            latency = self.call_latency(call_descr)
+            once = Cost(1, int(is_lambda), latency, 1)
+            n_retries, wait = retry_attempts_and_waits(value.get('Retry', []))
+            worst = Cost(1 + n_retries, int(is_lambda) * (1 + n_retries),
+                         (1 + n_retries) * latency + wait, 1)
+            return Estimate(once, worst, once)
+        if state_type == 'Wait' and 'Seconds' in value:
+            return Estimate.exact(Cost(1, 0, float(value['Seconds']), 1))
+        if state_type == 'Parallel':
+            branches = [self.definition_estimate(b)
+                        for b in value['Branches']]
+            combined = branches[0]
+            for b in branches[1:]:
+                combined = combined.alongside(b)
+            return own.then(combined)
+        if state_type == 'Map':
+            processor = value.get('ItemProcessor', value.get('Iterator'))
+            item_descr = value.get('ItemSelector', value.get('Parameters',
+                                                             {}))
+            per_item = self.definition_estimate(
+                processor, item_descr.get('call_descr'))
+            n_items = self.map_items
+            concurrency = value.get('MaxConcurrency') or n_items
+            n_rounds = math.ceil(n_items / concurrency) if n_items else 0
+            return own.then(per_item.repeated(n_items, n_rounds))
+        return own
+
+
+########################################################################
+
+def regressions(report, baseline, tolerance=0.0):
+    """
+    Yield a description of each transition or invocation count in the
+    given report which exceeds that in the baseline report by more than
+    the given fraction.
+    """
+    for metric in ('transitions', 'lambda_invocations'):
+        for stat in ('min', 'max', 'expected'):
+            old = baseline[metric][stat]
+            new = report[metric][stat]
+            if new > old * (1.0 + tolerance) + 1e-9:
+                yield '{} {}: {:g} -> {:g}'.format(stat, metric, old, new)
+
+
+def report_lines(report):
+    transitions = report['transitions']
+    invocations = report['lambda_invocations']
+    path = report['critical_path']
+    yield ('transitions: min {min:g}, max {max:g}, expected {expected:.2f}'
+           .format(**transitions))
+    yield ('lambda invocations: min {min:g}, max {max:g},'
+           ' expected {expected:.2f}'.format(**invocations))
+    yield ('critical path: {states} states, {seconds:.3f} s'
+           ' (expected {expected_seconds:.3f} s)'.format(**path))
+
+
+def json_from_file(fname):
+    if fname is None:
+        return {}
+    with open(fname, 'rt') as f_in:
+        return json.load(f_in)
+
+
+@click.command()
+@click.argument('source_fname')
+@click.argument('lambda_arn')
+@click.option('--probabilities', type=click.Path(exists=True, dir_okay=False),
+              help=('JSON file giving, for each state, the probability of'
+                    ' each successor: {"n3": {"n4": 0.9, "n7": 0.1}}.'))
+@click.option('--latencies', type=click.Path(exists=True, dir_okay=False),
+              help=('JSON file giving the latency, in seconds, of each'
+                    ' function: {"get_summary": 0.25}.'))
+@click.option('--default-latency', type=float, default=0.0,
+              show_default=True,
+              help='Latency, in seconds, of functions not in --latencies.')
+@click.option('--map-items', type=click.IntRange(min=0), default=1,
+              show_default=True,
+              help='Number of items assumed for each Map state.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Write the report as JSON.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help=('JSON report to compare against; exit with status 1'
+                    ' if any transition or invocation count has grown.'))
+@click.option('--tolerance', type=float, default=0.0, show_default=True,
+              help='Fractional growth allowed against --baseline.')
+@click.option('--write-baseline', type=click.Path(dir_okay=False),
+              help='Write the JSON report to this file.')
+@translation_options
+def main(source_fname, lambda_arn, probabilities, latencies,
+         default_latency, map_items, as_json, baseline, tolerance,
+         write_baseline,
+         function_arn, compact_calls, auto_parallel, fuse_calls,
+         prune_locals, merge_states, offload_values, cache_dir,
+         cache_max_mb, cache_max_age_days, cache_stats):
+    syntax_tree = ast.parse(source=open(source_fname, 'rt').read(),
+                            filename=source_fname)
+    cache = cache_from_options(cache_dir, cache_max_mb, cache_max_age_days)
+    xln_ctx = TranslationContext(lambda_arns(lambda_arn, function_arn),
+                                 compact_calls=compact_calls,
+                                 auto_parallel=auto_parallel,
+                                 fuse_calls=fuse_calls,
+                                 prune_locals=prune_locals,
+                                 merge_states=merge_states,
+                                 offload_values=offload_values,
+                                 cache=cache)
+    estimator = Estimator(json_from_file(probabilities),
+                          json_from_file(latencies),
+                          default_latency, map_items)
+    try:
+        estimate = estimator.definition_estimate(
+            xln_ctx.state_machine_json_obj(syntax_tree))
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    report = estimate.as_json_obj()
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        for line in report_lines(report):
+            click.echo(line)
+
+    if write_baseline:
+        with open(write_baseline, 'wt') as f_out:
+            json.dump(report, f_out, indent=2)
+            f_out.write('\n')
+
+    finish_cache(cache, cache_stats)
+
+    if baseline:
+        found = list(regressions(report, json_from_file(baseline), tolerance))
+        for line in found:
+            click.echo('regression: ' + line, err=True)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
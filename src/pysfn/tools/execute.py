@@ -0,0 +1,551 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local, in-process execution of compiled state machines.
+
+The JSON definition is interpreted directly, with each Task state
+calling the same 'dispatch' function as the generated Lambda handler,
+so an execution exercises the '$.locals' paths, call descriptors and
+dispatcher which running the original Python does not.  Only the
+parts of the States Language which the compiler emits are supported,
+together with the common comparison operators of Choice rules.
+"""
+
+import ast
+import attr
+import click
+import datetime
+import importlib.util
+import json
+import operator
+import os.path
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from .. import definition as PSF
+from .compile import (TranslationContext, translation_options, lambda_arns,
+                      cache_from_options, finish_cache)
+from .gen_lambda import dispatch_function, called_functions
+
+
+########################################################################
+
+class StatesError(Exception):
+    """
+    An error, with the name and cause it would have in AWS, raised by a
+    state or by the function a Task state called.
+    """
+    def __init__(self, error, cause):
+        super().__init__(error, cause)
+        self.error = error
+        self.cause = cause
+
+    def __str__(self):
+        return f'{self.error}: {self.cause}'
+
+
+########################################################################
+
+path_part_re = re.compile(r'\.([^.\[\]]+)|\[(\d+)\]')
+
+
+@lru_cache(maxsize=1024)
+def path_parts(path):
+    """
+    Split a JsonPath such as '$.locals.xs[2]' (or one on the context
+    object, starting '$$') into its root and the tuple of its keys and
+    indexes.  Only such simple paths are supported.
+    """
+    root = '$$' if path.startswith('$$') else '$'
+    if not path.startswith('$'):
+        raise StatesError('States.Runtime',
+                          f'unsupported JsonPath {path!r}')
+    parts = []
+    pos = len(root)
+    while pos < len(path):
+        m = path_part_re.match(path, pos)
+        if m is None:
+            raise StatesError('States.Runtime',
+                              f'unsupported JsonPath {path!r}')
+        parts.append(m.group(1) if m.group(2) is None else int(m.group(2)))
+        pos = m.end()
+    return root, tuple(parts)
+
+
+def path_value(obj, path, context):
+    root, parts = path_parts(path)
+    value = context if root == '$$' else obj
+    for part in parts:
+        try:
+            value = value[part]
+        except (KeyError, IndexError, TypeError):
+            raise StatesError('States.Runtime',
+                              f'JsonPath {path!r} matched nothing')
+    return value
+
+
+def path_present(obj, path):
+    try:
+        path_value(obj, path, None)
+        return True
+    except StatesError:
+        return False
+
+
+def with_path_value(obj, path, value):
+    """
+    Return a copy of 'obj' with the value at the given ResultPath set,
+    copying only the objects along the path.  A path of None discards
+    the value.
+    """
+    if path is None:
+        return obj
+    _, parts = path_parts(path)
+    if not parts:
+        return value
+
+    def updated(container, parts):
+        if not parts:
+            return value
+        head, rest = parts[0], parts[1:]
+        if isinstance(head, int):
+            new = list(container)
+            new[head] = updated(new[head], rest)
+            return new
+        new = dict(container) if isinstance(container, dict) else {}
+        new[head] = updated(new.get(head, {}), rest)
+        return new
+
+    return updated(obj, parts)
+
+
+########################################################################
+
+intrinsic_re = re.compile(r'(States\.\w+)\((.*)\)$')
+
+
+def intrinsic_args(text, obj, context):
+    args = []
+    for arg in [a.strip() for a in text.split(',')] if text.strip() else []:
+        if arg.startswith('$'):
+            args.append(path_value(obj, arg, context))
+        elif arg.startswith("'"):
+            args.append(arg[1:-1])
+        else:
+            args.append(json.loads(arg))
+    return args
+
+
+def intrinsic_value(expr, obj, context):
+    m = intrinsic_re.match(expr)
+    if m is None:
+        raise StatesError('States.Runtime',
+                          f'unsupported intrinsic {expr!r}')
+    name, args = m.group(1), intrinsic_args(m.group(2), obj, context)
+    if name == 'States.JsonMerge':
+        if args[2]:
+            raise StatesError('States.Runtime',
+                              'deep JsonMerge is not supported')
+        return dict(args[0], **args[1])
+    if name == 'States.Array':
+        return args
+    raise StatesError('States.Runtime', f'unsupported intrinsic {name}')
+
+
+def payload(template, obj, context):
+    """
+    Return the value of the given 'Parameters' (or 'ResultSelector',
+    'ItemSelector') template, evaluating each value whose key ends in
+    '.$' as a JsonPath or intrinsic function.
+    """
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                result[key[:-2]] = (
+                    intrinsic_value(value, obj, context)
+                    if value.startswith('States.')
+                    else path_value(obj, value, context))
+            else:
+                result[key] = payload(value, obj, context)
+        return result
+    if isinstance(template, list):
+        return [payload(v, obj, context) for v in template]
+    return template
+
+
+########################################################################
+
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+timestamp_re = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?'
+                          r'(Z|[+-]\d\d:\d\d)$')
+
+
+def timestamp(value):
+    """
+    Return the given RFC 3339 timestamp as a naive UTC datetime.  (The
+    offset is parsed here, as strptime() only accepts '+00:00' from
+    Python 3.7 on.)
+    """
+    match = timestamp_re.match(value)
+    if match is None:
+        raise ValueError('invalid timestamp {!r}'.format(value))
+    seconds, fraction, zone = match.groups()
+    result = datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        result += datetime.timedelta(seconds=float(fraction))
+    if zone != 'Z':
+        offset = datetime.timedelta(hours=int(zone[1:3]),
+                                    minutes=int(zone[4:6]))
+        result += -offset if zone[0] == '+' else offset
+    return result
+
+
+value_kinds = {'String': (lambda v: isinstance(v, str), lambda v: v),
+               'Numeric': (is_numeric, lambda v: v),
+               'Boolean': (lambda v: isinstance(v, bool), lambda v: v),
+               'Timestamp': (lambda v: isinstance(v, str), timestamp)}
+
+comparison_ops = {'Equals': operator.eq,
+                  'LessThan': operator.lt,
+                  'GreaterThan': operator.gt,
+                  'LessThanEquals': operator.le,
+                  'GreaterThanEquals': operator.ge}
+
+comparison_re = re.compile('({})({})(Path)?$'.format(
+    '|'.join(value_kinds), '|'.join(comparison_ops)))
+
+type_tests = {'IsNull': lambda v: v is None,
+              'IsString': lambda v: isinstance(v, str),
+              'IsNumeric': is_numeric,
+              'IsBoolean': lambda v: isinstance(v, bool)}
+
+
+def string_matches(value, pattern):
+    regex = ''.join('.*' if part == '*' else re.escape(part.replace('\\', ''))
+                    for part in re.split(r'(?<!\\)(\*)', pattern))
+    return re.fullmatch(regex, value, re.DOTALL) is not None
+
+
+def rule_matches(rule, obj):
+    """
+    Say whether the given Choice rule (without regard to its 'Next')
+    matches the given state input.
+    """
+    if 'And' in rule:
+        return all(rule_matches(r, obj) for r in rule['And'])
+    if 'Or' in rule:
+        return any(rule_matches(r, obj) for r in rule['Or'])
+    if 'Not' in rule:
+        return not rule_matches(rule['Not'], obj)
+    variable = rule['Variable']
+    for op, operand in rule.items():
+        if op in ('Variable', 'Next'):
+            continue
+        if op == 'IsPresent':
+            return path_present(obj, variable) == operand
+        # As in Step Functions, only IsPresent may look at a missing
+        # variable; for anything else, the execution fails.
+        value = path_value(obj, variable, None)
+        if op in type_tests:
+            return type_tests[op](value) == operand
+        if op == 'StringMatches':
+            return isinstance(value, str) and string_matches(value, operand)
+        m = comparison_re.match(op)
+        if m is None:
+            raise StatesError('States.Runtime',
+                              f'unsupported Choice operator {op}')
+        kind, comparison, is_path = m.groups()
+        if is_path:
+            operand = path_value(obj, operand, None)
+        is_kind, converted = value_kinds[kind]
+        if not (is_kind(value) and is_kind(operand)):
+            return False
+        return comparison_ops[comparison](converted(value),
+                                          converted(operand))
+    raise StatesError('States.Runtime', 'Choice rule has no operator')
+
+
+########################################################################
+
+def json_copy(obj):
+    # What a Lambda function receives and returns goes through JSON,
+    # so do the same, both to catch unserialisable values and so that
+    # the function cannot alias the state.
+    return json.loads(json.dumps(obj))
+
+
+@attr.s
+class Executor:
+    """
+    Runs a state machine definition in-process.  Each Lambda-invoking
+    Task state calls dispatch(event, None).  Parallel branches and Map
+    iterations are run on 'pool', if given; those nested within a
+    branch or iteration already running on the pool are run in the
+    calling thread, so the pool cannot deadlock waiting for itself.
+    Waits, and the intervals between retries, call 'sleep'.
+    """
+    definition = attr.ib()
+    dispatch = attr.ib()
+    pool = attr.ib(default=None)
+    sleep = attr.ib(default=time.sleep)
+    in_pool = attr.ib(factory=threading.local, repr=False, eq=False)
+
+    def execute(self, execution_input):
+        """
+        Run the state machine on the given input and return its
+        output, or raise a StatesError if the execution fails.
+        """
+        return self.run(self.definition, execution_input, {})
+
+    def run(self, defn, state_input, context):
+        states = defn['States']
+        name = defn['StartAt']
+        obj = state_input
+        while True:
+            value = states[name]
+            try:
+                obj, name = self.run_state(value, obj, context)
+            except StatesError as err:
+                catcher = next((c for c in value.get('Catch', [])
+                                if PSF.error_matches(c['ErrorEquals'],
+                                                     err.error)),
+                               None)
+                if catcher is None:
+                    raise
+                obj = with_path_value(obj, catcher.get('ResultPath', '$'),
+                                      {'Error': err.error,
+                                       'Cause': err.cause})
+                name = catcher['Next']
+            if name is None:
+                return obj
+
+    def run_state(self, value, obj, context):
+        """
+        Run one state on the given input, returning its output and the
+        name of the next state (or None at the end).
+        """
+        state_type = value['Type']
+        if state_type == 'Fail':
+            raise StatesError(value.get('Error', 'States.Fail'),
+                              value.get('Cause', ''))
+
+        input_path = value.get('InputPath', '$')
+        effective = {} if input_path is None else path_value(obj, input_path,
+                                                             context)
+
+        if state_type == 'Choice':
+            next_name = next((r['Next'] for r in value['Choices']
+                              if rule_matches(r, effective)),
+                             value.get('Default'))
+            if next_name is None:
+                raise StatesError('States.NoChoiceMatched',
+                                  'no Choice rule matched')
+            return self.output(value, effective, context), next_name
+
+        if state_type == 'Succeed':
+            return self.output(value, effective, context), None
+
+        if state_type == 'Wait':
+            self.sleep(value['Seconds'])
+            return self.output(value, effective, context), value.get('Next')
+
+        if 'Parameters' in value:
+            effective = payload(value['Parameters'], effective, context)
+
+        if state_type == 'Pass':
+            result = value.get('Result', effective)
+        elif state_type == 'Task':
+            result = self.with_retries(
+                value, lambda: self.invoke(value['Resource'], effective))
+        elif state_type == 'Parallel':
+            result = self.with_retries(
+                value, lambda: self.run_concurrently(
+                    [(b, effective, context) for b in value['Branches']]))
+        elif state_type == 'Map':
+            result = self.with_retries(
+                value, lambda: self.run_map(value, effective, context))
+        else:
+            raise StatesError('States.Runtime',
+                              f'unsupported state type {state_type}')
+
+        if 'ResultSelector' in value:
+            result = payload(value['ResultSelector'], result, context)
+        obj = with_path_value(obj, value.get('ResultPath', '$'), result)
+        return self.output(value, obj, context), value.get('Next')
+
+    @staticmethod
+    def output(value, obj, context):
+        output_path = value.get('OutputPath', '$')
+        if output_path is None:
+            return {}
+        return path_value(obj, output_path, context)
+
+    def invoke(self, resource, event):
+        if resource.startswith('arn:aws:states:::'):
+            raise StatesError('States.Runtime',
+                              f'unsupported service integration {resource}')
+        try:
+            return json_copy(self.dispatch(json_copy(event), None))
+        except StatesError:
+            raise
+        except Exception as exc:
+            raise StatesError(type(exc).__name__, str(exc))
+
+    def with_retries(self, value, attempt):
+        retriers = value.get('Retry', [])
+        n_retries = [0] * len(retriers)
+        while True:
+            try:
+                return attempt()
+            except StatesError as err:
+                i = next((i for i, r in enumerate(retriers)
+                          if PSF.error_matches(r['ErrorEquals'], err.error)),
+                         None)
+                if i is None:
+                    raise
+                retrier = retriers[i]
+                if n_retries[i] >= retrier.get('MaxAttempts', 3):
+                    raise
+                self.sleep(retrier.get('IntervalSeconds', 1)
+                           * retrier.get('BackoffRate', 2.0) ** n_retries[i])
+                n_retries[i] += 1
+
+    def run_map(self, value, effective, context):
+        if 'ItemReader' in value:
+            reader = value['ItemReader']
+            location = reader['Parameters']
+            items = PSF.items_from(
+                's3://{}/{}'.format(location['Bucket'], location['Key']),
+                reader.get('ReaderConfig', {}).get('InputType'))
+        else:
+            items = path_value(effective, value.get('ItemsPath', '$'),
+                               context)
+        selector = value.get('ItemSelector', value.get('Parameters'))
+        processor = value.get('ItemProcessor', value.get('Iterator'))
+        runs = []
+        for index, item in enumerate(items):
+            item_context = dict(context, Map={'Item': {'Index': index,
+                                                      'Value': item}})
+            item_input = (item if selector is None
+                          else payload(selector, effective, item_context))
+            runs.append((processor, item_input, item_context))
+        return self.run_concurrently(runs, value.get('MaxConcurrency', 0))
+
+    def run_concurrently(self, runs, max_concurrency=0):
+        """
+        Run each (definition, input, context) of 'runs', returning their
+        outputs in order, or raising the error of the first to fail.
+        """
+        if self.pool is None or getattr(self.in_pool, 'active', False):
+            return [self.run(*r) for r in runs]
+
+        def run_in_pool(r):
+            self.in_pool.active = True
+            try:
+                return self.run(*r)
+            finally:
+                self.in_pool.active = False
+
+        window = max_concurrency or len(runs) or 1
+        outputs = []
+        for i in range(0, len(runs), window):
+            futures = [self.pool.submit(run_in_pool, r)
+                       for r in runs[i:i + window]]
+            outputs.extend(f.result() for f in futures)
+        return outputs
+
+
+########################################################################
+
+def load_module(fname):
+    """
+    Import the given Python file as a module, named after its stem.
+    """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    spec = importlib.util.spec_from_file_location(name, fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@click.command()
+@click.argument('source_fname')
+@click.option('--input', 'input_text', default='{"locals": {}}',
+              show_default=True, help='JSON input for the execution.')
+@click.option('--lambda-arn', default='arn:aws:lambda:local:0:function:pysfn',
+              show_default=True,
+              help='ARN to compile in; any Lambda ARN runs locally.')
+@click.option('--threads', type=click.IntRange(min=0), default=0,
+              show_default=True,
+              help=('Run Parallel branches and Map iterations on this many'
+                    ' threads (0 to run them in turn).'))
+@click.option('--repeat', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help=('Run this many executions, and report the rate on'
+                    ' stderr.'))
+@translation_options
+def main(source_fname, input_text, lambda_arn, threads, repeat,
+         function_arn, compact_calls, auto_parallel, fuse_calls,
+         prune_locals, merge_states, offload_values, cache_dir,
+         cache_max_mb, cache_max_age_days, cache_stats):
+    syntax_tree = ast.parse(source=open(source_fname, 'rt').read(),
+                            filename=source_fname)
+    cache = cache_from_options(cache_dir, cache_max_mb, cache_max_age_days)
+    xln_ctx = TranslationContext(lambda_arns(lambda_arn, function_arn),
+                                 compact_calls=compact_calls,
+                                 auto_parallel=auto_parallel,
+                                 fuse_calls=fuse_calls,
+                                 prune_locals=prune_locals,
+                                 merge_states=merge_states,
+                                 offload_values=offload_values,
+                                 cache=cache)
+    defn = xln_ctx.state_machine_json_obj(syntax_tree)
+    finish_cache(cache, cache_stats)
+
+    dispatch = dispatch_function(load_module(source_fname),
+                                 called_functions(defn))
+    execution_input = json.loads(input_text)
+    pool = ThreadPoolExecutor(threads) if threads else None
+    executor = Executor(defn, dispatch, pool)
+    try:
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            output = executor.execute(execution_input)
+        elapsed = time.perf_counter() - t0
+    except StatesError as err:
+        raise click.ClickException(f'execution failed: {err}')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    click.echo(json.dumps(output))
+    if repeat > 1:
+        click.echo('{} executions in {:.3f}s ({:.0f} per second)'
+                   .format(repeat, elapsed, repeat / elapsed), err=True)
+
+
+if __name__ == '__main__':
+    main()
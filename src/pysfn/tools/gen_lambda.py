@@ -17,46 +17,617 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import ast
 import click
+import json
+import re
+import sys
+import tempfile
 import zipfile
 import os
 import os.path
 from contextlib import closing
 
+from .bundle import (shaken_source, bundled_modules, package_files,
+                     bytecode_entries, zipimport_split, zip_bytes,
+                     profile_imports, import_profile_lines,
+                     size_report_lines)
+from .compile import TranslationContext, literal_value
+from ..encoding import annotation_kind, encoder
+from .merge import nested_definition_slots
+
 
 package_dir = os.path.split(os.path.split(__file__)[0])[0]
+
+# The dispatcher proper, shared by the generated handler and by
+# dispatch_function().  It expects 'dispatch_table' to map the name of
+# each function the state machine calls to that function, 'blob_store'
+# to be the store for large values (or None, to use the one named by
+# the environment, if any), 'support_modules' to name the modules
+# providing the blob store ('blobstore') and value codecs ('encoding'),
+# and 'uses_codecs' to say whether any function the state machine calls
+# has a return annotation choosing a codec.
+dispatch_source = """\
+import os
+import time
+from operator import itemgetter
+
+log_timing = bool(os.environ.get('PYSFN_TIMING'))
+blob_threshold = int(os.environ.get('PYSFN_BLOB_THRESHOLD', 32768))
+compress_threshold = int(os.environ.get('PYSFN_COMPRESS_THRESHOLD', 4096))
+
+def support_module(name):
+    import importlib
+    return importlib.import_module(support_modules[name])
+
+def get_blob_store():
+    global blob_store
+    if blob_store is None and os.environ.get('PYSFN_BLOB_STORE'):
+        blob_store = support_module('blobstore').open_store(
+            os.environ['PYSFN_BLOB_STORE'])
+    return blob_store
+
+# Values encoded by a codec are decoded as the calls read them, whether
+# directly or as items of a list (as the results of a Map are).  If no
+# called function's results are encoded, the arguments are passed on
+# as they are, without looking inside them.
+def decoded(value):
+    if type(value) is dict:
+        if 'pysfn_codec' in value:
+            return support_module('encoding').decoded(value)
+    elif type(value) is list and any(type(v) in (dict, list) for v in value):
+        return [decoded(v) for v in value]
+    return value
+
+# Callers by (function, *arg_names), each taking the locals and
+# returning the result, so the work of finding the function and
+# picking out its arguments is done once per call site.
+callers = {}
+
+def make_caller(function, arg_names):
+    try:
+        fun = dispatch_table[function]
+    except KeyError:
+        raise KeyError('function {!r} is not called by the state machine'
+                       .format(function))
+    if not arg_names:
+        return lambda local_vars: fun()
+    get_args = itemgetter(*arg_names)
+    if not uses_codecs:
+        if len(arg_names) == 1:
+            return lambda local_vars: fun(get_args(local_vars))
+        return lambda local_vars: fun(*get_args(local_vars))
+    if len(arg_names) == 1:
+        return lambda local_vars: fun(decoded(get_args(local_vars)))
+    return lambda local_vars: fun(*map(decoded, get_args(local_vars)))
+
+def call(call_descr, local_vars):
+    function = call_descr['function']
+    key = (function, *call_descr['arg_names'])
+    caller = callers.get(key)
+    if caller is None:
+        caller = callers[key] = make_caller(function,
+                                            call_descr['arg_names'])
+    if log_timing:
+        t0 = time.perf_counter()
+    result = caller(local_vars)
+    if hasattr(result, '__await__'):
+        # Imported only when needed, as importing asyncio is a large
+        # part of a cold start.  (asyncio.run() is new in Python 3.7.)
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(result)
+        finally:
+            loop.close()
+    if log_timing:
+        print('pysfn call {}: {:.3f} ms'
+              .format(function, 1000 * (time.perf_counter() - t0)))
+    return result
+
+# Encoders by function, from the codec its return annotation chooses
+# (None for no encoding).
+encoders = {}
+
+def result_encoder(function):
+    try:
+        return encoders[function]
+    except KeyError:
+        pass
+    annotation = getattr(dispatch_table[function], '__annotations__',
+                         {}).get('return')
+    encoder = encoders[function] = (
+        None if annotation is None
+        else support_module('encoding').encoder(annotation))
+    return encoder
+
+def outgoing(call_descr, result, store):
+    # The result as it is to go into the state: encoded, and then, if
+    # the state machine does not itself look at it ('offload' in the
+    # descriptor), offloaded to the blob store if large.
+    opaque = call_descr.get('offload', False)
+    encoder = result_encoder(call_descr['function'])
+    if encoder is not None:
+        result = encoder(result, opaque, compress_threshold)
+    if opaque and store is not None:
+        result = store.offloaded(result, blob_threshold)
+    return result
+
+def dispatch(event, context):
+    call_descr = event['call_descr']
+    # With a blob store, references in the locals are resolved only as
+    # the calls read them.
+    store = get_blob_store()
+    if 'calls' in call_descr:
+        # Fused calls: make each in turn, and return all the locals.
+        local_vars = dict(event['locals'])
+        readable = (local_vars if store is None
+                    else store.resolving(local_vars))
+        for c in call_descr['calls']:
+            local_vars[c['target']] = call(c, readable)
+        if 'keep_locals' in call_descr:
+            local_vars = {k: v for k, v in local_vars.items()
+                          if k in call_descr['keep_locals']}
+        # Each target holds the result of the last call assigning it.
+        last_calls = {c['target']: c for c in call_descr['calls']}
+        for target, c in last_calls.items():
+            if target in local_vars:
+                local_vars[target] = outgoing(c, local_vars[target], store)
+        return local_vars
+    readable = (event['locals'] if store is None
+                else store.resolving(event['locals']))
+    return outgoing(call_descr, call(call_descr, readable), store)
+"""
 template = """\
+import time
+init_t0 = time.perf_counter()
+
+import importlib
 import sys
-sys.path.insert(0, './inner')
+import types
+{path_setup}
+class LazyModule(types.ModuleType):
+    # Stands in for a module until one of its attributes is first used,
+    # when the real module is imported and its contents taken on.  (An
+    # importlib.util.LazyLoader module would be loaded by the 'import'
+    # statement itself, which looks at its '__spec__'.)
+    def __getattr__(self, attr):
+        name = self.__name__
+        if sys.modules.get(name) is self:
+            del sys.modules[name]
+        module = importlib.import_module(name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+def lazy_import(name):
+    import importlib.util
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return
+    module = LazyModule(name)
+    module.__spec__ = spec
+    sys.modules[name] = module
+
+for name in {lazy_imports!r}:
+    lazy_import(name)
 
 import inner.{code_modulename} as inner_module
 
-def dispatch(event, context):
-    fun = getattr(inner_module, event['call_descr']['function'])
-    args = [event['locals'][arg_name]
-            for arg_name in event['call_descr']['arg_names']]
-    return fun(*args)
+dispatch_table = {{name: getattr(inner_module, name)
+                  for name in {function_names!r}}}
+support_modules = {{'blobstore': 'pysfn_blobstore',
+                   'encoding': 'pysfn_encoding'}}
+uses_codecs = {uses_codecs!r}
+blob_store = None
+
+"""
+init_report_source = """
+if log_timing:
+    print('pysfn init: {:.3f} ms, {} functions'
+          .format(1000 * (time.perf_counter() - init_t0),
+                  len(dispatch_table)))
+"""
+
+
+# Put the zip-file of the bundle's pure-Python packages, if any, first on
+# the path.
+lib_path_setup = """
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                {lib_zip_name!r}))
 """
+lib_zip_name = 'pysfn-lib.zip'
+
+
+def handler_source(code_modulename, function_names, lazy_imports=(),
+                   lib_zip_name=None, uses_codecs=True):
+    path_setup = ('' if lib_zip_name is None
+                  else lib_path_setup.format(lib_zip_name=lib_zip_name))
+    return (template.format(code_modulename=code_modulename,
+                            function_names=sorted(function_names),
+                            lazy_imports=list(lazy_imports),
+                            path_setup=path_setup,
+                            uses_codecs=uses_codecs)
+            + dispatch_source
+            + init_report_source)
+
+
+def dispatch_function(inner_module, function_names=None, blob_store=None):
+    """
+    Return the 'dispatch' function of the handler, as it would be
+    generated, but calling functions in the given (already imported)
+    module, for running state machines in-process.  Without
+    'function_names', any function of the module can be called.
+    Without a 'blob_store', that named by the environment variable
+    PYSFN_BLOB_STORE, if any, is used.
+    """
+    functions = {name: value for name, value in vars(inner_module).items()
+                 if callable(value)}
+    if function_names is None:
+        function_names = list(functions)
+    # Values may come from any function of the module, not only those
+    # called here.
+    annotations = [getattr(f, '__annotations__', {}).get('return')
+                   for f in functions.values()]
+    uses_codecs = any(a is not None and encoder(a) is not None
+                      for a in annotations)
+    namespace = {'dispatch_table': {name: getattr(inner_module, name)
+                                    for name in function_names},
+                 'support_modules': {'blobstore': 'pysfn.blobstore',
+                                     'encoding': 'pysfn.encoding'},
+                 'uses_codecs': uses_codecs,
+                 'blob_store': blob_store}
+    exec(compile(dispatch_source, '<pysfn handler>', 'exec'), namespace)
+    return namespace['dispatch']
+
+
+def called_functions_by_resource(defn):
+    """
+    Return a dict mapping the Resource (Lambda ARN) of each Task state
+    of the given state machine definition (including those nested
+    within it) to the set of names of the functions called through it,
+    as found from their call descriptors.
+    """
+    names = {}
+
+    def add_descr(resource, descr):
+        if 'calls' in descr:
+            for c in descr['calls']:
+                add_descr(resource, c)
+        else:
+            names.setdefault(resource, set()).add(descr['function'])
+
+    pending = [defn]
+    while pending:
+        states = pending.pop()['States']
+        for value in states.values():
+            if (value['Type'] == 'Pass'
+                    and value.get('ResultPath') == '$.call_descr'):
+                # The call descriptor is for the Task which follows.
+                add_descr(states[value['Next']]['Resource'], value['Result'])
+            if 'call_descr' in value.get('Parameters', {}):
+                add_descr(value['Resource'],
+                          value['Parameters']['call_descr'])
+            if 'call_descr' in value.get('ItemSelector', {}):
+                processor = value['ItemProcessor']
+                task = processor['States'][processor['StartAt']]
+                add_descr(task['Resource'],
+                          value['ItemSelector']['call_descr'])
+            for key, i in nested_definition_slots(value):
+                pending.append(value[key] if i is None else value[key][i])
+    return names
+
+
+def called_functions(defn):
+    """
+    Return the set of names of the functions which the Task states of
+    the given state machine definition (including those nested within
+    it) call, as found from their call descriptors.
+    """
+    return set().union(*called_functions_by_resource(defn).values())
+
+
+def resource_group_name(resource):
+    """
+    Return a name for the bundle of the functions called through the
+    given Resource: the name of the Lambda function, if it is a Lambda
+    ARN, otherwise the whole Resource made safe for a filename.
+    """
+    parts = resource.split(':')
+    if len(parts) >= 7 and parts[2] == 'lambda' and parts[5] == 'function':
+        return parts[6]
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', resource)
+
+
+def source_called_functions(code_filename):
+    """
+    Return the set of names of the functions called by the state
+    machines of all the PSF.main functions in the given file.
+    """
+    with open(code_filename, 'rt') as f_in:
+        syntax_tree = ast.parse(f_in.read(), filename=code_filename)
+    # The ARN and translation options do not affect which functions
+    # are called.
+    xln_ctx = TranslationContext('arn:aws:lambda:::function:pysfn')
+    names = set()
+    for fun in xln_ctx.main_fundefs(syntax_tree):
+        names |= called_functions(
+            xln_ctx.state_machine_json_obj(syntax_tree, fun))
+    return names
+
+
+def annotation_source(nd):
+    """
+    Return the text of the given annotation node, as far as it matters
+    for choosing a codec, or None if it cannot be told.
+    """
+    value = literal_value(nd)
+    if isinstance(value, str):
+        return value
+    if isinstance(nd, ast.Name):
+        return nd.id
+    if isinstance(nd, ast.Attribute):
+        value = annotation_source(nd.value)
+        return None if value is None else '{}.{}'.format(value, nd.attr)
+    if isinstance(nd, ast.Subscript):
+        value = annotation_source(nd.value)
+        index = nd.slice
+        if isinstance(index, getattr(ast, 'Index', ())):
+            # Python 3.8 and earlier
+            index = index.value
+        index_text = ('...' if isinstance(index, ast.Tuple)
+                      else annotation_source(index))
+        if value is None or index_text is None:
+            return None
+        return '{}[{}]'.format(value, index_text)
+    return None
+
+
+def source_uses_codecs(source, called_names, filename='<code>'):
+    """
+    Say whether any of the named functions of the given code might have
+    its results encoded by a codec (see pysfn.encoding), judging by the
+    return annotations of the top-level functions.  A called name which
+    the code does not define by 'def' or 'class' (e.g., one imported)
+    is taken to have a codec.
+    """
+    defined = {}
+    for stmt in ast.parse(source, filename=filename).body:
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            defined[stmt.name] = stmt.returns
+        elif isinstance(stmt, ast.ClassDef):
+            defined[stmt.name] = None
+    for name in called_names:
+        if name not in defined:
+            return True
+        if defined[name] is not None:
+            text = annotation_source(defined[name])
+            if text is None or annotation_kind(text) is not None:
+                return True
+    return False
 
 
 def zinfo(fname):
     # https://stackoverflow.com/questions/46076543
     zi = zipfile.ZipInfo(fname)
     zi.external_attr = 0o777 << 16
+    zi.compress_type = zipfile.ZIP_DEFLATED
     return zi
 
 
+# Files of the bundle which must not be replaced by bundled modules.
+reserved_arcnames = ('handler.py', 'pysfn.py', 'pysfn_blobstore.py',
+                     'pysfn_encoding.py', lib_zip_name)
+
+
+def write_bundle(code_filename, zip_filename, function_names,
+                 lazy_imports=(), tree_shake=True, excludes=(),
+                 whole_packages=(), bytecode=False, optimize=0,
+                 zipimport_layout=False, all_function_names=None):
+    """
+    Write the Lambda zip-file for calling the named functions of the
+    given code, and return the ZipInfo instances of its members (with
+    those of any zipimport zip-file in place of it) and the names which
+    tree-shaking dropped from the code.  Raise ValueError if what is to
+    be bundled cannot be.  The functions called by the state machine in
+    other bundles, whose results this one may be passed, are included
+    in 'all_function_names' (by default, just 'function_names').
+    """
+    code_basename = os.path.basename(code_filename)
+    code_modulename = os.path.splitext(code_basename)[0]
+
+    with open(code_filename, 'rt') as f_in:
+        code_content = f_in.read()
+    uses_codecs = source_uses_codecs(
+        code_content,
+        function_names if all_function_names is None else all_function_names,
+        code_filename)
+    dropped_names = []
+    if tree_shake:
+        code_content, dropped_names = shaken_source(
+            code_content, function_names, code_filename)
+
+    # The bundle provides 'pysfn' itself, as definition.py.
+    modules = dict(bundled_modules(code_filename, code_content,
+                                   ['pysfn'] + list(excludes)))
+    for name in whole_packages:
+        modules.update(package_files(name))
+    arcnames = {arcname: fname for fname, arcname in modules.items()}
+    clashes = [a for a in reserved_arcnames if a in arcnames]
+    if clashes:
+        raise ValueError('bundled module would replace {}'
+                         .format(', '.join(clashes)))
+
+    def file_content(fname):
+        with open(fname, 'rb') as f_in:
+            return f_in.read()
+
+    entries = ([('inner/{}'.format(code_basename), code_content.encode()),
+                ('pysfn.py', file_content(os.path.join(package_dir,
+                                                       'definition.py'))),
+                ('pysfn_blobstore.py',
+                 file_content(os.path.join(package_dir, 'blobstore.py'))),
+                ('pysfn_encoding.py',
+                 file_content(os.path.join(package_dir, 'encoding.py')))]
+               + [(arcname, file_content(fname))
+                  for arcname, fname in sorted(arcnames.items())])
+    lib_entries = []
+    if zipimport_layout:
+        entries, lib_entries = zipimport_split(entries, ['inner'])
+    handler_content = handler_source(
+        code_modulename, function_names, lazy_imports,
+        lib_zip_name if lib_entries else None, uses_codecs)
+    entries.insert(0, ('handler.py', handler_content.encode()))
+    if bytecode:
+        entries = bytecode_entries(entries, optimize)
+        lib_entries = bytecode_entries(lib_entries, optimize)
+    if lib_entries:
+        entries.append((lib_zip_name, zip_bytes(lib_entries)))
+
+    with closing(zipfile.ZipFile(zip_filename, 'x',
+                                 compression=zipfile.ZIP_DEFLATED)) as f_zip:
+        for arcname, content in entries:
+            f_zip.writestr(zinfo(arcname), content)
+        zip_infos = f_zip.infolist()
+        if lib_entries:
+            zip_infos = ([zi for zi in zip_infos
+                          if zi.filename != lib_zip_name]
+                         + zipfile.ZipFile(f_zip.open(lib_zip_name))
+                         .infolist())
+    return zip_infos, dropped_names
+
+
+def report_import_profile(zip_filename, n_slowest):
+    with tempfile.TemporaryDirectory() as bundle_dir:
+        with zipfile.ZipFile(zip_filename) as f_zip:
+            f_zip.extractall(bundle_dir)
+        try:
+            times = profile_imports(bundle_dir)
+        except RuntimeError as e:
+            click.echo('import profile failed: {}'.format(e), err=True)
+            sys.exit(1)
+    for line in import_profile_lines(times, n_slowest):
+        click.echo(line, err=True)
+
+
+def current_python_version():
+    return '{}.{}'.format(*sys.version_info[:2])
+
+
 @click.command()
 @click.argument('code_filename')
 @click.argument('zip_filename')
-def compile_zipfile(code_filename, zip_filename):
-    code_basename = os.path.basename(code_filename)
-    code_modulename = os.path.splitext(code_basename)[0]
-    handler_content = template.format(code_modulename=code_modulename)
-    with closing(zipfile.ZipFile(zip_filename, 'x')) as f_zip:
-        f_zip.writestr(zinfo('handler.py'), handler_content)
-        f_zip.write(code_filename, 'inner/{}'.format(code_basename))
-        f_zip.write(os.path.join(package_dir, 'definition.py'), 'pysfn.py')
+@click.option('--definition', multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help=('Compiled state machine JSON whose called functions'
+                    ' make up the dispatch table; may be repeated.  By'
+                    ' default, those of every PSF.main function in the'
+                    ' code.'))
+@click.option('--lazy-import', multiple=True,
+              help=('Module whose execution is deferred until it is first'
+                    ' used (e.g., a heavy library imported at the top of'
+                    ' the code but used by few functions); may be'
+                    ' repeated.'))
+@click.option('--tree-shake/--no-tree-shake', default=True,
+              show_default=True,
+              help=('Drop top-level definitions, imports, and assignments'
+                    ' of the code which the called functions do not need.'))
+@click.option('--exclude', multiple=True,
+              help=('Module not to bundle, nor follow the imports of'
+                    ' (e.g., boto3, which the Lambda runtime provides);'
+                    ' may be repeated.'))
+@click.option('--whole-package', multiple=True,
+              help=('Package to bundle all the files of, for one needing'
+                    ' data files or importing modules dynamically; may be'
+                    ' repeated.'))
+@click.option('--bytecode', is_flag=True,
+              help=('Ship compiled .pyc files instead of Python source,'
+                    ' so that the runtime need not compile on a cold'
+                    ' start.'))
+@click.option('--optimize', type=click.IntRange(0, 2), default=0,
+              show_default=True,
+              help=('Optimization level of the --bytecode: 1 drops'
+                    ' asserts; 2 drops docstrings too.'))
+@click.option('--target-python', default=current_python_version,
+              help=('Python version, as X.Y, of the Lambda runtime;'
+                    ' --bytecode must be compiled by that version.'
+                    '  [default: this Python]'))
+@click.option('--zipimport', 'zipimport_layout', is_flag=True,
+              help=('Gather pysfn and the bundled pure-Python packages'
+                    ' into one zip-file within the bundle, imported from'
+                    ' directly.'))
+@click.option('--import-profile', type=click.IntRange(min=0), default=0,
+              metavar='N',
+              help=('Import the bundle\'s handler in a fresh local Python,'
+                    ' as on a cold start, and report the N slowest imports'
+                    ' on stderr.'))
+@click.option('--split', is_flag=True,
+              help=('Write one bundle per Lambda function called by the'
+                    ' --definition state machines (or, without any, per'
+                    ' called function), each with only its functions, to'
+                    ' ZIP_FILENAME with \'{group}\' replaced by the name'
+                    ' of the Lambda (or called) function.'))
+@click.option('--size-report', is_flag=True,
+              help='Report the size of the bundle, by package, on stderr.')
+def compile_zipfile(code_filename, zip_filename, definition, lazy_import,
+                    tree_shake, exclude, whole_package, bytecode, optimize,
+                    target_python, zipimport_layout, import_profile, split,
+                    size_report):
+    if bytecode and target_python != current_python_version():
+        raise click.UsageError(
+            'bytecode for Python {} must be compiled by that version, not'
+            ' by this Python {}'.format(target_python,
+                                         current_python_version()))
+
+    if definition:
+        by_resource = {}
+        for fname in definition:
+            with open(fname, 'rt') as f_in:
+                for resource, names in called_functions_by_resource(
+                        json.load(f_in)).items():
+                    by_resource.setdefault(resource, set()).update(names)
+        groups = {}
+        for resource, names in by_resource.items():
+            groups.setdefault(resource_group_name(resource), set()).update(
+                names)
+    else:
+        groups = {name: {name}
+                  for name in source_called_functions(code_filename)}
+
+    if split:
+        if '{group}' not in zip_filename:
+            raise click.UsageError('with --split, ZIP_FILENAME must contain'
+                                   ' \'{group}\'')
+        bundles = [(zip_filename.replace('{group}', group), names)
+                   for group, names in sorted(groups.items())]
+    else:
+        bundles = [(zip_filename, set().union(*groups.values()))]
+
+    all_function_names = set().union(*groups.values())
+    for bundle_filename, function_names in bundles:
+        try:
+            zip_infos, dropped_names = write_bundle(
+                code_filename, bundle_filename, function_names,
+                lazy_imports=lazy_import, tree_shake=tree_shake,
+                excludes=exclude, whole_packages=whole_package,
+                bytecode=bytecode, optimize=optimize,
+                zipimport_layout=zipimport_layout,
+                all_function_names=all_function_names)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        if split and (size_report or import_profile):
+            click.echo('{}: {}'.format(bundle_filename,
+                                       ', '.join(sorted(function_names))),
+                       err=True)
+        if size_report:
+            if dropped_names:
+                click.echo('{}: dropped {}'.format(
+                    os.path.basename(code_filename),
+                    ', '.join(dropped_names)), err=True)
+            for line in size_report_lines(zip_infos):
+                click.echo(line, err=True)
+        if import_profile:
+            report_import_profile(bundle_filename, import_profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+# Copyright (C) 2018 Ben North
+#
+# This file is part of 'plausibility argument of concept for compiling
+# Python into Amazon Step Function state machine JSON'.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Merging of identical states ('hash-consing').
+
+Two states are identical if they have the same content and, after
+earlier merges, the same successors.  Merging identical states can
+make their predecessors identical in turn, so whole identical
+subgraphs collapse to one copy.  (Working up from the leaves like this
+does not merge states which lead to each other round a cycle, but the
+translation never produces cycles.)  The definitions nested within
+'Parallel' and 'Map' states are merged within themselves first, and
+compared modulo the names of their states.
+"""
+
+import json
+
+
+########################################################################
+
+def successor_names(value):
+    """
+    Return the names of the states to which the given state can pass
+    control, in a fixed order.
+    """
+    names = [r['Next'] for r in value.get('Choices', [])]
+    if 'Default' in value:
+        names.append(value['Default'])
+    names.extend(c['Next'] for c in value.get('Catch', []))
+    if 'Next' in value:
+        names.append(value['Next'])
+    return names
+
+
+def with_renamed_successors(value, rename):
+    """
+    Return a copy of the given state with each name of a successor
+    state replaced by rename(name).
+    """
+    value = dict(value)
+    if 'Choices' in value:
+        value['Choices'] = [dict(r, Next=rename(r['Next']))
+                            for r in value['Choices']]
+    if 'Default' in value:
+        value['Default'] = rename(value['Default'])
+    if 'Catch' in value:
+        value['Catch'] = [dict(c, Next=rename(c['Next']))
+                          for c in value['Catch']]
+    if 'Next' in value:
+        value['Next'] = rename(value['Next'])
+    return value
+
+
+def nested_definition_slots(value):
+    """
+    Yield (key, index) for each definition nested in the given state,
+    where 'index' is None unless the definitions are in a list.
+    """
+    for i in range(len(value.get('Branches', []))):
+        yield 'Branches', i
+    for key in ('Iterator', 'ItemProcessor'):
+        if key in value:
+            yield key, None
+
+
+def with_nested_definitions(value, transform):
+    """
+    Return a copy of the given state with each nested definition
+    replaced by transform(definition).
+    """
+    slots = list(nested_definition_slots(value))
+    if not slots:
+        return value
+    value = dict(value)
+    if 'Branches' in value:
+        value['Branches'] = list(value['Branches'])
+    for key, i in slots:
+        if i is None:
+            value[key] = transform(value[key])
+        else:
+            value[key][i] = transform(value[key][i])
+    return value
+
+
+def postorder_names(states, start_at):
+    """
+    Return the names of the given states in an order such that, apart
+    from around cycles, each state comes after all its successors.
+    States not reachable from 'start_at' come last, in their original
+    order.
+    """
+    order = []
+    visited = {start_at}
+    stack = [(start_at, iter(successor_names(states[start_at])))]
+    while stack:
+        name, successors = stack[-1]
+        for succ in successors:
+            if succ not in visited:
+                visited.add(succ)
+                stack.append((succ, iter(successor_names(states[succ]))))
+                break
+        else:
+            order.append(name)
+            stack.pop()
+    return order + [name for name in states if name not in visited]
+
+
+def canonical_definition(defn):
+    """
+    Return a copy of the given definition with its states renamed to
+    '#0', '#1', etc., in the order a depth-first walk from 'StartAt'
+    first reaches them, so that definitions differing only in their
+    state names become equal.
+    """
+    states = defn['States']
+    order = list(reversed(postorder_names(states, defn['StartAt'])))
+    index = {name: '#{}'.format(i) for i, name in enumerate(order)}
+    return {'States': {index[name]: canonical_state(
+                           with_renamed_successors(states[name],
+                                                   index.__getitem__))
+                       for name in order},
+            'StartAt': index[defn['StartAt']]}
+
+
+def canonical_state(value):
+    return with_nested_definitions(value, canonical_definition)
+
+
+def state_key(value):
+    return json.dumps(canonical_state(value), sort_keys=True,
+                      separators=(',', ':'))
+
+
+########################################################################
+
+def merged_definition(defn):
+    """
+    Return a copy of the given state machine definition (a dict with
+    'States' and 'StartAt') in which identical states have been merged.
+    Of each set of identical states, the first in the original order
+    is kept.
+    """
+    states = {name: with_nested_definitions(value, merged_definition)
+              for name, value in defn['States'].items()}
+    order = postorder_names(states, defn['StartAt'])
+
+    # Map each state's name to that of the state standing for it.
+    # With no cycles, one pass in post-order finds every merge; around
+    # cycles, a merge can need further passes.
+    rep = {name: name for name in states}
+    n_classes = len(states)
+    while True:
+        rep_by_key = {}
+        for name in order:
+            key = state_key(with_renamed_successors(states[name],
+                                                    rep.__getitem__))
+            rep[name] = rep_by_key.setdefault(key, name)
+        # Of each set of identical states, keep the earliest.
+        first = {}
+        for name in states:
+            first.setdefault(rep[name], name)
+        rep = {name: first[rep[name]] for name in states}
+        if len(first) >= n_classes:
+            break
+        n_classes = len(first)
+
+    return {'States': {name: with_renamed_successors(value, rep.__getitem__)
+                       for name, value in states.items()
+                       if rep[name] == name},
+            'StartAt': rep[defn['StartAt']]}
+
+
+def n_states(defn):
+    """
+    Return the number of states in the given definition, including
+    those in nested definitions.
+    """
+    total = 0
+    for value in defn['States'].values():
+        total += 1
+        for key, i in nested_definition_slots(value):
+            nested = value[key] if i is None else value[key][i]
+            total += n_states(nested)
+    return total
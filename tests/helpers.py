@@ -0,0 +1,60 @@
+"""
+Factories for state machine definitions, and stand-in functions, shared
+by the tests.
+"""
+
+
+def definition(start_at, **states):
+    return {'States': states, 'StartAt': start_at}
+
+
+def succeed():
+    return {'Type': 'Succeed'}
+
+
+def task(next_name=None, **kwargs):
+    value = {'Type': 'Task', 'Resource': 'arn:...'}
+    if next_name is not None:
+        value['Next'] = next_name
+    return dict(value, **kwargs)
+
+
+def call_task(function, next_name=None, **kwargs):
+    return task(next_name,
+                Resource='arn:...:function:dispatch',
+                Parameters={'call_descr': {'function': function,
+                                           'arg_names': []}},
+                **kwargs)
+
+
+def choice(*next_names, default):
+    return {'Type': 'Choice',
+            'Choices': [{'Variable': '$.x', 'NumericEquals': i, 'Next': n}
+                        for i, n in enumerate(next_names)],
+            'Default': default}
+
+
+class Flaky:
+    """
+    Function which raises the given exceptions in turn, then returns
+    'result' of its arguments (by default, the number of calls made).
+    """
+    def __init__(self, *errors, result=None):
+        self.errors = list(errors)
+        self.result = result
+        self.n_calls = 0
+
+    def __call__(self, *args):
+        self.n_calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.n_calls if self.result is None else self.result(*args)
+
+
+def flaky_dispatch(n_failures, error=RuntimeError):
+    """
+    Dispatch function which fails a given number of times before
+    returning its event's 'x'.
+    """
+    return Flaky(*[error('try again') for _ in range(n_failures)],
+                 result=lambda event, context: event['x'])
@@ -0,0 +1,99 @@
+import pytest
+from pysfn.tools import batch as B
+from pysfn.tools import compile as C
+from click.testing import CliRunner
+import json
+import os.path
+import textwrap
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    (src_dir / 'two.py').write_text(textwrap.dedent("""
+        from pysfn import definition as PSF
+
+        @PSF.main
+        def first(x):
+            y = f(x)
+            return y
+
+        @PSF.main
+        def second(x):
+            y = f(x)
+            z = g(y)
+            return z
+    """))
+    (src_dir / 'one.py').write_text(textwrap.dedent("""
+        from pysfn import definition as PSF
+
+        @PSF.main
+        def only(x):
+            return x
+    """))
+    (src_dir / 'bad.py').write_text('def x(:\n')
+    return src_dir
+
+
+def run_batch(source_dir, out_dir, *args):
+    return CliRunner().invoke(
+        B.main,
+        [str(source_dir / '*.py'), '--lambda-arn', 'arn:...:dispatch',
+         '--out-dir', str(out_dir)] + list(args))
+
+
+class TestBatch:
+    def test_source_fnames(self, source_dir):
+        fnames = B.source_fnames([str(source_dir / 'one.py'),
+                                  str(source_dir / '*.py'),
+                                  'no-such-file.py'])
+        assert [os.path.basename(f) for f in fnames] == [
+            'one.py', 'bad.py', 'two.py', 'no-such-file.py']
+
+    @pytest.mark.parametrize('n_jobs', ['1', '2'])
+    def test_batch(self, source_dir, tmp_path, n_jobs):
+        out_dir = tmp_path / 'out'
+        result = run_batch(source_dir, out_dir, '--jobs', n_jobs)
+        assert result.exit_code == 1
+        assert sorted(os.listdir(out_dir)) == [
+            'one.only.json', 'two.first.json', 'two.second.json']
+        with open(out_dir / 'two.second.json') as f_in:
+            obj = json.load(f_in)
+        # Each machine is numbered from zero.
+        assert obj['StartAt'] == 'n0'
+        lines = result.stderr.splitlines()
+        assert 'bad.py: FAILED' in lines[0]
+        assert 'SyntaxError' in lines[0]
+        assert 'one.py: 1 machine(s)' in lines[1]
+        assert 'two.py: 2 machine(s)' in lines[2]
+        assert lines[3].startswith('3 file(s), 3 machine(s), 1 failure(s)')
+
+    def test_matches_single_compile(self, source_dir, tmp_path):
+        out_dir = tmp_path / 'out'
+        (source_dir / 'bad.py').unlink()
+        result = run_batch(source_dir, out_dir, '--jobs', '2')
+        assert result.exit_code == 0
+        single = CliRunner().invoke(
+            C.main, [str(source_dir / 'one.py'), 'arn:...:dispatch'])
+        with open(out_dir / 'one.only.json') as f_in:
+            assert json.load(f_in) == json.loads(single.stdout)
+
+    def test_cache_stats(self, source_dir, tmp_path):
+        out_dir = tmp_path / 'out'
+        cache_args = ['--jobs', '2', '--cache-dir', str(tmp_path / 'cache'),
+                      '--cache-stats']
+        run_batch(source_dir, out_dir, *cache_args)
+        result = run_batch(source_dir, out_dir, *cache_args)
+        assert 'cache machine: 3 hits, 0 misses' in result.stderr
+
+    def test_colliding_stems(self, source_dir, tmp_path):
+        other_dir = tmp_path / 'other'
+        other_dir.mkdir()
+        (other_dir / 'one.py').write_text((source_dir / 'one.py').read_text())
+        result = CliRunner().invoke(
+            B.main,
+            [str(source_dir / 'one.py'), str(other_dir / 'one.py'),
+             '--lambda-arn', 'arn', '--out-dir', str(tmp_path / 'out')])
+        assert result.exit_code == 2
+        assert 'same name' in result.output
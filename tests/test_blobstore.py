@@ -0,0 +1,94 @@
+import pytest
+from pysfn import blobstore as BS
+import io
+import json
+import os
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BS.LocalBlobStore(str(tmp_path / 'blobs'))
+
+
+class CountingStore(BS.LocalBlobStore):
+    n_gets = 0
+
+    def get(self, key):
+        self.n_gets += 1
+        return super().get(key)
+
+
+class TestOffload:
+    def test_small_value_kept(self, store):
+        assert store.offloaded({'a': 1}, 100) == {'a': 1}
+
+    def test_large_value(self, store):
+        value = {'text': 'x' * 200}
+        ref = store.offloaded(value, 100)
+        assert BS.is_ref(ref)
+        assert ref['pysfn_blob'].startswith(store.uri_prefix)
+        assert ref['n_bytes'] == len(json.dumps(value,
+                                                separators=(',', ':')))
+        assert store.loaded(ref) == value
+        # Keys are content hashes, so the same value is stored once.
+        assert store.offloaded(dict(value), 100) == ref
+        assert len(os.listdir(store.directory)) == 1
+
+    def test_resolved(self, tmp_path):
+        store = CountingStore(str(tmp_path))
+        big = ['y' * 100]
+        ref = store.offloaded(big, 10)
+        value = {'a': ref, 'b': [ref, 1], 'c': 'plain'}
+        assert store.resolved(value) == {'a': big, 'b': [big, 1],
+                                         'c': 'plain'}
+        assert store.n_gets == 1
+
+    def test_resolving_only_what_is_read(self, tmp_path):
+        store = CountingStore(str(tmp_path))
+        local_vars = {'x': store.offloaded('x' * 100, 10),
+                      'y': store.offloaded('y' * 100, 10),
+                      'z': 3}
+        view = store.resolving(local_vars)
+        assert view['x'] == 'x' * 100
+        assert view['x'] == 'x' * 100
+        assert view['z'] == 3
+        assert store.n_gets == 1
+
+    def test_foreign_ref(self, store):
+        with pytest.raises(ValueError, match='is not in the store'):
+            store.loaded({'pysfn_blob': 's3://elsewhere/k', 'n_bytes': 1})
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Bucket, Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+
+class TestOpenStore:
+    def test_s3(self):
+        store = BS.open_store('s3://bucket/some/prefix')
+        assert isinstance(store, BS.S3BlobStore)
+        assert (store.bucket, store.prefix) == ('bucket', 'some/prefix/')
+        store._client = FakeS3Client()
+        ref = store.offloaded('z' * 100, 10)
+        assert ref['pysfn_blob'].startswith('s3://bucket/some/prefix/')
+        key = ref['pysfn_blob'][len('s3://bucket/'):]
+        assert ('bucket', key) in store._client.objects
+        assert store.loaded(ref) == 'z' * 100
+
+    def test_local(self, tmp_path):
+        for uri in ['file://{}'.format(tmp_path), str(tmp_path)]:
+            store = BS.open_store(uri)
+            assert isinstance(store, BS.LocalBlobStore)
+            assert store.directory == str(tmp_path)
+
+    @pytest.mark.parametrize('uri', ['gs://bucket/x', 's3:///x'])
+    def test_bad_uri(self, uri):
+        with pytest.raises(ValueError):
+            BS.open_store(uri)
@@ -0,0 +1,256 @@
+import pytest
+from pysfn.tools import bundle as B
+from pysfn.tools import gen_lambda as G
+from click.testing import CliRunner
+import importlib.util
+import io
+import json
+import subprocess
+import sys
+import textwrap
+import zipfile
+
+
+code_source = textwrap.dedent('''\
+    """Docstring."""
+    from __future__ import annotations
+    import json
+    import attr
+    import click
+    import pysfn as PSF
+    import helper
+
+    LIMIT = 10
+    UNUSED = json.dumps([])
+
+
+    class Error(Exception):
+        pass
+
+
+    def check(x):
+        if x > LIMIT:
+            raise Error
+        return attr.asdict(helper.Point(x, x))
+
+
+    def unused_cli():
+        click.echo('hello')
+
+
+    @PSF.main
+    def main(x):
+        y = check(x)
+        return y
+    ''')
+
+helper_source = textwrap.dedent('''\
+    import attr
+
+    @attr.s
+    class Point:
+        x = attr.ib()
+        y = attr.ib()
+    ''')
+
+
+@pytest.fixture
+def code_fname(tmp_path):
+    code_dir = tmp_path / 'code'
+    code_dir.mkdir()
+    (code_dir / 'helper.py').write_text(helper_source)
+    fname = code_dir / 'workflow.py'
+    fname.write_text(code_source)
+    return str(fname)
+
+
+class TestShakenSource:
+    def test_example(self):
+        shaken, dropped = B.shaken_source(code_source, {'check'})
+        assert dropped == ['PSF', 'UNUSED', 'click', 'json', 'main',
+                           'unused_cli']
+        lines = shaken.splitlines()
+        # Line numbers are preserved.
+        assert len(lines) == len(code_source.splitlines())
+        assert lines[lines.index('def check(x):') - 1] == ''
+        assert 'json' not in shaken
+        assert '"""Docstring."""' not in shaken
+        assert 'from __future__ import annotations' in shaken
+        for name in ['attr', 'helper', 'LIMIT', 'Error']:
+            assert name in shaken
+        assert 'unused_cli' not in shaken
+        compile(shaken, 'workflow.py', 'exec')
+
+    def test_decorators_and_statements_kept(self):
+        source = textwrap.dedent('''\
+            import functools
+            import os
+            registry = []
+            registry.append(1)
+
+            @functools.lru_cache()
+            def f():
+                return 1
+            ''')
+        shaken, dropped = B.shaken_source(source, {'f'})
+        assert dropped == ['os']
+        assert '@functools.lru_cache()' in shaken
+        # Statements other than bindings are always kept, as are the
+        # bindings they need.
+        assert 'registry = []' in shaken
+
+
+class TestBundledModules:
+    def test_import_graph(self, code_fname):
+        shaken, _ = B.shaken_source(open(code_fname).read(), {'check'})
+        arcnames = [a for _, a in B.bundled_modules(code_fname, shaken,
+                                                    ['pysfn'])]
+        assert 'helper.py' in arcnames
+        assert 'attr/__init__.py' in arcnames
+        assert not any(a.startswith(('click', 'json', 'pysfn'))
+                       for a in arcnames)
+
+    def test_package_files(self):
+        arcnames = [a for _, a in B.package_files('attr')]
+        assert 'attr/__init__.py' in arcnames
+        assert all(a.startswith('attr/') for a in arcnames)
+        with pytest.raises(ValueError, match='cannot find'):
+            B.package_files('no_such_package_here')
+
+
+class TestBytecode:
+    def test_sourceless_import(self, tmp_path):
+        source = b'"""Doc."""\nassert False\nVALUE = 42\n'
+        (tmp_path / 'compiled.pyc').write_bytes(
+            B.pyc_bytes(source, 'compiled.py', optimize=2))
+        spec = importlib.util.spec_from_file_location(
+            'compiled', str(tmp_path / 'compiled.pyc'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        assert module.VALUE == 42
+        assert module.__doc__ is None
+
+    def test_deterministic(self):
+        assert B.pyc_bytes(b'x = 1\n', 'x.py') == B.pyc_bytes(b'x = 1\n',
+                                                             'x.py')
+
+    def test_entries(self):
+        entries = [('a/__init__.py', b'x = 1\n'),
+                   ('a/template.py', b'{% if x %}\n'),
+                   ('a/data.json', b'{}')]
+        arcnames = [a for a, _ in B.bytecode_entries(entries)]
+        assert arcnames == ['a/__init__.pyc', 'a/template.py', 'a/data.json']
+
+
+class TestZipimport:
+    def test_split(self):
+        entries = [('inner/code.py', b''), ('pysfn.py', b''),
+                   ('pure/__init__.pyc', b''), ('pure/mod.py', b''),
+                   ('ext/__init__.py', b''), ('ext/_speedups.so', b''),
+                   ('single.cpython-311-x86_64-linux-gnu.so', b'')]
+        kept, zipped = B.zipimport_split(entries, ['inner'])
+        assert [a for a, _ in zipped] == ['pysfn.py', 'pure/__init__.pyc',
+                                          'pure/mod.py']
+        assert [a for a, _ in kept] == [
+            'inner/code.py', 'ext/__init__.py', 'ext/_speedups.so',
+            'single.cpython-311-x86_64-linux-gnu.so']
+
+    def test_zip_bytes(self):
+        content = B.zip_bytes([('a/b.py', b'x = 1\n')])
+        with zipfile.ZipFile(io.BytesIO(content)) as f_zip:
+            assert f_zip.read('a/b.py') == b'x = 1\n'
+
+
+class TestImportTimes:
+    def test_parse(self):
+        text = textwrap.dedent("""\
+            import time: self [us] | cumulative | imported package
+            import time:       120 |        120 |   _io
+            import time:       300 |       1500 | handler
+            Traceback-like noise
+            """)
+        assert B.import_times(text) == [('_io', 120, 120),
+                                        ('handler', 300, 1500)]
+
+    def test_report(self):
+        times = [('_io', 120, 120), ('handler', 300, 1500)]
+        lines = list(B.import_profile_lines(times, 1))
+        assert len(lines) == 2
+        assert lines[1].split() == ['handler', '1.500', 'ms', '0.300', 'ms']
+
+
+class TestCommand:
+    def build(self, tmp_path, code_fname, *args):
+        zip_fname = str(tmp_path / 'lambda-function.zip')
+        result = CliRunner().invoke(G.compile_zipfile,
+                                    [code_fname, zip_fname] + list(args))
+        assert result.exit_code == 0, result.output
+        return zipfile.ZipFile(zip_fname), result
+
+    def test_bundle(self, tmp_path, code_fname):
+        f_zip, result = self.build(tmp_path, code_fname, '--size-report')
+        names = f_zip.namelist()
+        assert names[:3] == ['handler.py', 'inner/workflow.py', 'pysfn.py']
+        assert 'helper.py' in names
+        assert 'attr/__init__.py' in names
+        assert not any(n.startswith('click/') for n in names)
+        code = f_zip.read('inner/workflow.py').decode()
+        assert 'unused_cli' not in code
+        assert 'workflow.py: dropped PSF, UNUSED' in result.stderr
+        report = result.stderr.splitlines()
+        assert report[1].startswith('bundle: {} files'.format(len(names)))
+        assert report[2].split()[0] == 'attr'
+
+    def test_options(self, tmp_path, code_fname):
+        f_zip, result = self.build(tmp_path, code_fname, '--no-tree-shake',
+                                   '--exclude', 'attr',
+                                   '--whole-package', 'click')
+        names = f_zip.namelist()
+        assert not any(n.startswith('attr/') for n in names)
+        assert 'click/py.typed' in names
+        assert 'unused_cli' in f_zip.read('inner/workflow.py').decode()
+        assert result.stderr == ''
+
+    @pytest.mark.parametrize('args', [['--bytecode'],
+                                      ['--zipimport'],
+                                      ['--bytecode', '--optimize', '2',
+                                       '--zipimport']])
+    def test_cold_start_layouts(self, tmp_path, code_fname, args):
+        f_zip, result = self.build(tmp_path, code_fname, *args)
+        names = f_zip.namelist()
+        if '--bytecode' in args:
+            assert not any(n.endswith('.py') for n in names)
+        if '--zipimport' in args:
+            assert 'pysfn-lib.zip' in names
+            assert not any(n.startswith(('attr/', 'pysfn.py'))
+                           for n in names)
+        bundle_dir = tmp_path / 'bundle'
+        f_zip.extractall(bundle_dir)
+        # Run the handler in a fresh process with only the bundle (and
+        # the standard library) to import from.
+        event = {'call_descr': {'function': 'check', 'arg_names': ['x']},
+                 'locals': {'x': 3}}
+        script = textwrap.dedent("""
+        import json, sys
+        sys.path[:] = [p for p in sys.path if 'packages' not in p]
+        import handler
+        print(json.dumps(handler.dispatch({!r}, None)))
+        """.format(event))
+        result = subprocess.run([sys.executable, '-E', '-s', '-c', script],
+                                cwd=str(bundle_dir), capture_output=True,
+                                text=True, check=True)
+        assert json.loads(result.stdout.splitlines()[-1]) == {'x': 3, 'y': 3}
+
+    def test_target_python(self, tmp_path, code_fname):
+        result = CliRunner().invoke(
+            G.compile_zipfile, [code_fname, str(tmp_path / 'l.zip'),
+                                '--bytecode', '--target-python', '2.7'])
+        assert result.exit_code == 2
+        assert 'must be compiled by that version' in result.stderr
+
+    def test_import_profile(self, tmp_path, code_fname):
+        _, result = self.build(tmp_path, code_fname, '--import-profile', '3')
+        lines = result.stderr.splitlines()
+        assert lines[0] == 'slowest imports (cumulative, self):'
+        assert len(lines) == 4
+        assert any(line.split()[0] == 'handler' for line in lines[1:])
@@ -0,0 +1,77 @@
+import pytest
+from pysfn.tools import cache as K
+import os
+import pickle
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return K.CompilationCache(str(tmp_path / 'cache'))
+
+
+class TestCacheKey:
+    def test_stable(self):
+        assert K.cache_key({'a': 1, 'b': [2]}, 'x') == K.cache_key(
+            {'b': [2], 'a': 1}, 'x')
+
+    def test_distinct(self):
+        assert K.cache_key('x') != K.cache_key('y')
+
+    def test_compiler_version(self):
+        assert len(K.compiler_version()) == 64
+
+
+class TestCompilationCache:
+    def test_miss_then_hit(self, cache):
+        assert cache.get('suite', K.cache_key('x')) is None
+        cache.put('suite', K.cache_key('x'), {'states': [1, 2]})
+        assert cache.get('suite', K.cache_key('x')) == {'states': [1, 2]}
+        assert cache.hits['suite'] == 1
+        assert cache.misses['suite'] == 1
+        assert cache.n_stored == 1
+
+    def test_corrupt_entry_is_miss(self, cache):
+        key = K.cache_key('x')
+        cache.put('machine', key, {})
+        with open(cache.entry_path('machine', key), 'wt') as f_out:
+            f_out.write('{"trunc')
+        assert cache.get('machine', key) is None
+
+    def test_evict_by_age(self, cache):
+        for i, age in enumerate([10, 1000, 5]):
+            key = K.cache_key(i)
+            cache.put('suite', key, {'i': i})
+            mtime = 1e9 - age
+            os.utime(cache.entry_path('suite', key), (mtime, mtime))
+        cache.max_age_seconds = 100
+        cache.evict(now=1e9)
+        assert cache.n_evicted == 1
+        assert cache.get('suite', K.cache_key(1)) is None
+        assert cache.get('suite', K.cache_key(0)) == {'i': 0}
+
+    def test_evict_by_size(self, cache):
+        for i in range(4):
+            key = K.cache_key(i)
+            cache.put('suite', key, {'payload': 'x' * 100})
+            mtime = 1e9 + i
+            os.utime(cache.entry_path('suite', key), (mtime, mtime))
+        entry_size = os.path.getsize(cache.entry_path('suite', K.cache_key(0)))
+        cache.max_bytes = 2 * entry_size
+        cache.evict(now=1e9)
+        # The two least recently used have gone.
+        assert [cache.get('suite', K.cache_key(i)) is not None
+                for i in range(4)] == [False, False, True, True]
+
+    def test_summary_lines(self, cache):
+        cache.get('machine', K.cache_key('x'))
+        lines = list(cache.summary_lines())
+        assert lines == ['cache machine: 0 hits, 1 misses',
+                         'cache: 0 stored, 0 evicted']
+
+    def test_pickle(self, cache):
+        cache.get('machine', K.cache_key('x'))
+        copied = pickle.loads(pickle.dumps(cache))
+        assert copied.directory == cache.directory
+        assert copied.misses == cache.misses
+        copied.put('machine', K.cache_key('x'), {})
+        assert cache.get('machine', K.cache_key('x')) == {}
@@ -0,0 +1,275 @@
+import pytest
+from pysfn import definition as PSF
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .helpers import Flaky
+
+
+@pytest.fixture
+def items_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('PYSFN_ITEMS_DIR', str(tmp_path))
+    (tmp_path / 'data').mkdir()
+    return tmp_path / 'data'
+
+
+class TestItemsFrom:
+    def test_jsonl(self, items_dir):
+        items = [{'n': 1}, [2, 3], 'four']
+        (items_dir / 'items.jsonl').write_text(
+            '\n'.join(json.dumps(x) for x in items) + '\n\n')
+        assert list(PSF.items_from('s3://data/items.jsonl')) == items
+
+    def test_csv(self, items_dir):
+        (items_dir / 'rows.csv').write_text('a,b\n1,"x,y"\n2,z\n')
+        assert list(PSF.items_from('s3://data/rows.csv')) == [
+            {'a': '1', 'b': 'x,y'}, {'a': '2', 'b': 'z'}]
+
+    def test_json(self, items_dir):
+        (items_dir / 'items.json').write_text('[1, 2, 3]')
+        assert list(PSF.items_from('s3://data/items.json')) == [1, 2, 3]
+
+    def test_explicit_input_type(self, items_dir):
+        (items_dir / 'items').write_text('1\n2\n')
+        assert list(PSF.items_from('s3://data/items',
+                                   input_type='JSONL')) == [1, 2]
+
+    def test_lazy(self, items_dir):
+        (items_dir / 'items.jsonl').write_text('1\nnot JSON\n')
+        items = PSF.items_from('s3://data/items.jsonl')
+        assert next(items) == 1
+        with pytest.raises(ValueError):
+            next(items)
+
+    def test_with_map(self, items_dir):
+        (items_dir / 'items.jsonl').write_text('1\n2\n3\n')
+        assert PSF.map(lambda x: 10 * x,
+                       PSF.items_from('s3://data/items.jsonl')) \
+            == [10, 20, 30]
+
+    @pytest.mark.parametrize('uri', ['data/items.jsonl', 's3://data',
+                                     's3:///items.jsonl'])
+    def test_bad_uri(self, uri):
+        with pytest.raises(ValueError, match='s3://bucket/key'):
+            next(PSF.items_from(uri))
+
+    def test_unknown_input_type(self):
+        with pytest.raises(ValueError, match='input_type'):
+            next(PSF.items_from('s3://data/items.xml'))
+
+
+def square_of_three():
+    return 9
+
+
+def cube_of_two():
+    return 8
+
+
+@pytest.fixture
+def parallel_executor():
+    previous = PSF.set_parallel_executor(None)
+    yield PSF.set_parallel_executor
+    PSF.set_parallel_executor(previous)
+
+
+class TestParallel:
+    def test_concurrent(self, parallel_executor):
+        # Each branch waits for the other, so this only finishes if they
+        # run at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def branch(x):
+            return lambda: (barrier.wait(), x)[1]
+
+        assert PSF.parallel(branch('a'), branch('b')) == ['a', 'b']
+
+    def test_order(self, parallel_executor):
+        def branch(delay, x):
+            return lambda: (time.sleep(delay), x)[1]
+
+        assert PSF.parallel(branch(0.05, 1), branch(0, 2)) == [1, 2]
+
+    def test_first_failure(self, parallel_executor):
+        def slow_failure():
+            time.sleep(0.2)
+            raise KeyError('slow')
+
+        def fast_failure():
+            raise ValueError('fast')
+
+        with pytest.raises(ValueError, match='fast'):
+            PSF.parallel(slow_failure, fast_failure)
+
+    @pytest.mark.parametrize('set_by_env', [False, True])
+    def test_serial(self, parallel_executor, monkeypatch, set_by_env):
+        if set_by_env:
+            monkeypatch.setenv('PYSFN_PARALLEL', 'serial')
+        else:
+            parallel_executor('serial')
+        threads = []
+
+        def branch():
+            threads.append(threading.current_thread())
+
+        PSF.parallel(branch, branch)
+        assert threads == [threading.current_thread()] * 2
+
+    def test_process_pool(self, parallel_executor):
+        with ProcessPoolExecutor(2) as pool:
+            parallel_executor(pool)
+            assert PSF.parallel(square_of_three, cube_of_two) == [9, 8]
+
+    def test_unknown_executor(self, parallel_executor):
+        parallel_executor('fibers')
+        with pytest.raises(ValueError, match='fibers'):
+            PSF.parallel(square_of_three, cube_of_two)
+
+    def test_coroutines(self):
+        event = asyncio.Event()
+
+        async def waiter():
+            await asyncio.wait_for(event.wait(), 5)
+            return 'waited'
+
+        async def setter():
+            event.set()
+            return 'set'
+
+        assert PSF.parallel(waiter, setter, square_of_three) \
+            == ['waited', 'set', 9]
+
+    def test_coroutine_failure(self):
+        async def failure():
+            raise ValueError('async')
+
+        async def success():
+            return 1
+
+        with pytest.raises(ValueError, match='async'):
+            PSF.parallel(success, failure)
+
+    def test_coroutines_within_running_loop(self):
+        async def branch():
+            return 42
+
+        async def main():
+            return PSF.parallel(branch, branch)
+
+        assert asyncio.run(main()) == [42, 42]
+
+
+class TransientError(Exception):
+    pass
+
+
+class TestRetrySpec:
+    @pytest.mark.parametrize('error_equals, error, expected',
+                             [(['States.ALL'], 'KeyError', True),
+                              (['States.ALL'], 'States.Runtime', False),
+                              (['States.TaskFailed'], 'KeyError', True),
+                              (['States.TaskFailed'], 'States.Timeout',
+                               False),
+                              (['States.TaskFailed'],
+                               'States.Permissions', True),
+                              (['States.TaskFailed'],
+                               'States.ResultPathMatchFailure', True),
+                              (['States.TaskFailed'], 'States.Runtime',
+                               False),
+                              (['ValueError'], 'KeyError', False)])
+    def test_error_matches(self, error_equals, error, expected):
+        assert PSF.error_matches(error_equals, error) == expected
+
+    def test_no_failure(self):
+        with PSF.VirtualClock() as clock:
+            assert PSF.with_retry_spec(Flaky(), ()) == 1
+        assert clock.sleeps == []
+
+    def test_retries(self):
+        fun = Flaky(TransientError(), TransientError(), TransientError())
+        with PSF.VirtualClock() as clock:
+            assert PSF.with_retry_spec(
+                fun, (), (['TransientError'], 1, 3, 2.0)) == 4
+        assert clock.sleeps == [1, 2.0, 4.0]
+        assert clock.now == 7.0
+
+    def test_exhausted(self):
+        fun = Flaky(*[TransientError()] * 3)
+        with PSF.VirtualClock() as clock:
+            with pytest.raises(TransientError):
+                PSF.with_retry_spec(fun, (), (['States.ALL'], 0.5, 2, 1.5))
+        assert fun.n_calls == 3
+        assert clock.sleeps == [0.5, 0.75]
+
+    def test_unmatched(self):
+        fun = Flaky(KeyError('k'))
+        with PSF.VirtualClock() as clock:
+            with pytest.raises(KeyError):
+                PSF.with_retry_spec(fun, (), (['TransientError'], 1, 3, 2.0))
+        assert clock.sleeps == []
+
+    def test_first_matching_spec_decides(self):
+        fun = Flaky(TransientError(), KeyError('k'), TransientError())
+        specs = [(['TransientError'], 1, 1, 2.0),
+                 (['States.ALL'], 10, 5, 1.0)]
+        with PSF.VirtualClock() as clock:
+            with pytest.raises(TransientError):
+                PSF.with_retry_spec(fun, (), *specs)
+        # The second TransientError finds its spec already used up, even
+        # though the catch-all spec has attempts left.
+        assert clock.sleeps == [1, 10]
+
+    def test_arguments(self):
+        with PSF.VirtualClock():
+            assert PSF.with_retry_spec(lambda x, y: x + y, (2, 3)) == 5
+
+    def test_clock_restored(self):
+        previous = PSF.set_clock(None)
+        try:
+            with PSF.VirtualClock() as outer:
+                with PSF.VirtualClock() as inner:
+                    assert PSF.set_clock(inner) is inner
+                assert PSF.set_clock(outer) is outer
+            assert PSF.set_clock(None) is None
+        finally:
+            PSF.set_clock(previous)
+
+    def test_many_scenarios_instantly(self):
+        t0 = time.perf_counter()
+        with PSF.VirtualClock() as clock:
+            for _ in range(1000):
+                PSF.with_retry_spec(Flaky(*[TransientError()] * 5), (),
+                                    (['States.TaskFailed'], 60, 5, 2.0))
+        assert time.perf_counter() - t0 < 5
+        assert clock.now == 1000 * 60 * (1 + 2 + 4 + 8 + 16)
+
+    @pytest.mark.parametrize('executor', ['threads', 'serial'])
+    def test_parallel_branches_own_clocks(self, parallel_executor, executor):
+        parallel_executor(executor)
+
+        def branch(n_failures):
+            fun = Flaky(*[TransientError()] * n_failures)
+            return lambda: PSF.with_retry_spec(
+                fun, (), (['TransientError'], 1, 5, 2.0))
+
+        with PSF.VirtualClock(10.0) as clock:
+            assert PSF.parallel(branch(3), branch(1), branch(0)) == [4, 2, 1]
+        # The branches' waits overlap, so take as long as the longest.
+        assert clock.now == 10.0 + 1 + 2 + 4
+        assert clock.sleeps == [1, 2.0, 4.0, 1]
+
+    def test_nested_parallel_clocks(self, parallel_executor):
+        def retried():
+            return PSF.with_retry_spec(Flaky(TransientError()), (),
+                                       (['TransientError'], 3, 1, 1.0))
+
+        def waits_twice():
+            return [retried(), retried()]
+
+        with PSF.VirtualClock() as clock:
+            PSF.parallel(lambda: PSF.parallel(retried, waits_twice), retried)
+        assert clock.now == 6
+        assert len(clock.sleeps) == 4
@@ -0,0 +1,134 @@
+import pytest
+from pysfn.tools import emit as E
+from pysfn.tools import compile as C
+from click.testing import CliRunner
+import io
+import json
+import os.path
+
+
+example_fname = os.path.join(os.path.dirname(__file__),
+                             '..', 'examples', 'analyse_text.py')
+
+
+@pytest.fixture(scope='module')
+def example_obj():
+    with open(os.path.join(os.path.dirname(example_fname),
+                           'stepfun.json')) as f_in:
+        return json.load(f_in)
+
+
+def emitted(obj, **kwargs):
+    f_out = io.StringIO()
+    emitter = E.StateMachineEmitter(f_out, **kwargs)
+    emitter.emit(obj['States'].items(), obj['StartAt'])
+    return f_out.getvalue(), emitter
+
+
+class TestEmitter:
+    @pytest.mark.parametrize('buffer_bytes', [65536, 10])
+    def test_indented(self, example_obj, buffer_bytes):
+        text, emitter = emitted(example_obj, buffer_bytes=buffer_bytes)
+        assert text == json.dumps(example_obj, indent=2) + '\n'
+        assert emitter.n_bytes == len(text)
+        assert len(emitter.state_sizes) == len(example_obj['States'])
+
+    def test_minified(self, example_obj):
+        text, emitter = emitted(example_obj, minify=True)
+        assert text == json.dumps(example_obj, separators=(',', ':')) + '\n'
+        assert emitter.n_bytes == len(text)
+
+    def test_non_ascii(self):
+        obj = {'States': {'n0': {'Type': 'Fail', 'Cause': 'café ☕'}},
+               'StartAt': 'n0'}
+        text, emitter = emitted(obj)
+        assert json.loads(text) == obj
+        assert emitter.n_bytes == len(text.encode('utf-8'))
+
+    def test_state_sizes(self, example_obj):
+        _, emitter = emitted(example_obj, minify=True)
+        sizes = {name: n_bytes for name, _, n_bytes in emitter.state_sizes}
+        assert sizes['n0'] == len('"n0":' + json.dumps(
+            example_obj['States']['n0'], separators=(',', ':')))
+
+    @pytest.mark.parametrize('buffer_bytes', [65536, 10])
+    def test_too_large(self, example_obj, buffer_bytes):
+        f_out = io.StringIO()
+        emitter = E.StateMachineEmitter(f_out, max_bytes=2000,
+                                        buffer_bytes=buffer_bytes)
+        with pytest.raises(E.DefinitionTooLargeError) as exc_info:
+            emitter.emit(example_obj['States'].items(),
+                         example_obj['StartAt'])
+        err = exc_info.value
+        assert err.n_bytes > 2000
+        full_text = json.dumps(example_obj, indent=2)
+        assert full_text.startswith(f_out.getvalue())
+        lines = list(err.breakdown_lines(n_largest=2))
+        assert lines[0] == 'largest states:'
+        assert 'n11 (Parallel)' in lines[1]
+        assert len(lines) == 3
+
+    def test_limit_is_on_minified_size(self, example_obj):
+        minified_size = len(json.dumps(example_obj, separators=(',', ':')))
+        text, emitter = emitted(example_obj, max_bytes=minified_size)
+        assert len(text) > minified_size
+        assert emitter.n_minified_bytes == minified_size
+        with pytest.raises(E.DefinitionTooLargeError):
+            emitted(example_obj, max_bytes=minified_size - 1)
+
+    def test_no_limit(self, example_obj):
+        _, emitter = emitted(example_obj, max_bytes=None)
+        assert 'limit' not in emitter.summary_line()
+
+    def test_emit_to_file(self, example_obj, tmp_path):
+        fname = str(tmp_path / 'machine.json')
+        E.emit_to_file(fname, example_obj['States'].items(),
+                       example_obj['StartAt'])
+        with open(fname) as f_in:
+            assert json.load(f_in) == example_obj
+        with pytest.raises(E.DefinitionTooLargeError):
+            E.emit_to_file(str(tmp_path / 'big.json'),
+                           example_obj['States'].items(),
+                           example_obj['StartAt'], max_bytes=100)
+        assert os.listdir(str(tmp_path)) == ['machine.json']
+
+    def test_emit_to_stream(self, example_obj):
+        f_out = io.StringIO()
+        E.emit_to_stream(f_out, example_obj['States'].items(),
+                         example_obj['StartAt'])
+        assert json.loads(f_out.getvalue()) == example_obj
+        f_out = io.StringIO()
+        with pytest.raises(E.DefinitionTooLargeError):
+            E.emit_to_stream(f_out, example_obj['States'].items(),
+                             example_obj['StartAt'], max_bytes=2000)
+        assert f_out.getvalue() == ''
+
+
+class TestCommand:
+    def test_minify_and_output(self, example_obj, tmp_path):
+        fname = str(tmp_path / 'out.json')
+        result = CliRunner().invoke(
+            C.main, [example_fname, 'LAMBDA-FUN-ARN', '--minify',
+                     '-o', fname, '--size-report'])
+        assert result.exit_code == 0
+        with open(fname) as f_in:
+            text = f_in.read()
+        assert json.loads(text) == example_obj
+        assert 'definition: {} bytes'.format(len(text)) in result.stderr
+
+    def test_too_large(self, tmp_path):
+        fname = str(tmp_path / 'out.json')
+        result = CliRunner().invoke(
+            C.main, [example_fname, 'LAMBDA-FUN-ARN',
+                     '--max-definition-bytes', '1000', '-o', fname])
+        assert result.exit_code == 1
+        assert 'exceeds 1000 bytes' in result.stderr
+        assert 'largest states:' in result.stderr
+        assert not os.path.exists(fname)
+
+    def test_too_large_to_stdout(self):
+        result = CliRunner().invoke(
+            C.main, [example_fname, 'LAMBDA-FUN-ARN',
+                     '--max-definition-bytes', '1000'])
+        assert result.exit_code == 1
+        assert result.stdout == ''
@@ -0,0 +1,101 @@
+import pytest
+from pysfn import encoding as E
+import array
+import json
+import typing
+
+
+class TestAnnotationKind:
+    @pytest.mark.parametrize(
+        'annotation, kind',
+        [(bytes, 'bytes'), ('bytearray', 'bytes'),
+         (array.array, 'array'), ('array.array', 'array'),
+         (list[int], 'int_list'), (typing.List[int], 'int_list'),
+         ('typing.Sequence[float]', 'float_list'),
+         (dict, 'dict'), (typing.Dict[str, int], 'dict'),
+         ('dict[str, list[int]]', 'dict'),
+         (str, None), (list, None), (list[str], None), ('Thing', None)])
+    def test_kind(self, annotation, kind):
+        assert E.annotation_kind(annotation) == kind
+
+    def test_encoder(self):
+        assert E.encoder(bytes) is E.encoded_bytes
+        assert E.encoder(str) is None
+
+
+def round_trip(annotation, value, opaque=True, threshold=100):
+    encoded = E.encoder(annotation)(value, opaque, threshold)
+    # What goes into the state must be JSON.
+    encoded = json.loads(json.dumps(encoded))
+    return encoded, (E.decoded(encoded) if E.is_encoded(encoded)
+                     else encoded)
+
+
+class TestCodecs:
+    def test_bytes(self):
+        value = bytes(range(256))
+        encoded, decoded = round_trip(bytes, value)
+        assert encoded['pysfn_codec'] == 'bytes'
+        assert 'compression' not in encoded
+        assert decoded == value
+
+    def test_compressible_bytes(self):
+        value = b'abc' * 1000
+        encoded, decoded = round_trip(bytes, bytearray(value))
+        assert encoded['compression'] == 'zlib'
+        assert len(encoded['data']) < 100
+        assert decoded == value
+
+    def test_array(self):
+        value = array.array('f', [1.5, -2.0, 3.25])
+        encoded, decoded = round_trip(array.array, value)
+        assert encoded['typecode'] == 'f'
+        assert decoded == value
+
+    @pytest.mark.parametrize('values, typecode',
+                             [([1, -128, 127], 'b'),
+                              ([0, 40000], 'i'),
+                              ([-2 ** 63, 2 ** 63 - 1], 'q')])
+    def test_int_list(self, values, typecode):
+        encoded, decoded = round_trip(list[int], values)
+        # The narrowest which holds them ('l' may be as wide as 'q').
+        assert (array.array(encoded['typecode']).itemsize
+                == array.array(typecode).itemsize)
+        assert decoded == values
+        assert type(decoded) is list
+
+    def test_float_list(self):
+        values = [i / 7 for i in range(1000)]
+        encoded, decoded = round_trip(list[float], values)
+        assert len(json.dumps(encoded)) < len(json.dumps(values))
+        assert decoded == values
+
+    @pytest.mark.parametrize('values', [[2 ** 64], [1, True], [], 'abc'])
+    def test_int_list_kept(self, values):
+        encoded, decoded = round_trip(list[int], values)
+        assert encoded == values
+
+    def test_list_kept_unless_opaque(self):
+        assert E.encoded_float_list([1.0], False, 100) == [1.0]
+
+    def test_dict(self):
+        value = {'rows': [{'name': 'row {}'.format(i), 'n': i}
+                          for i in range(100)]}
+        encoded, decoded = round_trip(dict, value)
+        assert encoded['pysfn_codec'] == 'json'
+        assert encoded['compression'] in ('zstd', 'gzip')
+        assert len(encoded['data']) < len(json.dumps(value)) / 4
+        assert decoded == value
+
+    def test_dict_kept(self):
+        small = {'a': 1}
+        assert round_trip(dict, small)[0] == small
+        large = {'a': 'x' * 1000}
+        assert round_trip(dict, large, opaque=False)[0] == large
+
+    def test_wrong_type_kept(self):
+        assert round_trip(bytes, 'text')[0] == 'text'
+
+    def test_unknown_codec(self):
+        with pytest.raises(ValueError, match='unknown codec'):
+            E.decoded({'pysfn_codec': 'pickle', 'data': ''})
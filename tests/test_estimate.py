@@ -0,0 +1,164 @@
+import pytest
+from pysfn.tools import estimate as E
+from click.testing import CliRunner
+import json
+import os.path
+
+from .helpers import definition, succeed, call_task, choice
+
+
+example_fname = os.path.join(os.path.dirname(__file__),
+                             '..', 'examples', 'analyse_text.py')
+
+
+class TestEstimator:
+    def test_chain(self):
+        defn = definition('a', a=call_task('f', 'b'), b=call_task('g', 's'),
+                          s=succeed())
+        estimator = E.Estimator(latencies={'f': 0.5, 'g': 0.25})
+        est = estimator.definition_estimate(defn)
+        assert est.least == est.greatest == est.expected
+        assert est.expected == E.Cost(3, 2, 0.75, 3)
+
+    def test_choice(self):
+        defn = definition('c', c=choice('a', default='s'),
+                          a=call_task('f', 's'), s=succeed())
+        est = E.Estimator().definition_estimate(defn)
+        assert est.least.transitions == 2
+        assert est.greatest.transitions == 3
+        assert est.expected.transitions == pytest.approx(2.5)
+
+    def test_choice_probabilities(self):
+        defn = definition('c', c=choice('a', 'b', default='s'),
+                          a=call_task('f', 's'), b=call_task('f', 's'),
+                          s=succeed())
+        estimator = E.Estimator(probabilities={'c': {'a': 0.8}})
+        est = estimator.definition_estimate(defn)
+        # 'b' and 's' share the remaining 0.2.
+        assert est.expected.invocations == pytest.approx(0.9)
+
+    def test_catch(self):
+        defn = definition(
+            'a', a=call_task('f', 's', Catch=[{'ErrorEquals': ['E'],
+                                                'Next': 'h'}]),
+            h=call_task('g', 's'), s=succeed())
+        assert (E.Estimator().definition_estimate(defn).expected.invocations
+                == 1)
+        estimator = E.Estimator(probabilities={'a': {'h': 0.25}})
+        est = estimator.definition_estimate(defn)
+        assert est.expected.invocations == pytest.approx(1.25)
+        assert est.greatest.invocations == 2
+
+    def test_retry(self):
+        defn = definition('a', a=call_task(
+            'f', Retry=[{'ErrorEquals': ['E'], 'IntervalSeconds': 1,
+                         'MaxAttempts': 2, 'BackoffRate': 3.0}],
+            End=True))
+        est = E.Estimator(latencies={'f': 0.5}).definition_estimate(defn)
+        assert est.least == est.expected == E.Cost(1, 1, 0.5, 1)
+        assert est.greatest == E.Cost(3, 3, 1.5 + 1 + 3, 1)
+
+    def test_pass_call_descriptor(self):
+        defn = definition(
+            'p', p={'Type': 'Pass', 'ResultPath': '$.call_descr',
+                    'Result': {'function': 'f', 'arg_names': []},
+                    'Next': 't'},
+            t={'Type': 'Task', 'Resource': 'arn:...', 'End': True})
+        est = E.Estimator(latencies={'f': 2.0}).definition_estimate(defn)
+        assert est.expected == E.Cost(2, 1, 2.0, 2)
+
+    def test_fused_calls(self):
+        defn = definition('t', t={
+            'Type': 'Task', 'Resource': 'arn:...', 'End': True,
+            'Parameters': {'call_descr': {'calls': [
+                {'function': 'f'}, {'function': 'g'}]}}})
+        estimator = E.Estimator(latencies={'f': 1.0, 'g': 2.0})
+        assert estimator.definition_estimate(defn).expected.latency == 3.0
+
+    def test_parallel(self):
+        branches = [definition('a', a=call_task('f', End=True)),
+                    definition('b', b=call_task('g', 'c'),
+                               c=call_task('g', End=True))]
+        defn = definition('p', p={'Type': 'Parallel', 'Branches': branches,
+                                  'Next': 's'},
+                          s=succeed())
+        est = E.Estimator(latencies={'f': 5.0, 'g': 1.0}) \
+            .definition_estimate(defn)
+        assert est.expected == E.Cost(5, 3, 5.0, 4)
+
+    @pytest.mark.parametrize('max_concurrency, n_rounds',
+                             [(0, 1), (3, 4), (10, 1)])
+    def test_map(self, max_concurrency, n_rounds):
+        value = {'Type': 'Map', 'ItemsPath': '$.locals.xs',
+                 'ItemSelector': {'call_descr': {'function': 'f',
+                                                 'arg_names': ['item']}},
+                 'ItemProcessor': definition('t', t={
+                     'Type': 'Task', 'Resource': 'arn:...', 'End': True}),
+                 'End': True}
+        if max_concurrency:
+            value['MaxConcurrency'] = max_concurrency
+        estimator = E.Estimator(latencies={'f': 1.0}, map_items=10)
+        est = estimator.definition_estimate(definition('m', m=value))
+        assert est.expected == E.Cost(11, 10, float(n_rounds), 1 + n_rounds)
+
+    def test_loop(self):
+        defn = definition('c1', c1=choice('c2', default='s'),
+                          c2=choice('c1', default='s'), s=succeed())
+        with pytest.raises(ValueError, match='loop'):
+            E.Estimator().definition_estimate(defn)
+
+    @pytest.mark.parametrize('probabilities, match',
+                             [({'c': {'x': 0.5}}, 'no successor'),
+                              ({'c': {'a': 0.8, 's': 0.8}}, 'more than 1')])
+    def test_bad_probabilities(self, probabilities, match):
+        defn = definition('c', c=choice('a', default='s'),
+                          a=call_task('f', 's'), s=succeed())
+        with pytest.raises(ValueError, match=match):
+            E.Estimator(probabilities).definition_estimate(defn)
+
+
+class TestRegressions:
+    def report(self, n_transitions):
+        return E.Estimate.exact(E.Cost(n_transitions, 1, 0.0, 1)) \
+            .as_json_obj()
+
+    def test_none(self):
+        assert list(E.regressions(self.report(10), self.report(10))) == []
+        assert list(E.regressions(self.report(9), self.report(10))) == []
+
+    def test_growth(self):
+        found = list(E.regressions(self.report(11), self.report(10)))
+        assert found == ['min transitions: 10 -> 11',
+                         'max transitions: 10 -> 11',
+                         'expected transitions: 10 -> 11']
+
+    def test_tolerance(self):
+        assert list(E.regressions(self.report(11), self.report(10),
+                                  tolerance=0.1)) == []
+
+
+class TestCommand:
+    def test_report(self):
+        result = CliRunner().invoke(E.main, [example_fname, 'arn:...'])
+        assert result.exit_code == 0
+        assert result.output.startswith('transitions: min 3, max 17,')
+
+    def test_baseline_gate(self, tmp_path):
+        baseline = str(tmp_path / 'baseline.json')
+        runner = CliRunner()
+        result = runner.invoke(E.main, [example_fname, 'arn:...', '--json',
+                                        '--compact-calls',
+                                        '--write-baseline', baseline])
+        assert result.exit_code == 0
+        assert json.loads(result.stdout) == json.load(open(baseline))
+
+        result = runner.invoke(E.main, [example_fname, 'arn:...',
+                                        '--compact-calls',
+                                        '--baseline', baseline])
+        assert result.exit_code == 0
+
+        # Without compact calls, each call costs an extra transition.
+        result = runner.invoke(E.main, [example_fname, 'arn:...',
+                                        '--baseline', baseline])
+        assert result.exit_code == 1
+        assert 'regression: max transitions: 12 -> 17' in result.stderr
@@ -0,0 +1,467 @@
+import pytest
+from pysfn.tools import execute as X
+from pysfn.tools import compile as C
+from pysfn.tools.gen_lambda import dispatch_function
+from pysfn import definition as PSF
+from pysfn.blobstore import LocalBlobStore
+from examples import analyse_text as A
+from click.testing import CliRunner
+from concurrent.futures import ThreadPoolExecutor
+import ast
+import os.path
+import textwrap
+
+from .helpers import definition, succeed, task, Flaky, flaky_dispatch
+
+
+example_fname = os.path.join(os.path.dirname(__file__),
+                             '..', 'examples', 'analyse_text.py')
+
+
+@pytest.fixture(scope='module')
+def example_tree():
+    with open(example_fname) as f_in:
+        return ast.parse(f_in.read())
+
+
+@pytest.fixture(scope='module')
+def pool():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+def python_result(text):
+    try:
+        return A.summarise(text)
+    except PSF.Fail as err:
+        return (err.label, err.message)
+
+
+def executed_result(executor, text):
+    try:
+        return executor.execute({'locals': {'text': text}})
+    except X.StatesError as err:
+        return (err.error, err.cause)
+
+
+class TestExample:
+    @pytest.mark.parametrize(
+        'options',
+        [{},
+         {'compact_calls': True},
+         {'fuse_calls': True, 'prune_locals': True},
+         {'auto_parallel': 'all'},
+         {'merge_states': True}])
+    @pytest.mark.parametrize('use_pool', [False, True])
+    def test_matches_python(self, example_tree, pool, options, use_pool):
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch',
+                                       **options)
+        executor = X.Executor(xln_ctx.state_machine_json_obj(example_tree),
+                              dispatch_function(A),
+                              pool if use_pool else None)
+        for text in ['a short example', 'bother', 'choose wisely', '',
+                     'do not handle starting with "d"']:
+            assert executed_result(executor, text) == python_result(text)
+
+    def test_command(self):
+        result = CliRunner().invoke(X.main, [
+            example_fname, '--input', '{"locals": {"text": "choose"}}'])
+        assert result.exit_code == 0
+        assert result.stdout == '"text starts with \\"c\\"; look: \\"c\\""\n'
+
+    def test_command_failure(self):
+        result = CliRunner().invoke(X.main, [
+            example_fname, '--input', '{"locals": {"text": ""}}'])
+        assert result.exit_code == 1
+        assert 'MalformedText: text too short' in result.stderr
+
+
+class TestExecutor:
+    retry = [{'ErrorEquals': ['RuntimeError'], 'IntervalSeconds': 2,
+              'MaxAttempts': 3, 'BackoffRate': 1.5}]
+
+    @pytest.mark.parametrize('n_failures, succeeds', [(3, True),
+                                                      (4, False)])
+    def test_retry(self, n_failures, succeeds):
+        sleeps = []
+        dispatch = flaky_dispatch(n_failures)
+        executor = X.Executor(
+            definition('t', t=task(Retry=self.retry, End=True)),
+            dispatch, sleep=sleeps.append)
+        if succeeds:
+            assert executor.execute({'x': 42}) == 42
+        else:
+            with pytest.raises(X.StatesError, match='RuntimeError'):
+                executor.execute({'x': 42})
+        assert sleeps == [2, 3.0, 4.5]
+        assert dispatch.n_calls == min(n_failures + 1, 4)
+
+    def test_task_failed_retries_states_errors(self):
+        sleeps = []
+        dispatch = Flaky(X.StatesError('States.Permissions', 'denied'),
+                         result=lambda event, context: event['x'])
+        retry = [{'ErrorEquals': ['States.TaskFailed'],
+                  'IntervalSeconds': 1}]
+        executor = X.Executor(
+            definition('t', t=task(Retry=retry, End=True)),
+            dispatch, sleep=sleeps.append)
+        assert executor.execute({'x': 42}) == 42
+        assert sleeps == [1]
+
+    def test_catch(self):
+        defn = definition(
+            't', t=task(Catch=[{'ErrorEquals': ['States.ALL'],
+                                'ResultPath': '$.error', 'Next': 's'}],
+                        End=True),
+            s={'Type': 'Succeed'})
+        output = X.Executor(defn, flaky_dispatch(1, KeyError)).execute(
+            {'x': 1})
+        assert output == {'x': 1, 'error': {'Error': 'KeyError',
+                                            'Cause': "'try again'"}}
+
+    def test_parallel_error(self, pool):
+        branches = [definition('a', a=task(End=True)),
+                    definition('b', b={'Type': 'Fail', 'Error': 'Bad',
+                                       'Cause': 'branch'})]
+        defn = definition('p', p={'Type': 'Parallel', 'Branches': branches,
+                                  'End': True})
+        with pytest.raises(X.StatesError, match='Bad: branch'):
+            X.Executor(defn, flaky_dispatch(0), pool).execute({'x': 1})
+
+    def test_result_selector_and_paths(self):
+        defn = definition('t', t=task(
+            InputPath='$.in', Parameters={'x.$': '$.v', 'k': 'lit'},
+            ResultSelector={'got.$': '$', 'both.$': 'States.Array($, 1)'},
+            ResultPath='$.out.r', OutputPath='$.out', End=True))
+        output = X.Executor(defn, flaky_dispatch(0)).execute(
+            {'in': {'v': [7]}})
+        assert output == {'r': {'got': [7], 'both': [[7], 1]}}
+
+    def test_unserialisable_result(self):
+        defn = definition('t', t=task(End=True))
+        with pytest.raises(X.StatesError, match='TypeError'):
+            X.Executor(defn, lambda event, context: {1, 2}).execute({})
+
+
+class TestAsyncBranches:
+    source = textwrap.dedent("""
+    import asyncio
+    import pysfn as PSF
+
+    async def fetch(x):
+        await asyncio.sleep(0)
+        return x + 1
+
+    def add(a, b):
+        return a + b
+
+    @PSF.main
+    def main(x):
+        async def left():
+            y = await fetch(x)
+            return y
+        async def right():
+            y = await fetch(x)
+            return y
+        ys = PSF.parallel(left, right)
+        return ys
+    """)
+
+    def test_async_branches(self, tmp_path):
+        fname = tmp_path / 'fetcher.py'
+        fname.write_text(self.source)
+        module = X.load_module(str(fname))
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch')
+        defn = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        executor = X.Executor(defn, dispatch_function(module))
+        assert executor.execute({'locals': {'x': 1}}) == module.main(1) \
+            == [2, 2]
+
+
+class TestMap:
+    source = textwrap.dedent("""
+    import pysfn as PSF
+
+    def double(x):
+        return 2 * x
+
+    def total(ys):
+        return sum(ys)
+
+    @PSF.main
+    def main(xs):
+        ys = PSF.map(double, xs, max_concurrency=2)
+        t = total(ys)
+        return t
+    """)
+
+    @pytest.mark.parametrize('use_pool', [False, True])
+    def test_map(self, tmp_path, pool, use_pool):
+        fname = tmp_path / 'mapper.py'
+        fname.write_text(self.source)
+        module = X.load_module(str(fname))
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch')
+        defn = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        executor = X.Executor(defn, dispatch_function(module),
+                              pool if use_pool else None)
+        xs = list(range(7))
+        assert executor.execute({'locals': {'xs': xs}}) == module.main(xs)
+
+    def test_item_reader(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('PYSFN_ITEMS_DIR', str(tmp_path))
+        (tmp_path / 'b').mkdir()
+        (tmp_path / 'b' / 'items.jsonl').write_text('1\n2\n3\n')
+        processor = definition('t', t=task(End=True))
+        defn = definition('m', m={
+            'Type': 'Map',
+            'ItemReader': {'Resource': 'arn:aws:states:::s3:getObject',
+                           'ReaderConfig': {'InputType': 'JSONL'},
+                           'Parameters': {'Bucket': 'b',
+                                          'Key': 'items.jsonl'}},
+            'ItemSelector': {'x.$': '$$.Map.Item.Value',
+                             'i.$': '$$.Map.Item.Index'},
+            'ItemProcessor': processor,
+            'ResultPath': '$.ys', 'End': True})
+        output = X.Executor(defn, flaky_dispatch(0)).execute({})
+        assert output == {'ys': [1, 2, 3]}
+
+
+class TestOffload:
+    source = textwrap.dedent("""
+    import pysfn as PSF
+
+    def make_text(n):
+        return 'word ' * n
+
+    def summary(text):
+        n_words = len(text.split())
+        return {'n_words': n_words,
+                'kind': 'long' if n_words > 20 else 'short'}
+
+    def kind_of(s):
+        return s['kind']
+
+    def first_words(text):
+        return text.split()[:3]
+
+    def shout(w):
+        return w.upper() * 40
+
+    def joined(ws):
+        return '-'.join(w[:4] for w in ws)
+
+    @PSF.main
+    def main(n):
+        text = make_text(n)
+        s = summary(text)
+        kind = kind_of(s)
+        if PSF.StringEquals(kind, 'long'):
+            ws = first_words(text)
+            us = PSF.map(shout, ws)
+            r = joined(us)
+            return r
+        else:
+            return kind
+    """)
+
+    def test_offloaded_calls(self):
+        xln_ctx = C.TranslationContext('arn:...', offload_values=True)
+        defn = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        descrs = {}
+        pending = [defn]
+        while pending:
+            for value in pending.pop()['States'].values():
+                if value.get('ResultPath') == '$.call_descr':
+                    descrs[value['Result']['function']] = value['Result']
+                if 'ItemSelector' in value:
+                    descr = value['ItemSelector']['call_descr']
+                    descrs[descr['function']] = descr
+                    pending.append(value['ItemProcessor'])
+        offloaded = {f for f, d in descrs.items() if d.get('offload')}
+        # The results read by the Choice, as Map items, or returned stay.
+        assert offloaded == {'make_text', 'summary', 'shout'}
+
+    @pytest.mark.parametrize('options', [{}, {'compact_calls': True},
+                                         {'fuse_calls': True,
+                                          'prune_locals': True}])
+    def test_matches_python(self, tmp_path, monkeypatch, options):
+        fname = tmp_path / 'offloader.py'
+        fname.write_text(self.source)
+        module = X.load_module(str(fname))
+        xln_ctx = C.TranslationContext('arn:...', offload_values=True,
+                                       **options)
+        defn = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        monkeypatch.setenv('PYSFN_BLOB_THRESHOLD', '100')
+        store_dir = tmp_path / 'blobs'
+        dispatch = dispatch_function(module,
+                                     blob_store=LocalBlobStore(store_dir))
+        executor = X.Executor(defn, dispatch)
+        for n in [5, 50]:
+            output = executor.execute({'locals': {'n': n}})
+            assert output == module.main(n)
+        # The long text, and the shouted words, went to the store; the
+        # words are all the same, so are stored once.
+        assert len(os.listdir(str(store_dir))) == 2
+
+    @pytest.mark.parametrize('options', [{}, {'compact_calls': True}])
+    def test_repeated_call_read_by_state(self, tmp_path, monkeypatch,
+                                         options):
+        # The same call is made twice, but only the second result is
+        # looked at by the state machine, so only the first may be
+        # offloaded; the two calls must not share their descriptor.
+        source = textwrap.dedent("""
+        import pysfn as PSF
+
+        def f(a):
+            return a * 2
+
+        def g(y):
+            return len(y)
+
+        @PSF.main
+        def main(a):
+            y = f(a)
+            z = g(y)
+            x = f(a)
+            if PSF.StringEquals(x, 'zz'):
+                return z
+            else:
+                return x
+        """)
+        fname = tmp_path / 'repeated.py'
+        fname.write_text(source)
+        module = X.load_module(str(fname))
+        xln_ctx = C.TranslationContext('arn:...', offload_values=True,
+                                       **options)
+        defn = xln_ctx.state_machine_json_obj(ast.parse(source))
+        monkeypatch.setenv('PYSFN_BLOB_THRESHOLD', '1')
+        store_dir = tmp_path / 'blobs'
+        dispatch = dispatch_function(module,
+                                     blob_store=LocalBlobStore(store_dir))
+        executor = X.Executor(defn, dispatch)
+        for a in ['z', 'q']:
+            assert executor.execute({'locals': {'a': a}}) == module.main(a)
+        assert len(os.listdir(str(store_dir))) == 2
+
+
+class TestCodecs:
+    source = textwrap.dedent("""
+    import pysfn as PSF
+
+    def words_of(n):
+        return ['word{}'.format(i) for i in range(n)]
+
+    def encoded(w) -> bytes:
+        return w.encode() * 50
+
+    def lengths(bs) -> list[int]:
+        return [len(b) for b in bs]
+
+    def table(ls) -> dict:
+        return {'rows': [{'i': i, 'n': n} for i, n in enumerate(ls)]}
+
+    def summary(t, bs):
+        return '{} rows, {} bytes'.format(len(t['rows']),
+                                          sum(len(b) for b in bs))
+
+    @PSF.main
+    def main(n):
+        ws = words_of(n)
+        bs = PSF.map(encoded, ws)
+        ls = lengths(bs)
+        t = table(ls)
+        r = summary(t, bs)
+        return r
+    """)
+
+    @pytest.mark.parametrize('options', [{}, {'offload_values': True},
+                                         {'offload_values': True,
+                                          'fuse_calls': True}])
+    def test_matches_python(self, tmp_path, monkeypatch, options):
+        fname = tmp_path / 'coded.py'
+        fname.write_text(self.source)
+        module = X.load_module(str(fname))
+        xln_ctx = C.TranslationContext('arn:...', **options)
+        defn = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        monkeypatch.setenv('PYSFN_COMPRESS_THRESHOLD', '100')
+        executor = X.Executor(defn, dispatch_function(module))
+        for n in [1, 30]:
+            assert (executor.execute({'locals': {'n': n}})
+                    == module.main(n))
+
+
+class TestChoiceRules:
+    obj = {'s': 'abc', 'n': 3, 'b': True, 'z': None,
+           't': '2020-01-01T00:00:00Z', 'm': 5}
+
+    @pytest.mark.parametrize(
+        'rule, expected',
+        [({'Variable': '$.s', 'StringEquals': 'abc'}, True),
+         ({'Variable': '$.s', 'StringLessThan': 'abd'}, True),
+         ({'Variable': '$.s', 'NumericEquals': 3}, False),
+         ({'Variable': '$.n', 'NumericGreaterThanEquals': 3}, True),
+         ({'Variable': '$.n', 'NumericLessThanPath': '$.m'}, True),
+         ({'Variable': '$.b', 'BooleanEquals': True}, True),
+         ({'Variable': '$.b', 'NumericEquals': 1}, False),
+         ({'Variable': '$.t',
+           'TimestampLessThan': '2020-01-01T00:00:01+00:00'}, True),
+         ({'Variable': '$.t',
+           'TimestampEquals': '2020-01-01T01:30:00+01:30'}, True),
+         ({'Variable': '$.t',
+           'TimestampGreaterThan': '2019-12-31T23:59:59.5-00:00'}, True),
+         ({'Variable': '$.t',
+           'TimestampLessThan': '2019-12-31T20:00:00.25-04:00'}, True),
+         ({'Variable': '$.t',
+           'TimestampLessThan': '2019-12-31T20:00:00-04:00'}, False),
+         ({'Variable': '$.z', 'IsNull': True}, True),
+         ({'Variable': '$.missing', 'IsPresent': False}, True),
+         ({'Variable': '$.s', 'StringMatches': 'a*c'}, True),
+         ({'Variable': '$.s', 'StringMatches': 'a\\*c'}, False),
+         ({'Not': {'Variable': '$.n', 'NumericEquals': 3}}, False),
+         ({'Or': [{'Variable': '$.n', 'NumericEquals': 4},
+                  {'Variable': '$.s', 'StringEquals': 'abc'}]}, True),
+         ({'And': [{'Variable': '$.n', 'NumericEquals': 4},
+                   {'Variable': '$.s', 'StringEquals': 'abc'}]}, False)])
+    def test_rule_matches(self, rule, expected):
+        assert X.rule_matches(rule, self.obj) == expected
+
+    @pytest.mark.parametrize('rule', [
+        {'Variable': '$.missing', 'StringEquals': 'x'},
+        {'Variable': '$.missing', 'IsNull': True},
+        {'Not': {'Variable': '$.missing', 'NumericEquals': 3}}])
+    def test_missing_variable(self, rule):
+        with pytest.raises(X.StatesError, match=r"'\$\.missing'") as info:
+            X.rule_matches(rule, self.obj)
+        assert info.value.error == 'States.Runtime'
+
+    def test_missing_variable_fails_execution(self):
+        defn = definition('c', c={'Type': 'Choice',
+                                  'Choices': [{'Variable': '$.locals.x',
+                                               'NumericEquals': 1,
+                                               'Next': 's'}],
+                                  'Default': 's'},
+                          s=succeed())
+        with pytest.raises(X.StatesError) as info:
+            X.Executor(defn, flaky_dispatch(0)).execute({'locals': {}})
+        assert info.value.error == 'States.Runtime'
+
+
+class TestPaths:
+    def test_path_value(self):
+        obj = {'a': {'b': [10, {'c': 'x'}]}}
+        assert X.path_value(obj, '$.a.b[1].c', None) == 'x'
+        assert X.path_value(obj, '$', None) is obj
+        assert X.path_value(None, '$$.Map.Item.Index',
+                            {'Map': {'Item': {'Index': 3}}}) == 3
+
+    def test_missing(self):
+        with pytest.raises(X.StatesError, match='States.Runtime'):
+            X.path_value({}, '$.a', None)
+
+    def test_with_path_value(self):
+        obj = {'locals': {'x': 1}}
+        new = X.with_path_value(obj, '$.locals.y', 2)
+        assert new == {'locals': {'x': 1, 'y': 2}}
+        assert obj == {'locals': {'x': 1}}
+        assert X.with_path_value(obj, None, 2) is obj
+        assert X.with_path_value(obj, '$', 2) == 2
@@ -0,0 +1,363 @@
+import pytest
+from pysfn.tools import gen_lambda as G
+from pysfn.tools import compile as C
+from examples import analyse_text as A
+from click.testing import CliRunner
+import ast
+import importlib.util
+import json
+import subprocess
+import textwrap
+import types
+import os.path
+import sys
+import zipfile
+
+
+code_fname = os.path.join(os.path.dirname(__file__),
+                          '..', 'examples', 'analyse_text.py')
+example_functions = {'get_summary', 'augment_summary', 'get_n_vowels',
+                     'get_n_spaces', 'format_result', 'format_c_result'}
+
+
+@pytest.fixture
+def handler_module(tmp_path):
+    """
+    Build the Lambda zip-file for the example code, unpack it, and
+    import its handler as the Lambda runtime would.
+    """
+    zip_fname = str(tmp_path / 'lambda-function.zip')
+    result = CliRunner().invoke(G.compile_zipfile, [code_fname, zip_fname])
+    assert result.exit_code == 0, result.output
+
+    bundle_dir = tmp_path / 'bundle'
+    with zipfile.ZipFile(zip_fname) as f_zip:
+        f_zip.extractall(bundle_dir)
+
+    sys.path.insert(0, str(bundle_dir))
+    try:
+        spec = importlib.util.spec_from_file_location(
+            'handler', str(bundle_dir / 'handler.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        sys.path.remove(str(bundle_dir))
+        for name in [n for n in sys.modules
+                     if n == 'inner' or n.startswith('inner.')]:
+            del sys.modules[name]
+
+
+class TestDispatch:
+    def test_single_call(self, handler_module):
+        event = {'call_descr': {'function': 'get_summary',
+                                'arg_names': ['text']},
+                 'locals': {'text': 'hello world', 'unused': 42}}
+        assert handler_module.dispatch(event, None) == {'head': 'h'}
+
+    def test_fused_calls(self, handler_module):
+        event = {'call_descr': {'calls': [
+                     {'function': 'get_summary', 'arg_names': ['text'],
+                      'target': 'summary'},
+                     {'function': 'augment_summary',
+                      'arg_names': ['text', 'summary'],
+                      'target': 'summary'},
+                     {'function': 'get_n_vowels', 'arg_names': ['text'],
+                      'target': 'n_vowels'}]},
+                 'locals': {'text': 'hello world'}}
+        assert handler_module.dispatch(event, None) == {
+            'text': 'hello world',
+            'summary': {'head': 'h', 'n_characters': 11},
+            'n_vowels': 3}
+
+    def test_fused_calls_keep_locals(self, handler_module):
+        event = {'call_descr': {'calls': [
+                     {'function': 'get_summary', 'arg_names': ['text'],
+                      'target': 'summary'},
+                     {'function': 'get_n_vowels', 'arg_names': ['text'],
+                      'target': 'n_vowels'}],
+                                'keep_locals': ['n_vowels', 'summary']},
+                 'locals': {'text': 'hello world'}}
+        assert handler_module.dispatch(event, None) == {
+            'summary': {'head': 'h'},
+            'n_vowels': 3}
+
+    def test_exception_propagates(self, handler_module):
+        event = {'call_descr': {'function': 'get_summary',
+                                'arg_names': ['text']},
+                 'locals': {'text': ''}}
+        with pytest.raises(Exception) as exc_info:
+            handler_module.dispatch(event, None)
+        assert type(exc_info.value).__name__ == 'TextTooShortError'
+
+    def test_unreferenced_function(self, handler_module):
+        assert set(handler_module.dispatch_table) == example_functions
+        event = {'call_descr': {'function': 'summarise',
+                                'arg_names': ['text']},
+                 'locals': {'text': 'hello world'}}
+        with pytest.raises(KeyError, match='not called by the state'):
+            handler_module.dispatch(event, None)
+
+    def test_blob_store(self, handler_module, monkeypatch, tmp_path):
+        from pysfn.blobstore import LocalBlobStore
+        store_dir = tmp_path / 'blobs'
+        monkeypatch.setenv('PYSFN_BLOB_STORE', str(store_dir))
+        text_ref = LocalBlobStore(str(store_dir)).offloaded('h' * 50000, 10)
+        event = {'call_descr': {'function': 'augment_summary',
+                                'arg_names': ['text', 'summary'],
+                                'offload': True},
+                 'locals': {'text': text_ref, 'summary': {'head': 'h'}}}
+        try:
+            assert handler_module.dispatch(event, None) == {
+                'head': 'h', 'n_characters': 50000}
+            # The store is the bundle's copy of the module.
+            assert sys.modules['pysfn_blobstore'].__file__.startswith(
+                str(tmp_path / 'bundle'))
+        finally:
+            sys.modules.pop('pysfn_blobstore', None)
+
+    def test_support_modules_bundled(self, handler_module, tmp_path):
+        for name in handler_module.support_modules.values():
+            assert (tmp_path / 'bundle' / (name + '.py')).exists()
+
+    def test_codecs(self):
+        module = types.ModuleType('coded')
+        exec(textwrap.dedent("""
+        def packed(n) -> bytes:
+            return bytes(range(n))
+
+        def counts(data) -> list[int]:
+            return [data.count(b) for b in range(4)]
+
+        def total(data, ns):
+            return len(data) + sum(ns)
+        """), vars(module))
+        dispatch = G.dispatch_function(module)
+        event = {'call_descr': {'function': 'packed', 'arg_names': ['n']},
+                 'locals': {'n': 5}}
+        data = dispatch(event, None)
+        assert data['pysfn_codec'] == 'bytes'
+        event = {'call_descr': {'calls': [
+                     {'function': 'counts', 'arg_names': ['data'],
+                      'target': 'ns', 'offload': True},
+                     {'function': 'total', 'arg_names': ['data', 'ns'],
+                      'target': 'r'}]},
+                 'locals': {'data': data}}
+        result = dispatch(event, None)
+        # Encoded values are decoded as the calls read them, and results
+        # encoded only on leaving the handler.
+        assert result['r'] == 5 + 4
+        assert result['ns']['pysfn_codec'] == 'array'
+        event = {'call_descr': {'function': 'total',
+                                'arg_names': ['data', 'ns']},
+                 'locals': result}
+        assert dispatch(event, None) == 9
+
+    def test_no_codecs(self, handler_module):
+        assert not handler_module.uses_codecs
+        module = types.ModuleType('plain')
+        exec(textwrap.dedent("""
+        def same(xs) -> list:
+            return xs
+        """), vars(module))
+        dispatch = G.dispatch_function(module)
+        xs = [{'pysfn_codec': 'bytes', 'data': ''}, [{'a': 1}]]
+        event = {'call_descr': {'function': 'same', 'arg_names': ['xs']},
+                 'locals': {'xs': xs}}
+        # Without codecs, arguments are not looked inside, let alone
+        # copied.
+        assert dispatch(event, None) is xs
+
+    @pytest.mark.parametrize('source, called, expected', [
+        ('def f(x) -> bytes: pass', ['f'], True),
+        ('def f(x) -> "typing.List[ int ]": pass', ['f'], True),
+        ('def f(x) -> typing.Dict[str, int]: pass', ['f'], True),
+        ('async def f(x) -> array.array: pass', ['f'], True),
+        ('def f(x) -> list: pass\ndef g(x) -> bytes: pass', ['f'], False),
+        ('def f(x) -> Optional[bytes]: pass', ['f'], False),
+        ('def f(x) -> str: pass\nclass E(Exception): pass', ['f', 'E'],
+         False),
+        ('def f(x): pass', ['f'], False),
+        ('from m import f', ['f'], True),
+        ('def f(x) -> kinds()[0]: pass', ['f'], True)])
+    def test_source_uses_codecs(self, source, called, expected):
+        assert G.source_uses_codecs(source, called) == expected
+
+    def test_awaitable_result(self):
+        module = types.ModuleType('waiting')
+        exec(textwrap.dedent("""
+        import asyncio
+
+        async def later(x):
+            await asyncio.sleep(0)
+            return x + 1
+
+        class Ready:
+            def __init__(self, x):
+                self.x = x
+
+            def __await__(self):
+                return (yield from later(self.x).__await__())
+        """), vars(module))
+        dispatch = G.dispatch_function(module)
+        for function in ['later', 'Ready']:
+            event = {'call_descr': {'function': function,
+                                    'arg_names': ['x']},
+                     'locals': {'x': 41}}
+            assert dispatch(event, None) == 42
+
+    def test_no_arguments(self):
+        dispatch = G.dispatch_function(A)
+        event = {'call_descr': {'function': 'TextTooShortError',
+                                'arg_names': []},
+                 'locals': {}}
+        assert isinstance(dispatch(event, None), A.TextTooShortError)
+
+    def test_timing(self, monkeypatch, capsys):
+        monkeypatch.setenv('PYSFN_TIMING', '1')
+        dispatch = G.dispatch_function(A, ['get_n_spaces'])
+        event = {'call_descr': {'function': 'get_n_spaces',
+                                'arg_names': ['text']},
+                 'locals': {'text': 'a b c'}}
+        assert dispatch(event, None) == 2
+        assert capsys.readouterr().out.startswith(
+            'pysfn call get_n_spaces: ')
+
+
+class TestCalledFunctions:
+    @pytest.mark.parametrize('options', [{}, {'compact_calls': True},
+                                         {'fuse_calls': True},
+                                         {'auto_parallel': 'all'}])
+    def test_example(self, options):
+        with open(code_fname) as f_in:
+            syntax_tree = ast.parse(f_in.read())
+        xln_ctx = C.TranslationContext('arn:...', **options)
+        defn = xln_ctx.state_machine_json_obj(syntax_tree)
+        assert G.called_functions(defn) == example_functions
+
+    def test_map(self):
+        syntax_tree = ast.parse(textwrap.dedent("""
+        @PSF.main
+        def main(xs):
+            ys = PSF.map(f, xs)
+            return ys
+        """))
+        defn = C.TranslationContext('arn:...').state_machine_json_obj(
+            syntax_tree)
+        assert G.called_functions(defn) == {'f'}
+
+    def test_source(self):
+        assert G.source_called_functions(code_fname) == example_functions
+
+    def test_by_resource(self):
+        with open(code_fname) as f_in:
+            syntax_tree = ast.parse(f_in.read())
+        arns = {'format_result': 'arn:fmt', 'format_c_result': 'arn:fmt',
+                '*': 'arn:main'}
+        for options in [{}, {'compact_calls': True}, {'fuse_calls': True}]:
+            xln_ctx = C.TranslationContext(arns, **options)
+            defn = xln_ctx.state_machine_json_obj(syntax_tree)
+            assert G.called_functions_by_resource(defn) == {
+                'arn:fmt': {'format_result', 'format_c_result'},
+                'arn:main': example_functions - {'format_result',
+                                                 'format_c_result'}}
+
+    def test_resource_group_name(self):
+        assert G.resource_group_name(
+            'arn:aws:lambda:eu-west-1:123456789012:function:fmt') == 'fmt'
+        assert G.resource_group_name(
+            'arn:aws:lambda:eu-west-1:123456789012:function:fmt:live') == 'fmt'
+        assert G.resource_group_name('arn:...') == 'arn_...'
+
+
+class TestBundle:
+    def build(self, tmp_path, *args):
+        zip_fname = str(tmp_path / 'lambda-function.zip')
+        result = CliRunner().invoke(G.compile_zipfile,
+                                    [code_fname, zip_fname] + list(args))
+        assert result.exit_code == 0, result.output
+        bundle_dir = tmp_path / 'bundle'
+        with zipfile.ZipFile(zip_fname) as f_zip:
+            f_zip.extractall(bundle_dir)
+        return bundle_dir
+
+    def test_definition_option(self, tmp_path):
+        defn = {'States': {'n0': {
+                    'Type': 'Task', 'Resource': 'arn:...', 'End': True,
+                    'Parameters': {'call_descr': {'function': 'get_summary',
+                                                  'arg_names': ['text']}}}},
+                'StartAt': 'n0'}
+        defn_fname = tmp_path / 'machine.json'
+        defn_fname.write_text(json.dumps(defn))
+        bundle_dir = self.build(tmp_path, '--definition', str(defn_fname))
+        handler_text = (bundle_dir / 'handler.py').read_text()
+        assert "for name in ['get_summary']" in handler_text
+        assert 'sys.path.insert' not in handler_text
+
+    def test_cold_start(self, tmp_path):
+        # Run the handler as a fresh process would, with a module which
+        # records being executed, imported by the code but deferred.
+        bundle_dir = self.build(tmp_path, '--lazy-import', 'heavy')
+        with open(bundle_dir / 'inner' / 'analyse_text.py', 'a') as f_out:
+            f_out.write('\nimport heavy\n')
+        lib_dir = tmp_path / 'lib'
+        lib_dir.mkdir()
+        (lib_dir / 'heavy.py').write_text(
+            'print("heavy executed")\nVALUE = 42\n')
+        script = textwrap.dedent("""
+        import handler
+        print('imported')
+        print(handler.inner_module.heavy.VALUE)
+        """)
+        env = dict(os.environ, PYTHONPATH=str(lib_dir))
+        env.pop('PYSFN_TIMING', None)
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=str(bundle_dir), env=env,
+            capture_output=True, text=True, check=True)
+        # 'heavy' ran only when its attribute was first used.
+        assert result.stdout.splitlines() == ['imported',
+                                              'heavy executed', '42']
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=str(bundle_dir),
+            env=dict(env, PYSFN_TIMING='1'),
+            capture_output=True, text=True, check=True)
+        assert result.stdout.startswith('pysfn init: ')
+
+    def test_split(self, tmp_path):
+        xln_ctx = C.TranslationContext(
+            {'get_summary': 'arn:aws:lambda:r:1:function:summary',
+             '*': 'arn:aws:lambda:r:1:function:rest'})
+        with open(code_fname) as f_in:
+            defn = xln_ctx.state_machine_json_obj(ast.parse(f_in.read()))
+        defn_fname = tmp_path / 'machine.json'
+        defn_fname.write_text(json.dumps(defn))
+        zip_template = str(tmp_path / 'fn-{group}.zip')
+        result = CliRunner().invoke(
+            G.compile_zipfile, [code_fname, zip_template, '--split',
+                                '--definition', str(defn_fname)])
+        assert result.exit_code == 0, result.output
+        with zipfile.ZipFile(str(tmp_path / 'fn-summary.zip')) as f_zip:
+            handler_text = f_zip.read('handler.py').decode()
+            code = f_zip.read('inner/analyse_text.py').decode()
+        assert "for name in ['get_summary']" in handler_text
+        assert 'def get_summary' in code
+        assert 'def format_result' not in code
+        with zipfile.ZipFile(str(tmp_path / 'fn-rest.zip')) as f_zip:
+            code = f_zip.read('inner/analyse_text.py').decode()
+        assert 'def get_summary' not in code
+        assert 'def format_result' in code
+
+    def test_split_by_function(self, tmp_path):
+        zip_template = str(tmp_path / '{group}.zip')
+        result = CliRunner().invoke(G.compile_zipfile,
+                                    [code_fname, zip_template, '--split'])
+        assert result.exit_code == 0, result.output
+        assert sorted(os.listdir(str(tmp_path))) == sorted(
+            '{}.zip'.format(name) for name in example_functions)
+
+    def test_split_needs_group(self, tmp_path):
+        result = CliRunner().invoke(
+            G.compile_zipfile, [code_fname, str(tmp_path / 'l.zip'),
+                                '--split'])
+        assert result.exit_code == 2
+        assert "must contain '{group}'" in result.stderr
@@ -0,0 +1,145 @@
+from pysfn.tools import merge as M
+from pysfn.tools import compile as C
+import ast
+import attr
+import json
+import os.path
+
+from .helpers import definition, succeed, task, choice
+
+
+example_fname = os.path.join(os.path.dirname(__file__),
+                             '..', 'examples', 'analyse_text.py')
+
+
+class TestMergedDefinition:
+    def test_identical_leaves(self):
+        defn = definition('c', c=choice('a', default='b'),
+                          a=succeed(), b=succeed())
+        merged = M.merged_definition(defn)
+        assert list(merged['States']) == ['c', 'a']
+        assert merged['States']['c']['Default'] == 'a'
+
+    def test_identical_subgraphs(self):
+        defn = definition('c', c=choice('t1', 't3', default='t5'),
+                          t1=task('t2'), t2=succeed(),
+                          t3=task('t4'), t4=succeed(),
+                          t5=task('t6', Resource='arn:other'), t6=succeed())
+        merged = M.merged_definition(defn)
+        assert list(merged['States']) == ['c', 't1', 't2', 't5']
+        assert ([r['Next'] for r in merged['States']['c']['Choices']]
+                == ['t1', 't1'])
+        assert merged['States']['t5']['Next'] == 't2'
+
+    def test_differing_successors_not_merged(self):
+        defn = definition('c', c=choice('t1', default='t2'),
+                          t1=task('s1'), s1=succeed(),
+                          t2=task('f'), f={'Type': 'Fail'})
+        assert M.merged_definition(defn) == defn
+
+    def test_catch_targets(self):
+        fail = {'Type': 'Fail', 'Error': 'E'}
+        defn = definition('t1',
+                          t1=task('t2', Catch=[{'ErrorEquals': ['E'],
+                                                'Next': 'f1'}]),
+                          t2=task('s', Catch=[{'ErrorEquals': ['E'],
+                                               'Next': 'f2'}]),
+                          s=succeed(), f1=fail, f2=dict(fail))
+        merged = M.merged_definition(defn)
+        assert 'f2' not in merged['States']
+        assert merged['States']['t2']['Catch'][0]['Next'] == 'f1'
+
+    def test_start_at_merged(self):
+        defn = definition('b', a=succeed(), b=succeed())
+        assert M.merged_definition(defn) == definition('a', a=succeed())
+
+    def test_parallel_branches(self):
+        def branch(prefix):
+            return definition(prefix + '0',
+                              **{prefix + '0': task(prefix + '1'),
+                                 prefix + '1': succeed(),
+                                 prefix + '2': succeed()})
+        defn = definition(
+            'c', c=choice('p1', default='p2'),
+            p1={'Type': 'Parallel', 'Branches': [branch('x')], 'Next': 's'},
+            p2={'Type': 'Parallel', 'Branches': [branch('y')], 'Next': 's'},
+            s=succeed())
+        merged = M.merged_definition(defn)
+        # Within each branch, the two Succeed states merge; the Parallel
+        # states then differ only in their states' names.
+        assert list(merged['States']['p1']['Branches'][0]['States']) \
+            == ['x0', 'x1']
+        assert list(merged['States']) == ['c', 'p1', 's']
+        assert merged['States']['c']['Default'] == 'p1'
+
+    def test_cycle(self):
+        defn = definition('c1',
+                          c1=choice('c2', default='s1'),
+                          c2=choice('c1', default='s2'),
+                          s1=succeed(), s2=succeed())
+        # Only states whose successors are already merged are merged, so
+        # the two Choice states, each of which leads to the other, stay.
+        merged = M.merged_definition(defn)
+        assert list(merged['States']) == ['c1', 'c2', 's1']
+        assert merged['States']['c2']['Default'] == 's1'
+
+    def test_payloads_not_renamed(self):
+        defn = definition('p', p={'Type': 'Pass', 'Result': {'Next': 'b'},
+                                  'Next': 'b'},
+                          a=succeed(), b=succeed())
+        merged = M.merged_definition(defn)
+        assert merged['States']['p'] == {'Type': 'Pass',
+                                         'Result': {'Next': 'b'},
+                                         'Next': 'a'}
+
+    def test_n_states(self):
+        defn = definition(
+            'p', p={'Type': 'Parallel',
+                    'Branches': [definition('a', a=succeed())] * 2,
+                    'Next': 's'},
+            s=succeed())
+        assert M.n_states(defn) == 4
+
+
+class TestTranslation:
+    source = '\n'.join([
+        '@PSF.main',
+        'def main(x):',
+        '    if PSF.NumericEquals(x, 1):',
+        '        y = f(x)',
+        '        return y',
+        '    elif PSF.NumericEquals(x, 2):',
+        '        y = f(x)',
+        '        return y',
+        '    else:',
+        '        y = f(x)',
+        '        return y'])
+
+    def test_merge_states(self):
+        tree = ast.parse(self.source)
+        plain = C.TranslationContext('arn:...:function:dispatch')
+        merging = C.TranslationContext('arn:...:function:dispatch',
+                                       merge_states=True)
+        plain_obj = plain.state_machine_json_obj(tree)
+        merged_obj = merging.state_machine_json_obj(tree)
+        assert M.n_states(merged_obj) < M.n_states(plain_obj)
+        choice_state = merged_obj['States'][merged_obj['StartAt']]
+        targets = {r['Next'] for r in choice_state['Choices']}
+        assert targets == {choice_state['Default']}
+        items, start_at = merging.state_machine_definition(tree)
+        assert {'States': dict(items), 'StartAt': start_at} == merged_obj
+
+    def test_options_key(self):
+        plain = C.TranslationContext('arn:...:function:dispatch')
+        merging = attr.evolve(plain, merge_states=True)
+        assert plain.options_key() != merging.options_key()
+
+    def test_example_fixpoint(self):
+        with open(example_fname) as f_in:
+            tree = ast.parse(f_in.read())
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch',
+                                       merge_states=True)
+        obj = xln_ctx.state_machine_json_obj(tree)
+        assert M.merged_definition(obj) == obj
+        json.dumps(obj)
+
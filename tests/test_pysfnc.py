@@ -1,7 +1,13 @@
 import pytest
 from pysfn.tools import compile as C
+from pysfn import definition as PSF
+from click.testing import CliRunner
 import ast
+import attr
+import json
+import os.path
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 
@@ -70,6 +76,12 @@ def translation_context():
     return C.TranslationContext('arn:...:function:dispatch')
 
 
+@pytest.fixture(scope='module')
+def compact_translation_context():
+    return C.TranslationContext('arn:...:function:dispatch',
+                                compact_calls=True)
+
+
 class TestSupportFunctions:
     def test_psf_attr(self):
         val = expr_value('PSF.hello_world')
@@ -346,6 +358,21 @@ class TestFunctionCallIR:
                                             translation_context,
                                             'the_result', 'foo', ['bar', 'baz'])
 
+    def test_as_compact_fragment(self, sample_funcall_with_retry,
+                                 compact_translation_context, factory):
+        ir = factory(sample_funcall_with_retry)
+        frag = ir.as_fragment(compact_translation_context, 'the_result')
+        assert frag.n_states == 1
+        task_state = frag.all_states[0]
+        assert task_state is frag.enter_state
+        assert frag.exit_states == [task_state]
+        assert task_state.fields['Type'] == 'Task'
+        assert task_state.fields['ResultPath'] == '$.locals.the_result'
+        assert task_state.fields['Parameters'] == {
+            'call_descr': {'function': 'foo', 'arg_names': ['bar', 'baz']},
+            'locals': {'bar.$': '$.locals.bar', 'baz.$': '$.locals.baz'}}
+        assert len(task_state.fields['Retry']) == 2
+
 
 class TestAssignmentIR:
     @pytest.fixture(scope='module', params=[C.AssignmentIR, C.StatementIR])
@@ -411,6 +438,19 @@ class TestTryIR:
                                             translation_context,
                                             'qux', 'bar', ['baz'])
 
+    def test_as_compact_fragment(self, sample_try_stmt,
+                                 compact_translation_context):
+        ir = C.TryIR.from_ast_node(sample_try_stmt)
+        frag = ir.as_fragment(compact_translation_context)
+        assert frag.n_states == 5  # One per assignment
+        s_task = frag.enter_state
+        assert s_task.fields['Type'] == 'Task'
+        catches = s_task.fields['Catch']
+        assert len(catches) == 2
+        catch0_s0 = find_state_by_name(frag, catches[0]['Next'])
+        assert catch0_s0.fields['Parameters']['call_descr'] == {
+            'function': 'bar', 'arg_names': ['baz']}
+
 
 @pytest.fixture(scope='module')
 def sample_if_statement():
@@ -456,6 +496,186 @@ class TestIfIR:
                                             'z', 'g', ['u'])
 
 
+@pytest.fixture(scope='module')
+def sample_elif_chain():
+    return stmt_value("""
+    if PSF.StringEquals(foo, 'a'):
+        x = f(y)
+    elif PSF.StringEquals(foo, 'b'):
+        x = g(y)
+    elif PSF.StringEquals(foo, 'c') or PSF.StringEquals(foo, 'd'):
+        x = h(y)
+    else:
+        x = k(y)
+    """)
+
+
+class TestIfElifChain:
+    def test_choice_arms(self, sample_elif_chain):
+        ir = C.IfIR.from_ast_node(sample_elif_chain)
+        arms, default_body = ir.choice_arms()
+        assert len(arms) == 3
+        _assert_comparison_correct(arms[1][0], 'StringEquals', ['foo'], 'b')
+        _assert_is_assignment(arms[2][1].body[0], 'x', 'h', 'y')
+        _assert_is_assignment(default_body.body[0], 'x', 'k', 'y')
+
+    def test_as_fragment(self, translation_context, sample_elif_chain):
+        ir = C.IfIR.from_ast_node(sample_elif_chain)
+        frag = ir.as_fragment(translation_context)
+        assert frag.n_states == 9  # Two per assignment; one for choice.
+        assert len(frag.exit_states) == 4  # One per branch.
+        choice_states = [s for s in frag.all_states
+                         if s.fields['Type'] == 'Choice']
+        assert choice_states == [frag.enter_state]
+        choices = frag.enter_state.fields['Choices']
+        assert len(choices) == 3
+        assert choices[2]['Or'][1] == {'Variable': '$.locals.foo',
+                                       'StringEquals': 'd'}
+        for choice, exp_fun in zip(choices, ['f', 'g', 'h']):
+            s0 = find_state_by_name(frag, choice['Next'])
+            s1 = find_successor_state(frag, s0)
+            _assert_state_pair_forms_assignment(s0, s1, translation_context,
+                                                'x', exp_fun, ['y'])
+        default_s0 = find_state_by_name(frag,
+                                        frag.enter_state.fields['Default'])
+        default_s1 = find_successor_state(frag, default_s0)
+        _assert_state_pair_forms_assignment(default_s0, default_s1,
+                                            translation_context,
+                                            'x', 'k', ['y'])
+
+    def test_nested_if_in_longer_else_not_merged(self, translation_context):
+        ir = C.IfIR.from_ast_node(stmt_value("""
+        if PSF.StringEquals(foo, 'a'):
+            x = f(y)
+        else:
+            z = g(y)
+            if PSF.StringEquals(foo, 'b'):
+                x = h(y)
+            else:
+                x = k(y)
+        """))
+        arms, default_body = ir.choice_arms()
+        assert len(arms) == 1
+        frag = ir.as_fragment(translation_context)
+        assert len(frag.enter_state.fields['Choices']) == 1
+
+
+def _choice_test(text):
+    return C.ChoiceConditionIR.from_ast_node(expr_value(text))
+
+
+class TestBranchProfile:
+    @pytest.fixture(scope='module')
+    def recorded_locals(self):
+        return ([{'foo': 'c', 'y': 1}] * 6
+                + [{'foo': 'd', 'y': 1}] * 3
+                + [{'foo': 'a'}, {'bar': 'x'}])
+
+    def test_evaluate(self):
+        test = _choice_test('PSF.StringEquals(foo["bar"], "x")'
+                            ' and PSF.StringEquals(baz, "y")')
+        assert test.evaluate({'foo': {'bar': 'x'}, 'baz': 'y'})
+        assert not test.evaluate({'foo': {'bar': 'x'}, 'baz': 'z'})
+        assert not test.evaluate({'baz': 'y'})
+
+    def test_n_evaluations(self):
+        test = _choice_test('PSF.StringEquals(foo, "x")'
+                            ' or PSF.StringEquals(foo, "y")'
+                            ' or PSF.StringEquals(foo, "z")')
+        assert test.n_evaluations({'foo': 'x'}) == 1
+        assert test.n_evaluations({'foo': 'y'}) == 2
+        assert test.n_evaluations({'foo': 'w'}) == 3
+
+    def test_reordered_terms(self, recorded_locals):
+        test = _choice_test('PSF.StringEquals(foo, "a")'
+                            ' or PSF.StringEquals(foo, "d")'
+                            ' or PSF.StringEquals(foo, "c")')
+        reordered = test.reordered(recorded_locals)
+        assert ([v.predicate_literal for v in reordered.values]
+                == ['c', 'd', 'a'])
+
+    @pytest.mark.parametrize(
+        'texts, exp_exclusive',
+        [(['PSF.StringEquals(foo, "a")',
+           'PSF.StringEquals(foo, "b") or PSF.StringEquals(foo, "c")'],
+          True),
+         (['PSF.StringEquals(foo, "a")',
+           'PSF.StringEquals(foo, "b") or PSF.StringEquals(foo, "a")'],
+          False),
+         (['PSF.StringEquals(foo, "a")', 'PSF.StringEquals(bar, "b")'],
+          False),
+         (['PSF.StringEquals(foo, "a") and PSF.StringEquals(foo, "b")'],
+          False)]
+    )
+    def test_arms_mutually_exclusive(self, texts, exp_exclusive):
+        tests = [_choice_test(t) for t in texts]
+        assert C.arms_mutually_exclusive(tests) == exp_exclusive
+
+    def test_ordered_arms(self, recorded_locals):
+        profile = C.BranchProfile({'n7': recorded_locals}, 2)
+        tests_and_xs = [(_choice_test('PSF.StringEquals(foo, "a")'), 'A'),
+                        (_choice_test('PSF.StringEquals(foo, "b")'
+                                      ' or PSF.StringEquals(foo, "c")'), 'B'),
+                        (_choice_test('PSF.StringEquals(foo, "d")'), 'D')]
+        ordered = profile.ordered_arms('n7', tests_and_xs)
+        assert [x for _, x in ordered] == ['B', 'D', 'A']
+        assert ordered[0][0].values[0].predicate_literal == 'c'
+        report, = profile.reports
+        assert report.arms_reordered
+        assert report.n_visits == 11
+        # Source order: 'c' costs 3, 'd' 4, 'a' 1, neither 4.
+        assert report.n_evaluations_before == 6 * 3 + 3 * 4 + 1 + 4
+        # Profiled order: 'c' costs 1, 'd' 3, 'a' 4, neither 4.
+        assert report.n_evaluations_after == 6 * 1 + 3 * 3 + 4 + 4
+        assert report.n_evaluations_saved == 35 - 23
+        assert profile.ordered_arms('n99', tests_and_xs) == tests_and_xs
+
+    def test_overlapping_arms_kept(self, recorded_locals):
+        profile = C.BranchProfile({'n7': recorded_locals}, 1)
+        tests_and_xs = [(_choice_test('PSF.StringEquals(foo, "a")'), 'A'),
+                        (_choice_test('PSF.StringEquals(y, "b")'), 'Y')]
+        ordered = profile.ordered_arms('n7', tests_and_xs)
+        assert [x for _, x in ordered] == ['A', 'Y']
+        assert not profile.reports[0].arms_reordered
+
+    def test_from_history_files(self, tmp_path):
+        def entered(name, locals_obj):
+            return {'type': 'ChoiceStateEntered',
+                    'stateEnteredEventDetails': {
+                        'name': name,
+                        'input': json.dumps({'locals': locals_obj})}}
+        history = {'events': [{'type': 'ExecutionStarted'},
+                              entered('n3', {'foo': 'a'}),
+                              {'type': 'ChoiceStateExited'},
+                              entered('n9', {'foo': 'b'})]}
+        for i in range(2):
+            (tmp_path / f'history-{i}.json').write_text(json.dumps(history))
+        fnames = C.history_fnames([str(tmp_path)])
+        assert len(fnames) == 2
+        profile = C.BranchProfile.from_history_files(fnames)
+        assert profile.n_executions == 2
+        assert profile.inputs_by_state == {'n3': [{'foo': 'a'}] * 2,
+                                           'n9': [{'foo': 'b'}] * 2}
+
+    def test_as_fragment(self, sample_elif_chain):
+        class AnyStateInputs(dict):
+            def get(self, name, default=None):
+                return [{'foo': 'c'}, {'foo': 'c'}, {'foo': 'b'}]
+        profile = C.BranchProfile(AnyStateInputs(), 1)
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch',
+                                       branch_profile=profile)
+        frag = C.IfIR.from_ast_node(sample_elif_chain).as_fragment(xln_ctx)
+        choices = frag.enter_state.fields['Choices']
+        assert choices[0]['Or'][0] == {'Variable': '$.locals.foo',
+                                       'StringEquals': 'c'}
+        assert choices[1]['StringEquals'] == 'b'
+        assert choices[2]['StringEquals'] == 'a'
+        summary = list(profile.summary_lines())
+        assert len(summary) == 2
+        assert summary[-1] == ('expected per execution: 3.00'
+                               ' rule evaluations saved')
+
+
 @pytest.fixture(scope='module')
 def sample_parallel_invocation():
     return suite_value("""
@@ -510,6 +730,143 @@ class TestParallelIR:
         assert len(b1['States']) == 3  # ... plus one return
 
 
+class TestAsyncParallel:
+    def test_same_as_sync(self, sample_parallel_invocation):
+        async_nodes = suite_value("""
+        async def f1():
+            r = await f(bar, baz)
+            s = await g(r)
+            return s
+        async def f2():
+            x = await m(u)
+            return x
+        results = PSF.parallel(f1, f2)
+        """)
+        ir = C.SuiteIR.from_ast_nodes(async_nodes)
+        assert ir == C.SuiteIR.from_ast_nodes(sample_parallel_invocation)
+
+
+class TestMapIR:
+    def test_from_ast_node(self):
+        ir = C.AssignmentSourceIR.from_ast_node(
+            expr_value('ys = PSF.map(f, xs, max_concurrency=4)'), {})
+        assert ir == C.MapIR('f', 'xs', 4)
+
+    def test_unlimited(self):
+        ir = C.AssignmentSourceIR.from_ast_node(
+            expr_value('ys = PSF.map(f, xs)'), {})
+        assert ir.max_concurrency == 0
+
+    def test_legacy_literal(self, monkeypatch):
+        # As Python before 3.8 parses 'max_concurrency=4'.
+        class Num(ast.expr):
+            _fields = ('n',)
+        monkeypatch.setattr(C, 'legacy_literal_fields', ((Num, 'n'),))
+        nd = expr_value('ys = PSF.map(f, xs, max_concurrency=4)')
+        nd.keywords[0].value = Num(n=4)
+        assert (C.AssignmentSourceIR.from_ast_node(nd, {})
+                == C.MapIR('f', 'xs', 4))
+
+    @pytest.mark.parametrize(
+        'text',
+        ['ys = PSF.map(f)',
+         'ys = PSF.map(f, xs, max_concurrency=n)',
+         'ys = PSF.map(f, xs, max_concurrency=-1)',
+         'ys = PSF.map(f, xs, batch_size=10)'])
+    def test_bad_map(self, text):
+        _test_factory_raises(expr_value(text), mk_assign_src_empty_defs)
+
+    def test_for_loop_rejected(self):
+        nd = stmt_value("""
+        for x in xs:
+            ys.append(f(x))
+        """)
+        with pytest.raises(ValueError, match='PSF.map'):
+            mk_statement_empty_defs(nd)
+
+    def test_as_fragment(self, translation_context):
+        ir = C.MapIR('f', 'xs', 4)
+        frag = ir.as_fragment(translation_context, 'ys')
+        assert frag.n_states == 1
+        fields = frag.enter_state.fields
+        assert fields['Type'] == 'Map'
+        assert fields['ItemsPath'] == '$.locals.xs'
+        assert fields['MaxConcurrency'] == 4
+        assert fields['ResultPath'] == '$.locals.ys'
+        assert fields['ItemSelector'] == {
+            'call_descr': {'function': 'f', 'arg_names': ['item']},
+            'locals': {'item.$': '$$.Map.Item.Value'}}
+        processor = fields['ItemProcessor']
+        assert processor['ProcessorConfig'] == {'Mode': 'INLINE'}
+        task = processor['States'][processor['StartAt']]
+        assert task == {'Type': 'Task',
+                        'Resource': translation_context.lambda_arn,
+                        'End': True}
+
+    def test_no_max_concurrency_field(self, translation_context):
+        frag = C.MapIR('f', 'xs').as_fragment(translation_context, 'ys')
+        assert 'MaxConcurrency' not in frag.enter_state.fields
+
+    def test_liveness(self):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+        xs = g(x)
+        ys = PSF.map(f, xs, max_concurrency=2)
+        return ys
+        """))
+        assert suite.live_in(set()) == {'x'}
+
+    def test_item_source(self, translation_context):
+        ir = C.AssignmentSourceIR.from_ast_node(expr_value(
+            'ys = PSF.map(f, PSF.items_from("s3://data/rows.csv"))'), {})
+        assert ir.item_source == C.ItemSourceIR('data', 'rows.csv', 'CSV')
+        assert ir.used_vars() == set()
+        fields = ir.as_fragment(translation_context, 'ys').enter_state.fields
+        assert 'ItemsPath' not in fields
+        assert fields['ItemReader'] == {
+            'Resource': 'arn:aws:states:::s3:getObject',
+            'ReaderConfig': {'InputType': 'CSV',
+                             'CSVHeaderLocation': 'FIRST_ROW'},
+            'Parameters': {'Bucket': 'data', 'Key': 'rows.csv'}}
+        assert (fields['ItemProcessor']['ProcessorConfig']
+                == {'Mode': 'DISTRIBUTED', 'ExecutionType': 'STANDARD'})
+
+    def test_item_source_input_type(self):
+        ir = C.AssignmentSourceIR.from_ast_node(expr_value(
+            'ys = PSF.map(f, PSF.items_from("s3://data/rows",'
+            ' input_type="JSONL"))'), {})
+        assert ir.item_source.input_type == 'JSONL'
+        assert 'CSVHeaderLocation' not in \
+            ir.item_source.item_reader()['ReaderConfig']
+
+    def test_item_source_legacy_literals(self, monkeypatch):
+        # As Python before 3.8 parses string literals.
+        class Str(ast.expr):
+            _fields = ('s',)
+        monkeypatch.setattr(C, 'legacy_literal_fields', ((Str, 's'),))
+        nd = expr_value('ys = PSF.map(f, PSF.items_from("s3://data/rows",'
+                        ' input_type="JSONL"))')
+        items_from = nd.args[1]
+        items_from.args = [Str(s='s3://data/rows')]
+        items_from.keywords[0].value = Str(s='JSONL')
+        ir = C.AssignmentSourceIR.from_ast_node(nd, {})
+        assert ir.item_source == C.ItemSourceIR('data', 'rows', 'JSONL')
+
+    @pytest.mark.parametrize(
+        'text',
+        ['ys = PSF.map(f, PSF.items_from(uri))',
+         'ys = PSF.map(f, PSF.items_from("/local/rows.csv"))',
+         'ys = PSF.map(f, PSF.items_from("s3://data/rows"))',
+         'ys = PSF.map(f, PSF.items_from("s3://data/rows.csv",'
+         ' input_type="XML"))',
+         'ys = PSF.map(f, g(xs))'])
+    def test_bad_item_source(self, text):
+        _test_factory_raises(expr_value(text), mk_assign_src_empty_defs)
+
+    def test_local_semantics(self):
+        assert PSF.map(lambda x: 2 * x, [1, 2, 3], max_concurrency=2) \
+            == [2, 4, 6]
+
+
 class TestSuiteIR:
     @pytest.fixture(scope='module')
     def sample_suite(self):
@@ -539,20 +896,671 @@ class TestSuiteIR:
         assert frag.exit_states == [states[3]]
 
 
+class TestStateMachineFragmentIR:
+    def test_flattened(self, translation_context):
+        def state():
+            return C.StateMachineStateIR.from_fields(translation_context,
+                                                     Type='Pass')
+        s0, s1, s2, s3 = [state() for _ in range(4)]
+        inner = C.StateMachineFragmentIR([s1, s2], s1, [s1, s2])
+        outer = C.StateMachineFragmentIR([s0, inner, s3], s0, [inner, s3])
+        assert outer.all_states == [s0, s1, s2, s3]
+        assert outer.exit_states == [s1, s2, s3]
+        assert outer.n_states == 4
+
+    def test_long_elif_chain(self, translation_context):
+        n_arms = 600
+        lines = ['@PSF.main', 'def main(x):']
+        for i in range(n_arms):
+            lines += ["    {} PSF.StringEquals(x, 'v{}'):"
+                      .format('if' if i == 0 else 'elif', i),
+                      '        y = f(x)']
+        lines += ['    else:', '        y = g(x)', '    return y']
+        tree = ast.parse('\n'.join(lines))
+        xln_ctx = attr.evolve(translation_context, auto_parallel='all',
+                              fuse_calls=True, prune_locals=True)
+        obj = xln_ctx.state_machine_json_obj(tree)
+        choice = obj['States'][obj['StartAt']]
+        assert len(choice['Choices']) == n_arms
+
+
+@pytest.fixture(scope='module')
+def sample_independent_calls():
+    return suite_value("""
+        a = f(x)
+        b = g(y)
+        c = h(a, b)
+        d = k(x)
+        x = m(y)
+        if PSF.StringEquals(c, 'yes'):
+            e = f(d)
+            u = g(d)
+        else:
+            e = h(d, d)
+        return e
+    """)
+
+
+class TestAutoParallel:
+    @staticmethod
+    def _assert_parallel_targets(ir, *exp_targets):
+        assert isinstance(ir, C.AutoParallelIR)
+        assert [a.target_varname for a in ir.assignments] == list(exp_targets)
+
+    def test_levels(self, sample_independent_calls):
+        suite = C.SuiteIR.from_ast_nodes(sample_independent_calls)
+        assert C.call_assignment_levels(suite.body[:5]) == [0, 0, 1, 0, 0]
+
+    def test_dependent_levels(self):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            a = g(y)
+            b = h(a)
+            y = k(b)
+        """))
+        assert C.call_assignment_levels(suite.body) == [0, 1, 2, 3]
+
+    def test_parallelised_stmts(self, sample_independent_calls):
+        suite = C.SuiteIR.from_ast_nodes(sample_independent_calls)
+        stmts = C.parallelised_stmts(suite.body, lambda call: True)
+        assert len(stmts) == 4
+        self._assert_parallel_targets(stmts[0], 'a', 'b', 'd', 'x')
+        _assert_is_assignment(stmts[1], 'c', 'h', 'a', 'b')
+        assert isinstance(stmts[2], C.IfIR)
+        _assert_is_return(stmts[3], 'e')
+
+    def test_rewrite_suites(self, sample_independent_calls):
+        suite = C.SuiteIR.from_ast_nodes(sample_independent_calls)
+        new_suite = C.rewrite_suites(
+            suite, lambda stmts: C.parallelised_stmts(stmts, lambda c: True))
+        self._assert_parallel_targets(new_suite.body[2].true_body.body[0],
+                                      'e', 'u')
+        _assert_is_assignment(new_suite.body[2].false_body.body[0],
+                              'e', 'h', 'd', 'd')
+        # Original is untouched.
+        assert len(suite.body) == 7
+
+    def test_ineligible_calls_stay(self, sample_independent_calls):
+        suite = C.SuiteIR.from_ast_nodes(sample_independent_calls)
+        stmts = C.parallelised_stmts(suite.body,
+                                     lambda call: call.fun_name != 'k')
+        self._assert_parallel_targets(stmts[0], 'a', 'b')
+        _assert_is_assignment(stmts[1], 'c', 'h', 'a', 'b')
+        _assert_is_assignment(stmts[2], 'd', 'k', 'x')
+        _assert_is_assignment(stmts[3], 'x', 'm', 'y')
+
+    def test_as_fragment(self, translation_context):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(y)
+        """))
+        ir = C.AutoParallelIR(suite.body)
+        frag = ir.as_fragment(translation_context)
+        assert frag.n_states == 2
+        s_parallel = frag.enter_state
+        assert s_parallel.fields['Type'] == 'Parallel'
+        assert s_parallel.fields['ResultSelector'] == {
+            'a.$': '$[0].locals.a', 'b.$': '$[1].locals.b'}
+        assert s_parallel.fields['ResultPath'] == '$.parallel_result'
+        branch_0 = s_parallel.fields['Branches'][0]
+        assert len(branch_0['States']) == 2
+        task_0 = [s for s in branch_0['States'].values()
+                  if s['Type'] == 'Task'][0]
+        assert task_0['End'] is True
+        s_merge = find_successor_state(frag, s_parallel)
+        assert s_merge.fields == {
+            'Type': 'Pass',
+            'Parameters': {'locals.$': ('States.JsonMerge($.locals,'
+                                        ' $.parallel_result, false)')}}
+        assert frag.exit_states == [s_merge]
+
+    def test_pure_only(self):
+        tree = ast.parse(textwrap.dedent("""
+            @PSF.pure
+            def f(x):
+                return x
+
+            def g(x):
+                return x
+
+            @PSF.main
+            def main(x, y):
+                a = f(x)
+                b = g(y)
+                c = f(y)
+                return c
+        """))
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch',
+                                       auto_parallel='pure')
+        frag = xln_ctx.top_level_state_machine(tree)
+        obj = frag.as_json_obj()
+        parallels = [s for s in obj['States'].values()
+                     if s['Type'] == 'Parallel']
+        assert len(parallels) == 0  # 'g' separates the two calls of 'f'
+        xln_ctx = attr.evolve(xln_ctx, auto_parallel='all')
+        obj = xln_ctx.top_level_state_machine(tree).as_json_obj()
+        parallels = [s for s in obj['States'].values()
+                     if s['Type'] == 'Parallel']
+        assert len(parallels) == 1
+        assert len(parallels[0]['Branches']) == 3
+
+
+class TestFusedCalls:
+    @pytest.fixture(scope='module')
+    def sample_suite(self):
+        return C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(a)
+            c = PSF.with_retry_spec(h, (b,), (["Bad"], 1, 2, 1.5))
+            d = f(c)
+            e = g(d)
+            try:
+                u = f(e)
+            except Bad:
+                u = g(e)
+            v = h(u)
+        """))
+
+    def test_fused_stmts(self, sample_suite):
+        stmts = C.fused_stmts(sample_suite.body)
+        assert len(stmts) == 5
+        assert isinstance(stmts[0], C.FusedCallIR)
+        assert [a.target_varname for a in stmts[0].assignments] == ['a', 'b']
+        _assert_is_assignment(stmts[1], 'c', 'h', 'b')
+        assert [a.target_varname for a in stmts[2].assignments] == ['d', 'e']
+        assert isinstance(stmts[3], C.TryIR)
+        _assert_is_assignment(stmts[4], 'v', 'h', 'u')
+
+    def test_call_descriptor(self, sample_suite):
+        ir = C.FusedCallIR(sample_suite.body[:2])
+        assert ir.call_descriptor() == {
+            'calls': [{'function': 'f', 'arg_names': ['x'], 'target': 'a'},
+                      {'function': 'g', 'arg_names': ['a'], 'target': 'b'}]}
+
+    def test_as_fragment(self, sample_suite, translation_context):
+        ir = C.FusedCallIR(sample_suite.body[:2])
+        frag = ir.as_fragment(translation_context)
+        assert frag.n_states == 2
+        s_pass, s_task = frag.all_states
+        assert s_pass.fields == {'Type': 'Pass',
+                                 'Result': ir.call_descriptor(),
+                                 'ResultPath': '$.call_descr'}
+        assert s_pass.next_state_name == s_task.name
+        assert s_task.fields == {'Type': 'Task',
+                                 'Resource': translation_context.lambda_arn,
+                                 'ResultPath': '$.locals'}
+
+    def test_as_compact_fragment(self, sample_suite,
+                                 compact_translation_context):
+        ir = C.FusedCallIR(sample_suite.body[:2])
+        frag = ir.as_fragment(compact_translation_context)
+        assert frag.n_states == 1
+        assert frag.enter_state.fields['Parameters'] == {
+            'call_descr': ir.call_descriptor(),
+            'locals.$': '$.locals'}
+        assert frag.enter_state.fields['ResultPath'] == '$.locals'
+
+
+class TestFunctionArns:
+    source = textwrap.dedent("""
+        @PSF.main
+        def main(x):
+            a = f(x)
+            b = g(a)
+            c = h(b)
+            ys = PSF.map(f, c)
+            return ys
+        """)
+
+    def resources(self, lambda_arn, **kwargs):
+        xln_ctx = C.TranslationContext(lambda_arn, **kwargs)
+        obj = xln_ctx.state_machine_json_obj(ast.parse(self.source))
+        tasks = [s for s in obj['States'].values() if s['Type'] == 'Task']
+        map_state = next(s for s in obj['States'].values()
+                         if s['Type'] == 'Map')
+        processor = map_state['ItemProcessor']
+        return ([t['Resource'] for t in tasks],
+                processor['States'][processor['StartAt']]['Resource'])
+
+    def test_template(self):
+        task_arns, map_arn = self.resources('arn:...:function:{function}')
+        assert task_arns == ['arn:...:function:f', 'arn:...:function:g',
+                             'arn:...:function:h']
+        assert map_arn == 'arn:...:function:f'
+
+    def test_mapping(self):
+        arns = {'g': 'arn:g', '*': 'arn:default'}
+        task_arns, map_arn = self.resources(arns)
+        assert task_arns == ['arn:default', 'arn:g', 'arn:default']
+        assert map_arn == 'arn:default'
+
+    def test_unmapped_function(self):
+        with pytest.raises(ValueError, match="no Lambda ARN for function 'h'"):
+            self.resources({'f': 'arn:f', 'g': 'arn:g'})
+
+    def test_fusion_within_arn(self):
+        arns = {'h': 'arn:h', '*': 'arn:default'}
+        task_arns, _ = self.resources(arns, fuse_calls=True)
+        # 'f' and 'g' share an invocation; 'h' has its own.
+        assert task_arns == ['arn:default', 'arn:h']
+
+    def test_fused_stmts(self):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(a)
+            c = h(b)
+            d = f(c)
+        """))
+        stmts = C.fused_stmts(suite.body, {'h': 'arn:h'}.get)
+        assert len(stmts) == 3
+        assert [a.target_varname for a in stmts[0].assignments] == ['a', 'b']
+        _assert_is_assignment(stmts[1], 'c', 'h', 'b')
+        _assert_is_assignment(stmts[2], 'd', 'f', 'c')
+
+    def test_lambda_arns(self):
+        assert C.lambda_arns('arn:x', []) == 'arn:x'
+        assert C.lambda_arns('arn:x', [('f', 'arn:f')]) == {'f': 'arn:f',
+                                                           '*': 'arn:x'}
+
+    def test_command(self):
+        example_fname = os.path.join(os.path.dirname(__file__),
+                                     '..', 'examples', 'analyse_text.py')
+        result = CliRunner().invoke(
+            C.main, [example_fname, 'arn:default',
+                     '--function-arn', 'get_summary=arn:summary'])
+        assert result.exit_code == 0, result.output
+        resources = {s.get('Resource')
+                     for s in json.loads(result.stdout)['States'].values()}
+        assert {'arn:default', 'arn:summary'} <= resources
+        result = CliRunner().invoke(
+            C.main, [example_fname, 'arn:default',
+                     '--function-arn', 'get_summary'])
+        assert result.exit_code == 2
+        assert 'expected FUNCTION=ARN' in result.stderr
+
+
+class TestOffloading:
+    @pytest.fixture(scope='module')
+    def sample_suite(self):
+        return C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(a)
+            if PSF.StringEquals(b, 'p'):
+                try:
+                    c = h(a)
+                except Bad:
+                    c = k(a)
+                ys = PSF.map(f, c)
+                return ys
+            else:
+                d = h(a)
+                return d
+        """))
+
+    def test_state_read_vars(self, sample_suite):
+        assert C.state_read_vars(sample_suite) == {'b', 'c', 'ys', 'd'}
+
+    def test_offloading_suite(self, sample_suite):
+        suite = C.offloading_suite(sample_suite)
+        a, b, if_ir = suite.body
+        assert a.source.offload
+        assert not b.source.offload
+        try_ir, map_assignment, _ = if_ir.true_body.body
+        assert not try_ir.body.body[0].source.offload
+        assert map_assignment.source.call_descriptor() == {
+            'function': 'f', 'arg_names': ['item']}
+        assert if_ir.false_body.body[0].source.call_descriptor() == {
+            'function': 'h', 'arg_names': ['a']}
+        assert a.source.call_descriptor() == {
+            'function': 'f', 'arg_names': ['x'], 'offload': True}
+
+    def test_fused(self):
+        tree = ast.parse(textwrap.dedent("""
+            @PSF.main
+            def main(x):
+                a = f(x)
+                b = g(a)
+                return b
+        """))
+        xln_ctx = C.TranslationContext('arn:...', fuse_calls=True,
+                                       offload_values=True)
+        obj = xln_ctx.state_machine_json_obj(tree)
+        assert obj['States']['n0']['Result'] == {'calls': [
+            {'function': 'f', 'arg_names': ['x'], 'offload': True,
+             'target': 'a'},
+            {'function': 'g', 'arg_names': ['a'], 'target': 'b'}]}
+
+
+class TestLiveness:
+    @pytest.fixture(scope='module')
+    def sample_suite(self):
+        return C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(a, y)
+            if PSF.StringEquals(b['kind'], 'p'):
+                c = h(a)
+            elif PSF.StringEquals(b['kind'], 'q'):
+                c = k(y)
+            else:
+                raise PSF.Fail('Bad', 'unknown kind')
+            d = m(c, y)
+            return d
+        """))
+
+    def test_live_in(self, sample_suite):
+        assert sample_suite.live_in(set()) == {'x', 'y'}
+        if_ir = sample_suite.body[2]
+        assert if_ir.live_in({'c', 'y'}) == {'a', 'b', 'y'}
+
+    def test_assigned_vars(self, sample_suite):
+        assert sample_suite.body[2].assigned_vars() == {'c'}
+        assert sample_suite.assigned_vars() is None
+        assert C.SuiteIR(sample_suite.body[:2]).assigned_vars() == {'a', 'b'}
+
+    def test_pruned_suite(self, sample_suite):
+        ir = C.pruned_suite(sample_suite, set(), {'x', 'y'})
+        assert len(ir.body) == 7
+        _assert_is_assignment(ir.body[0], 'a', 'f', 'x')
+        assert ir.body[1] == C.PruneLocalsIR(['a', 'y'])
+        _assert_is_assignment(ir.body[2], 'b', 'g', 'a', 'y')
+        if_ir = ir.body[3]
+        arms, default_body = if_ir.choice_arms()
+        assert len(arms) == 2  # Chain is still an if/elif/else chain.
+        assert arms[0][1].body[0] == C.PruneLocalsIR(['a', 'y'])
+        assert arms[1][1].body[0] == C.PruneLocalsIR(['y'])
+        assert ir.body[4] == C.PruneLocalsIR(['c', 'y'])
+        assert ir.body[6] == sample_suite.body[4]
+
+    def test_pruning_folded_into_fused_call(self):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(a)
+            c = h(b, x)
+            d = PSF.with_retry_spec(k, (c,), (["Bad"], 1, 2, 1.5))
+            return d
+        """))
+        fused_suite = C.rewrite_suites(suite, C.fused_stmts)
+        ir = C.pruned_suite(fused_suite, set(), {'x'})
+        assert len(ir.body) == 3
+        assert ir.body[0].keep_locals == ['c']
+        assert ir.body[0].call_descriptor()['keep_locals'] == ['c']
+
+    def test_pruning_folded_into_auto_parallel(self, translation_context):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            a = f(x)
+            b = g(y)
+            c = h(a, b, y)
+            return c
+        """))
+        par_suite = C.rewrite_suites(
+            suite, lambda stmts: C.parallelised_stmts(stmts, lambda c: True))
+        ir = C.pruned_suite(par_suite, set(), {'x', 'y'})
+        assert len(ir.body) == 3
+        assert ir.body[0].keep_locals == ['a', 'b', 'y']
+        frag = ir.body[0].as_fragment(translation_context)
+        s_merge = frag.exit_states[0]
+        assert s_merge.fields['Parameters'] == {
+            'locals': {'a.$': '$.parallel_result.a',
+                       'b.$': '$.parallel_result.b',
+                       'y.$': '$.locals.y'}}
+
+    def test_maybe_assigned_not_pruned(self):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            if PSF.StringEquals(x, 'p'):
+                a = f(x)
+            else:
+                b = g(x)
+            c = h(a)
+            d = k(c)
+            return d
+        """))
+        ir = C.pruned_suite(suite, set(), {'x'})
+        # 'a' is live after the 'if' but may not be present, so the
+        # locals cannot be rebuilt there; after 'c = h(a)' they can.
+        assert isinstance(ir.body[1], C.AssignmentIR)
+        assert ir.body[2] == C.PruneLocalsIR(['c'])
+
+    def test_as_fragment(self, translation_context):
+        frag = C.PruneLocalsIR(['a', 'b']).as_fragment(translation_context)
+        assert frag.n_states == 1
+        assert frag.enter_state.fields == {
+            'Type': 'Pass',
+            'Parameters': {'locals': {'a.$': '$.locals.a',
+                                      'b.$': '$.locals.b'}}}
+
+
+class TestCaching:
+    @pytest.fixture
+    def cached_translation_context(self, tmp_path, monkeypatch):
+        # Cache every suite, however small, so the samples exercise it.
+        monkeypatch.setattr(C, 'min_cached_suite_statements', 1)
+        return C.TranslationContext(
+            'arn:...:function:dispatch',
+            cache=C.CompilationCache(str(tmp_path / 'cache')))
+
+    @pytest.fixture(scope='module')
+    def sample_tree(self):
+        return ast.parse(textwrap.dedent("""
+            @PSF.main
+            def main(x):
+                a = f(x)
+                if PSF.StringEquals(a, 'p'):
+                    b = g(a)
+                else:
+                    b = h(a)
+                    c = k(b)
+                return b
+        """))
+
+    def test_relocated_state_names(self):
+        obj = {'Type': 'Parallel',
+               'Branches': [{'States': {'n3': {'Type': 'Pass', 'Next': 'n4'},
+                                        'n4': {'Type': 'Succeed'}},
+                             'StartAt': 'n3'}],
+               'Catch': [{'ErrorEquals': ['Next'], 'Next': 'n5'}],
+               'Default': 'n6',
+               'Result': {'Default': 'x'}}
+        relocated = C.relocated_state_names(obj, 10)
+        assert relocated['Branches'][0] == {
+            'States': {'n13': {'Type': 'Pass', 'Next': 'n14'},
+                       'n14': {'Type': 'Succeed'}},
+            'StartAt': 'n13'}
+        assert relocated['Catch'] == [{'ErrorEquals': ['Next'],
+                                       'Next': 'n15'}]
+        assert relocated['Default'] == 'n16'
+        assert obj['Default'] == 'n6'
+
+    def test_cacheable_obj_round_trip(self, sample_tree, translation_context):
+        suite = C.SuiteIR.from_ast_nodes(sample_tree.body[0].body)
+        base_id = translation_context.next_id
+        frag = suite.as_fragment(translation_context)
+        obj = json.loads(json.dumps(frag.as_cacheable_obj(
+            base_id, translation_context.next_id)))
+        assert obj['n_ids'] == frag.n_states
+        new_frag = C.StateMachineFragmentIR.from_cacheable_obj(
+            obj, translation_context)
+        offset = int(new_frag.enter_state.name[1:]) - int(frag.enter_state.name[1:])
+        assert offset == obj['n_ids']
+        assert (new_frag.as_json_obj()
+                == C.relocated_state_names(frag.as_json_obj(), offset))
+        assert len(new_frag.exit_states) == len(frag.exit_states)
+
+    @staticmethod
+    def _normalised(obj):
+        base_id = min(int(name[1:]) for name in obj['States'])
+        return C.relocated_state_names(obj, -base_id)
+
+    def test_machine_cache(self, sample_tree, cached_translation_context):
+        xln_ctx = cached_translation_context
+        obj_1 = xln_ctx.state_machine_json_obj(sample_tree)
+        obj_2 = xln_ctx.state_machine_json_obj(sample_tree)
+        assert obj_1 == obj_2
+        assert xln_ctx.cache.hits['machine'] == 1
+        assert xln_ctx.cache.misses['suite'] == 3
+
+    def test_suite_cache(self, sample_tree, cached_translation_context):
+        xln_ctx = cached_translation_context
+        xln_ctx.state_machine_json_obj(sample_tree)
+        # Change the main function outside the 'if': the bodies of the
+        # 'if' should come from the cache.
+        changed_tree = ast.parse(textwrap.dedent("""
+            @PSF.main
+            def main(x):
+                a = f(x)
+                if PSF.StringEquals(a, 'p'):
+                    b = g(a)
+                else:
+                    b = h(a)
+                    c = k(b)
+                d = m(b)
+                return d
+        """))
+        obj = xln_ctx.state_machine_json_obj(changed_tree)
+        assert xln_ctx.cache.hits['suite'] == 2
+        uncached_ctx = C.TranslationContext(xln_ctx.lambda_arn)
+        assert (self._normalised(obj)
+                == self._normalised(
+                    uncached_ctx.state_machine_json_obj(changed_tree)))
+
+    def test_small_suites_not_cached(self, sample_tree, tmp_path):
+        xln_ctx = C.TranslationContext(
+            'arn:...:function:dispatch',
+            cache=C.CompilationCache(str(tmp_path / 'cache')))
+        xln_ctx.state_machine_json_obj(sample_tree)
+        assert xln_ctx.cache.misses['suite'] == 0
+        assert xln_ctx.cache.misses['machine'] == 1
+
+    def test_n_statements(self, sample_tree):
+        suite = C.SuiteIR.from_ast_nodes(sample_tree.body[0].body)
+        assert C.n_statements(suite) == 6
+
+    def test_options_key_made_once(self, cached_translation_context,
+                                   monkeypatch):
+        xln_ctx = cached_translation_context
+        key = xln_ctx.options_key()
+        monkeypatch.setattr(C, 'compiler_version', lambda: 1 / 0)
+        assert xln_ctx.options_key() == key
+
+    def test_options_change_key(self, sample_tree,
+                                cached_translation_context):
+        xln_ctx = cached_translation_context
+        other_ctx = attr.evolve(xln_ctx, compact_calls=True)
+        assert (xln_ctx.machine_cache_key(sample_tree)
+                != other_ctx.machine_cache_key(sample_tree))
+        obj = other_ctx.state_machine_json_obj(sample_tree)
+        assert any('Parameters' in s for s in obj['States'].values())
+
+    def test_referenced_defs_in_key(self, sample_tree,
+                                    cached_translation_context):
+        pure_tree = ast.parse(textwrap.dedent("""
+            @PSF.pure
+            def g(a):
+                return a
+        """))
+        pure_tree.body.extend(sample_tree.body)
+        xln_ctx = cached_translation_context
+        assert (xln_ctx.machine_cache_key(sample_tree)
+                != xln_ctx.machine_cache_key(pure_tree))
+
+
+class TestReentrancy:
+    @pytest.fixture(scope='module')
+    def sample_trees(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               '..', 'examples', 'analyse_text.py')) as f_in:
+            example_tree = ast.parse(f_in.read())
+        other_tree = ast.parse(textwrap.dedent("""
+            @PSF.main
+            def main(x):
+                y = f(x)
+                if PSF.StringEquals(y, 'a'):
+                    z = g(y)
+                    return z
+                else:
+                    return x
+        """))
+        return [example_tree, other_tree]
+
+    def test_deterministic_names(self, sample_trees, translation_context):
+        obj_1 = translation_context.state_machine_json_obj(sample_trees[0])
+        translation_context.state_machine_json_obj(sample_trees[1])
+        obj_2 = translation_context.state_machine_json_obj(sample_trees[0])
+        assert obj_1 == obj_2
+        assert obj_1['StartAt'] == 'n0'
+
+    @pytest.mark.parametrize('use_cache', [False, True])
+    def test_thread_pool(self, sample_trees, tmp_path, use_cache):
+        cache = (C.CompilationCache(str(tmp_path / 'cache'))
+                 if use_cache else None)
+        xln_ctx = C.TranslationContext('arn:...:function:dispatch',
+                                       fuse_calls=True, cache=cache)
+        expected = [C.TranslationContext(xln_ctx.lambda_arn, fuse_calls=True)
+                    .state_machine_json_obj(tree)
+                    for tree in sample_trees]
+        trees = sample_trees * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            objs = list(executor.map(xln_ctx.state_machine_json_obj, trees))
+        assert objs == expected * 20
+        assert xln_ctx.next_id == 0
+        if use_cache:
+            assert (sum(cache.hits.values()) + sum(cache.misses.values())
+                    >= len(trees))
+
+
+class TestCompactIR:
+    @pytest.mark.parametrize('cls', [C.SuiteIR, C.AssignmentIR, C.IfIR,
+                                     C.FunctionCallIR, C.TestComparisonIR,
+                                     C.StateMachineStateIR,
+                                     C.StateMachineFragmentIR])
+    def test_slotted(self, cls):
+        for klass in cls.__mro__[:-1]:
+            assert '__slots__' in vars(klass), klass
+
+    def test_interned_paths(self):
+        assert (C.chained_key_smr(['foo', 'bar'])
+                is C.chained_key_smr(['foo'] + ['bar']))
+
+    def test_shared_call_fields(self, translation_context):
+        suite = C.SuiteIR.from_ast_nodes(suite_value("""
+            try:
+                x = f(y)
+            except ValueError:
+                return y
+            x = f(y)
+            x = f(y)
+            return x
+        """))
+        xln_ctx = attr.evolve(translation_context, shared_fields={})
+        states = suite.as_fragment(xln_ctx).all_states
+        pass_0, task_0, _, pass_1, task_1, pass_2, task_2, _ = states
+        assert pass_0.fields is pass_1.fields is pass_2.fields
+        assert task_1.fields is task_2.fields
+        # The 'Catch' is added to a copy of the shared fields.
+        assert 'Catch' in task_0.fields
+        assert 'Catch' not in task_1.fields
+
+
 class TestStateMachineStateIR:
-    def test_construction(self):
-        sms_1 = C.StateMachineStateIR.from_fields(Type='Wait', Seconds=30)
-        sms_2 = C.StateMachineStateIR.from_fields(Type='Wait', Seconds=60)
+    def test_construction(self, translation_context):
+        xln_ctx = translation_context
+        sms_1 = C.StateMachineStateIR.from_fields(
+            xln_ctx, Type='Wait', Seconds=30)
+        sms_2 = C.StateMachineStateIR.from_fields(
+            xln_ctx, Type='Wait', Seconds=60)
         assert sms_1.name != sms_2.name
         assert sms_1.fields == {'Type': 'Wait', 'Seconds': 30}
         assert sms_2.fields == {'Type': 'Wait', 'Seconds': 60}
 
-    def test_as_json_no_next(self):
-        sms = C.StateMachineStateIR.from_fields(Type='Wait', Seconds=30)
+    def test_as_json_no_next(self, translation_context):
+        xln_ctx = translation_context
+        sms = C.StateMachineStateIR.from_fields(
+            xln_ctx, Type='Wait', Seconds=30)
         assert sms.value_as_json_obj() == {'Type': 'Wait', 'Seconds': 30}
 
-    def test_as_json_with_next(self):
-        sms = C.StateMachineStateIR.from_fields(Type='Wait', Seconds=30)
+    def test_as_json_with_next(self, translation_context):
+        xln_ctx = translation_context
+        sms = C.StateMachineStateIR.from_fields(
+            xln_ctx, Type='Wait', Seconds=30)
         sms.next_state_name = 'do_something'
         assert sms.value_as_json_obj() == {'Type': 'Wait', 'Seconds': 30,
                                            'Next': 'do_something'}